@@ -2,40 +2,150 @@
 
 import pandas as pd
 import numpy as np
+from typing import List
+from covariance import estimate_covariance, to_dense
+from instrumentation import span
+from price_matrix import PriceMatrix, as_price_matrix
+import risk
 
 
 
 class PortfolioAnalyzer:
-    def __init__(self, price_data: pd.DataFrame, risk_free_rate: float = 0.03):
-        self.prices = price_data
-        self.risk_free_rate = risk_free_rate
-        self.returns = self.calculate_daily_returns() # daily returns stored here for reuse.
+    # Every cached quantity and what it is derived from. Changing `prices` or
+    # `risk_free_rate` drops the cached values that depend on it, transitively.
+    _DEPENDENCIES = {
+        'return_matrix': ('prices',),
+        'daily_returns': ('return_matrix',),
+        'cumulative_returns': ('return_matrix',),
+        'annualized_volatility': ('return_matrix',),
+        'annualized_return': ('return_matrix',),
+        'sharpe_ratio': ('annualized_return', 'annualized_volatility', 'risk_free_rate'),
+        'max_drawdown': ('cumulative_returns',),
+        'correlation_matrix': ('return_matrix',),
+        'covariance_estimate': ('return_matrix', 'covariance_estimator'),
+        'covariance_matrix': ('covariance_estimate',),
+        'all_metrics': ('return_matrix', 'risk_free_rate'),
+        'tail_risk': ('return_matrix',),
+        'drawdown_statistics': ('return_matrix',),
+    }
+
+    # price_data is a wide (date x ticker) DataFrame or a PriceMatrix. Metrics
+    # are computed on the PriceMatrix arrays; DataFrames and Series are only
+    # built for the values returned to the caller.
+    def __init__(self, price_data: pd.DataFrame, risk_free_rate: float = 0.03,
+                 covariance_method: str = 'sample', covariance_dtype=np.float64, **covariance_options):
+        with span('analyzer.init', rows=len(price_data)):
+            self._cache = {}
+            self.cache_stats = {'hits': 0, 'misses': 0}
+            self.prices = price_data
+            self.risk_free_rate = risk_free_rate
+            self.set_covariance_estimator(covariance_method, covariance_dtype, **covariance_options)
+
+    @property
+    def prices(self) -> pd.DataFrame:
+        if self._prices is None:
+            self._prices = self._price_matrix.to_frame()
+        return self._prices
+
+    @prices.setter
+    def prices(self, price_data: pd.DataFrame):
+        self._price_matrix = as_price_matrix(price_data)
+        self._prices = None if isinstance(price_data, PriceMatrix) else price_data
+        self._invalidate('prices')
+
+    @property
+    def price_matrix(self) -> PriceMatrix:
+        return self._price_matrix
+
+    @property
+    def risk_free_rate(self) -> float:
+        return self._risk_free_rate
+
+    @risk_free_rate.setter
+    def risk_free_rate(self, rate: float):
+        self._risk_free_rate = rate
+        self._invalidate('risk_free_rate')
+
+    # Select the covariance estimator (see covariance.ESTIMATORS) used by
+    # calculate_covariance_matrix and by the optimizer. float32 halves memory.
+    def set_covariance_estimator(self, method: str = 'sample', dtype=np.float64, **options):
+        self.covariance_method = method
+        self.covariance_dtype = dtype
+        self.covariance_options = options
+        self._invalidate('covariance_estimator')
+
+    # Daily returns are computed on first use and reused afterwards.
+    @property
+    def returns(self) -> pd.DataFrame:
+        return self.calculate_daily_returns()
+
+    # Drop every cached value so the next call recomputes it.
+    def clear_cache(self):
+        self._cache.clear()
+
+    # Return the cached value for key, computing it on the first request.
+    # Cached frames are shared between callers and must not be modified in place.
+    def _cached(self, key: str, compute):
+        if key in self._cache:
+            self.cache_stats['hits'] += 1
+            return self._cache[key]
+        self.cache_stats['misses'] += 1
+        with span(f'analyzer.{key}', rows=len(self._price_matrix)):
+            value = compute()
+        self._cache[key] = value
+        return value
+
+    # Remove the cached values that depend on name.
+    def _invalidate(self, name: str):
+        for key, dependencies in self._DEPENDENCIES.items():
+            if name in dependencies:
+                self._cache.pop(key, None)
+                self._invalidate(key)
+
+    # Daily returns as a PriceMatrix, the form every metric below works on.
+    def return_matrix(self) -> PriceMatrix:
+        return self._cached('return_matrix', self._price_matrix.returns)
+
+    def _per_ticker(self, values: np.ndarray) -> pd.Series:
+        return pd.Series(values, index=self._price_matrix.tickers)
 
     # Calculate daily returns.
     def calculate_daily_returns(self) -> pd.DataFrame:
-        daily_returns = self.prices.pct_change().dropna()
-        return daily_returns
+        return self._cached('daily_returns', lambda: self.return_matrix().to_frame())
 
     # Calculate cumulative returns
     def calculate_cumulative_returns(self) -> pd.DataFrame:
-        cumulative_returns = (1 + self.returns).cumprod().dropna()
-        return cumulative_returns
+        return self._cached('cumulative_returns', self._cumulative_returns)
+
+    def _cumulative_returns(self) -> pd.DataFrame:
+        returns = self.return_matrix()
+        cumulative_returns = np.cumprod(1 + returns.values, axis=0)
+        return PriceMatrix(cumulative_returns, returns.tickers, returns.dates).to_frame()
 
     # Calculate annualized volatility.
     def calculate_annualized_volatility(self) -> pd.Series:
-        std_daily_returns = self.returns.std()
+        return self._cached('annualized_volatility', self._annualized_volatility)
+
+    def _annualized_volatility(self) -> pd.Series:
+        std_daily_returns = self.return_matrix().values.std(axis=0, ddof=1)
         annualized_volatility = std_daily_returns * np.sqrt(252)
-        return annualized_volatility
+        return self._per_ticker(annualized_volatility)
 
 
     # Calculate annualized return.
     def calculate_annualized_return(self) -> pd.Series:
-        average_daily_returns = self.returns.mean() # Take the average of daily returns.
+        return self._cached('annualized_return', self._annualized_return)
+
+    def _annualized_return(self) -> pd.Series:
+        average_daily_returns = self.return_matrix().values.mean(axis=0) # Take the average of daily returns.
         annualized_returns = average_daily_returns * 252
-        return annualized_returns
+        return self._per_ticker(annualized_returns)
 
     # Calculate Sharpe Ratio.
     def calculate_sharpe_ratio(self) -> pd.Series:
+        return self._cached('sharpe_ratio', self._sharpe_ratio)
+
+    def _sharpe_ratio(self) -> pd.Series:
         annualized_returns = self.calculate_annualized_return()
         annualized_volatility = self.calculate_annualized_volatility()
         sharpe_ratio = (annualized_returns - self.risk_free_rate) / annualized_volatility
@@ -44,17 +154,204 @@ class PortfolioAnalyzer:
     # calculate max drawdown.
     # Indicates the max pct drop from the previous high.
     def calculate_max_drawdown(self) -> pd.Series:
-        cumulative_returns = self.calculate_cumulative_returns()
-        running_max = cumulative_returns.cummax()
+        return self._cached('max_drawdown', self._max_drawdown)
+
+    def _max_drawdown(self) -> pd.Series:
+        cumulative_returns = self.calculate_cumulative_returns().to_numpy()
+        running_max = np.maximum.accumulate(cumulative_returns, axis=0)
         drawdown = (running_max - cumulative_returns ) / running_max
-        max_drawdown = drawdown.max()
-        return max_drawdown
+        max_drawdown = drawdown.max(axis=0)
+        return self._per_ticker(max_drawdown)
 
     # Create a function that calculates correlation between assets
     def calculate_correlation_matrix(self) -> pd.DataFrame:
-        return self.returns.corr()
+        return self._cached('correlation_matrix', self._correlation_matrix)
 
+    # Constant tickers have no correlation and get NaN, as in DataFrame.corr.
+    def _correlation_matrix(self) -> pd.DataFrame:
+        returns = self.return_matrix().values
+        centered = returns - returns.mean(axis=0)
+        co_moments = centered.T @ centered
+        scale = np.sqrt(np.diag(co_moments))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = np.clip(co_moments / np.outer(scale, scale), -1, 1)
+        tickers = self._price_matrix.tickers
+        return pd.DataFrame(correlation, index=tickers, columns=tickers)
+
+
+    # Create a function that calculates covariance between assets
+    def calculate_covariance_matrix(self) -> pd.DataFrame:
+        tickers = self._price_matrix.tickers
+        return self._cached('covariance_matrix', lambda: pd.DataFrame(
+            to_dense(self.covariance_estimate()), index=tickers, columns=tickers))
+
+    # Annualized covariance in the selected estimator's native form: an ndarray,
+    # or a covariance.FactorCovariance kept in factored form for the factor model.
+    def covariance_estimate(self):
+        return self._cached('covariance_estimate', lambda: estimate_covariance(
+            self.return_matrix().values, self.covariance_method, self.covariance_dtype,
+            **self.covariance_options))
+
+    # Daily Value at Risk per asset as a positive loss, with the methods in risk.METHODS.
+    def calculate_value_at_risk(self, confidence: float = 0.95, method: str = 'historical') -> pd.Series:
+        return self._tail_risk(confidence, method)['var']
+
+    # Daily Conditional Value at Risk (expected shortfall) per asset.
+    def calculate_conditional_value_at_risk(self, confidence: float = 0.95,
+                                            method: str = 'historical') -> pd.Series:
+        return self._tail_risk(confidence, method)['cvar']
+
+    # VaR and CVaR come out of the same pass and are cached together, one frame
+    # per (confidence, method).
+    def _tail_risk(self, confidence: float, method: str) -> pd.DataFrame:
+        computed = self._cached('tail_risk', dict)
+        if (confidence, method) not in computed:
+            with span(f'analyzer.tail_risk.{method}', rows=len(self._price_matrix)):
+                var, cvar = risk.var_cvar(self.return_matrix().values, confidence, method)
+            computed[(confidence, method)] = pd.DataFrame({'var': var, 'cvar': cvar},
+                                                          index=self._price_matrix.tickers)
+        return computed[(confidence, method)]
+
+    # VaR and CVaR of one weight vector or of every row of a (portfolios x
+    # tickers) weight frame, from the portfolios' daily returns.
+    def calculate_portfolio_tail_risk(self, weights, confidence: float = 0.95,
+                                      method: str = 'historical') -> pd.DataFrame:
+        if isinstance(weights, pd.DataFrame):
+            index = weights.index
+            weights = weights.reindex(columns=self._price_matrix.tickers, fill_value=0).to_numpy(dtype=float)
+        else:
+            index = None
+        var, cvar = risk.var_cvar(risk.portfolio_returns(self.return_matrix().values, weights),
+                                  confidence, method)
+        return pd.DataFrame({'var': var, 'cvar': cvar}, index=index)
+
+    # Depth, dates and durations (in trading days) of each asset's deepest
+    # drawdown, plus its longest and current time under water.
+    def calculate_drawdown_statistics(self) -> pd.DataFrame:
+        return self._cached('drawdown_statistics', self._drawdown_statistics)
+
+    def _drawdown_statistics(self) -> pd.DataFrame:
+        returns = self.return_matrix()
+        stats = risk.drawdown_statistics(returns.values)
+        dates = returns.dates
+        recovery_dates = pd.Series(dates[stats['recovery']]).where(stats['recovery'] >= 0)
+        return pd.DataFrame({
+            "max_drawdown": stats['max_drawdown'],
+            "peak_date": dates[stats['peak']],
+            "trough_date": dates[stats['trough']],
+            "recovery_date": recovery_dates.to_numpy(),
+            "recovery_days": stats['recovery_days'],
+            "max_duration_days": stats['max_duration'],
+            "current_duration_days": stats['current_duration'],
+        }, index=returns.tickers)
+
+    # Calculate every per-asset metric in one pass over the returns array.
+    # Returns one tidy frame indexed by ticker.
+    def compute_all_metrics(self) -> pd.DataFrame:
+        return self._cached('all_metrics', self._all_metrics)
+
+    def _all_metrics(self) -> pd.DataFrame:
+        returns = self.return_matrix().values
+
+        annualized_return = returns.mean(axis=0) * 252
+        annualized_volatility = returns.std(axis=0, ddof=1) * np.sqrt(252)
+        sharpe_ratio = (annualized_return - self.risk_free_rate) / annualized_volatility
+
+        cumulative_returns = np.cumprod(1 + returns, axis=0)
+        running_max = np.maximum.accumulate(cumulative_returns, axis=0)
+        max_drawdown = ((running_max - cumulative_returns) / running_max).max(axis=0)
+
+        return pd.DataFrame({
+            "cumulative_return": cumulative_returns[-1],
+            "annualized_return": annualized_return,
+            "annualized_volatility": annualized_volatility,
+            "sharpe_ratio": sharpe_ratio,
+            "max_drawdown": max_drawdown
+        }, index=self._price_matrix.tickers)
+
+
+# The IncrementalPortfolioAnalyzer keeps running sufficient statistics
+# (Welford mean/co-moment, cumulative product, running max) so that each new
+# bar costs O(assets) for per-asset metrics and O(assets^2) for the covariance
+# instead of rescanning the full price history.
+class IncrementalPortfolioAnalyzer:
+    def __init__(self, tickers: List[str], risk_free_rate: float = 0.03):
+        n_assets = len(tickers)
+        self.tickers = list(tickers)
+        self.risk_free_rate = risk_free_rate
+        self.count = 0 # number of daily returns seen so far
+        self.last_date = None
+        self._last_prices = None
+        self._mean = np.zeros(n_assets)
+        self._comoment = np.zeros((n_assets, n_assets)) # sum of (r - mean)(r - mean)^T
+        self._cumulative = np.ones(n_assets)
+        self._running_max = np.full(n_assets, -np.inf)
+        self._max_drawdown = np.zeros(n_assets)
+
+    # Seed the running statistics from a price history in one batch pass.
+    @classmethod
+    def from_prices(cls, price_data: pd.DataFrame, risk_free_rate: float = 0.03) -> 'IncrementalPortfolioAnalyzer':
+        incremental = cls(price_data.columns.tolist(), risk_free_rate)
+        returns = PortfolioAnalyzer(price_data, risk_free_rate).return_matrix().values
+        if len(returns):
+            cumulative_returns = np.cumprod(1 + returns, axis=0)
+            running_max = np.maximum.accumulate(cumulative_returns, axis=0)
+            centered = returns - returns.mean(axis=0)
+
+            incremental.count = len(returns)
+            incremental._mean = returns.mean(axis=0)
+            incremental._comoment = centered.T @ centered
+            incremental._cumulative = cumulative_returns[-1]
+            incremental._running_max = running_max[-1]
+            incremental._max_drawdown = ((running_max - cumulative_returns) / running_max).max(axis=0)
+        incremental._last_prices = price_data.ffill().iloc[-1].to_numpy(dtype=float)
+        incremental.last_date = price_data.index[-1]
+        return incremental
+
+    # Ingest one new bar of prices (a Series indexed by ticker).
+    def update(self, new_prices_row: pd.Series, date=None):
+        prices = new_prices_row.reindex(self.tickers).to_numpy(dtype=float)
+        if np.isnan(prices).any():
+            raise ValueError("New bar is missing prices for: "
+                             + ", ".join(np.array(self.tickers)[np.isnan(prices)]))
+        if self._last_prices is not None:
+            self._add_return(prices / self._last_prices - 1)
+        self._last_prices = prices
+        self.last_date = date if date is not None else new_prices_row.name
+
+    def _add_return(self, daily_return: np.ndarray):
+        self.count += 1
+        delta = daily_return - self._mean
+        self._mean += delta / self.count
+        self._comoment += np.outer(delta, daily_return - self._mean)
+
+        self._cumulative *= 1 + daily_return
+        self._running_max = np.maximum(self._running_max, self._cumulative)
+        drawdown = (self._running_max - self._cumulative) / self._running_max
+        self._max_drawdown = np.maximum(self._max_drawdown, drawdown)
+
+    def calculate_cumulative_returns(self) -> pd.Series:
+        return pd.Series(self._cumulative, index=self.tickers)
+
+    def calculate_annualized_return(self) -> pd.Series:
+        return pd.Series(self._mean * 252, index=self.tickers)
+
+    def calculate_annualized_volatility(self) -> pd.Series:
+        variance = np.diag(self._comoment) / (self.count - 1)
+        return pd.Series(np.sqrt(variance * 252), index=self.tickers)
+
+    def calculate_sharpe_ratio(self) -> pd.Series:
+        return (self.calculate_annualized_return() - self.risk_free_rate) / self.calculate_annualized_volatility()
+
+    def calculate_max_drawdown(self) -> pd.Series:
+        return pd.Series(self._max_drawdown, index=self.tickers)
 
-    # Create a function that calculates correlation between assets
     def calculate_covariance_matrix(self) -> pd.DataFrame:
-        return self.returns.cov() * 252
+        # The Welford update is symmetric only up to rounding, so symmetrize.
+        covariance = (self._comoment + self._comoment.T) / (2 * (self.count - 1)) * 252
+        return pd.DataFrame(covariance, index=self.tickers, columns=self.tickers)
+
+    def calculate_correlation_matrix(self) -> pd.DataFrame:
+        covariance = self.calculate_covariance_matrix()
+        std = np.sqrt(np.diag(covariance))
+        return covariance / np.outer(std, std)
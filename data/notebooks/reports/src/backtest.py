@@ -0,0 +1,143 @@
+''' The WalkForwardBacktester class answers how an optimized portfolio would have
+performed if it had been re-optimized on a trailing window at every rebalance
+date and held (buy and hold) until the next one.'''
+
+import numpy as np
+import pandas as pd
+
+from analysis import PortfolioAnalyzer
+from portfolio_optimizer import PortfolioOptimizer
+
+
+class WalkForwardBacktester:
+    def __init__(self, price_data: pd.DataFrame, lookback: int = 252, rebalance_frequency: str = 'M',
+                 objective: str = 'max_sharpe', risk_free_rate: float = 0.03):
+        if objective not in ('max_sharpe', 'min_volatility'):
+            raise ValueError(f"Unknown objective: {objective}")
+        self.analyzer = PortfolioAnalyzer(price_data, risk_free_rate)
+        self.lookback = lookback # number of daily returns in each estimation window
+        self.rebalance_frequency = rebalance_frequency
+        self.objective = objective
+        self.risk_free_rate = risk_free_rate
+        self.weights_history = None
+        self.turnover = None
+        self.result = None
+
+    # Rebalance on the last trading day of each period once a full window exists.
+    def rebalance_positions(self) -> np.ndarray:
+        returns = self.analyzer.return_matrix()
+        periods = returns.dates.to_period(self.rebalance_frequency)
+        last_of_period = np.flatnonzero(periods[1:] != periods[:-1])
+        return last_of_period[last_of_period >= self.lookback - 1]
+
+    # Create a function to run the walk-forward backtest.
+    # Returns the daily portfolio return and value between the first rebalance and the end.
+    def run(self) -> pd.DataFrame:
+        returns = self.analyzer.return_matrix()
+        daily_returns = returns.values
+        positions = self.rebalance_positions()
+        if len(positions) == 0:
+            raise ValueError("Not enough history for a single lookback window.")
+
+        tickers = returns.tickers
+        n_assets = len(tickers)
+        window = _RollingMoments(daily_returns, self.lookback)
+        weights = np.ones(n_assets) / n_assets
+        drifted_weights = None
+        weights_rows, turnover_rows, portfolio_returns = [], [], []
+
+        for i, position in enumerate(positions):
+            # Slide the window so it ends on the rebalance date (inclusive).
+            window.move_to(position + 1)
+            weights = self._optimize(window, tickers, weights)
+            turnover_rows.append(0.0 if drifted_weights is None else np.abs(weights - drifted_weights).sum() / 2)
+            weights_rows.append(weights)
+
+            # Hold the new weights until the next rebalance date (or the end of history).
+            end = positions[i + 1] + 1 if i + 1 < len(positions) else len(daily_returns)
+            growth = np.cumprod(1 + daily_returns[position + 1:end], axis=0)
+            if len(growth) == 0:
+                continue
+            value = growth @ weights
+            portfolio_returns.append(np.diff(value, prepend=1.0) / np.concatenate(([1.0], value[:-1])))
+            drifted_weights = weights * growth[-1] / value[-1]
+
+        rebalance_dates = returns.dates[positions]
+        self.weights_history = pd.DataFrame(weights_rows, index=rebalance_dates, columns=tickers)
+        self.turnover = pd.Series(turnover_rows, index=rebalance_dates, name='turnover')
+
+        portfolio_returns = np.concatenate(portfolio_returns) if portfolio_returns else np.array([])
+        result = pd.DataFrame({'portfolio_return': portfolio_returns},
+                              index=returns.dates[positions[0] + 1:positions[0] + 1 + len(portfolio_returns)])
+        result['portfolio_value'] = (1 + result['portfolio_return']).cumprod()
+        self.result = result
+        return result
+
+    # Create a function to summarize the backtest with the usual analyzer metrics.
+    def summary(self) -> pd.Series:
+        if self.result is None:
+            raise ValueError("No backtest results yet. Call run() before summary().")
+        values = pd.concat([pd.Series([1.0]), self.result['portfolio_value'].reset_index(drop=True)])
+        analyzer = PortfolioAnalyzer(values.to_frame('portfolio'), self.risk_free_rate)
+        summary = analyzer.compute_all_metrics().loc['portfolio']
+        summary['average_turnover'] = self.turnover.iloc[1:].mean() if len(self.turnover) > 1 else 0.0
+        return summary
+
+    # Re-optimize on the current window, warm-starting from the previous weights.
+    # If the solver fails the previous weights are kept.
+    def _optimize(self, window: '_RollingMoments', tickers: pd.Index, previous_weights: np.ndarray) -> np.ndarray:
+        annualized_returns, annualized_cov = window.annualized_moments()
+        optimizer = PortfolioOptimizer.from_moments(
+            pd.Series(annualized_returns, index=tickers),
+            pd.DataFrame(annualized_cov, index=tickers, columns=tickers),
+            self.risk_free_rate
+        )
+        try:
+            if self.objective == 'max_sharpe':
+                return optimizer.run_optimization(initial_weights=previous_weights)
+            return optimizer.min_volatility(initial_weights=previous_weights)
+        except ValueError as e:
+            print(f"Optimization failed, keeping previous weights: {e}")
+            return previous_weights
+
+
+# Running sums of returns and return cross-products over a sliding window.
+# Moving the window adds the rows that enter and subtracts the rows that leave,
+# so each step costs O(rows moved x assets^2) instead of O(lookback x assets^2).
+class _RollingMoments:
+    def __init__(self, daily_returns: np.ndarray, lookback: int):
+        self.daily_returns = daily_returns
+        self.lookback = lookback
+        self.start = 0
+        self.end = 0
+        n_assets = daily_returns.shape[1]
+        self.sum = np.zeros(n_assets)
+        self.cross_sum = np.zeros((n_assets, n_assets))
+
+    def move_to(self, end: int):
+        start = max(0, end - self.lookback)
+        if start >= self.end:
+            # No overlap with the current window, rebuild from scratch.
+            self.sum[:] = 0
+            self.cross_sum[:] = 0
+            self._add(start, end)
+        else:
+            self._add(self.end, end)
+            self._subtract(self.start, start)
+        self.start, self.end = start, end
+
+    def annualized_moments(self):
+        count = self.end - self.start
+        mean = self.sum / count
+        cov = (self.cross_sum - count * np.outer(mean, mean)) / (count - 1)
+        return mean * 252, cov * 252
+
+    def _add(self, start: int, end: int):
+        rows = self.daily_returns[start:end]
+        self.sum += rows.sum(axis=0)
+        self.cross_sum += rows.T @ rows
+
+    def _subtract(self, start: int, end: int):
+        rows = self.daily_returns[start:end]
+        self.sum -= rows.sum(axis=0)
+        self.cross_sum -= rows.T @ rows
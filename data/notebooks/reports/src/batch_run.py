@@ -0,0 +1,189 @@
+''' Headless batch runner for scheduled jobs. It reads a JSON config listing
+many portfolios, fetches the union of their tickers once, analyzes and optimizes
+each portfolio in a process pool and saves every result in one transaction.
+
+Example config:
+{
+    "start_date": "2020-01-01",
+    "end_date": "2024-12-31",
+    "risk_free_rate": 0.03,
+    "processes": 4,
+    "fetch": {"max_workers": 4, "shard_size": 50},
+    "portfolios": [
+        {"name": "tech", "tickers": ["AAPL", "MSFT", "NVDA"]},
+        {"name": "income", "tickers": ["KO", "PG", "JNJ"], "start_date": "2018-01-01", "risk_free_rate": 0.04}
+    ]
+}
+start_date, end_date and risk_free_rate at the top level are defaults that each
+portfolio may override. As in the fetch, end_date is exclusive: prices dated
+end_date are not part of the portfolio. Run it with `python batch_run.py --config batch.json`.'''
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from analysis import PortfolioAnalyzer
+from data_pipeline import StockDataFetcher
+from data_sources import DataSource
+from portfolio_optimizer import PortfolioOptimizer
+
+
+# Read the config and fill in each portfolio's dates and risk-free rate from the defaults.
+def load_config(path: str) -> dict:
+    with open(path) as f:
+        config = json.load(f)
+    if not config.get('portfolios'):
+        raise ValueError(f"No portfolios listed in {path}")
+    for i, portfolio in enumerate(config['portfolios']):
+        portfolio.setdefault('name', f'portfolio_{i + 1}')
+        portfolio['tickers'] = [ticker.strip().upper() for ticker in portfolio['tickers']]
+        for key, default in (('start_date', None), ('end_date', None), ('risk_free_rate', 0.03)):
+            portfolio.setdefault(key, config.get(key, default))
+            if portfolio[key] is None:
+                raise ValueError(f"Portfolio {portfolio['name']} has no {key}")
+    return config
+
+
+# Analyze and optimize one portfolio. Any failure (bad data, numerical errors,
+# optimization failures) is reported in the result instead of stopping the batch.
+def analyze_portfolio(name: str, price_data: pd.DataFrame, risk_free_rate: float) -> dict:
+    start_time = time.perf_counter()
+    result = {'name': name, 'tickers': list(price_data.columns), 'error': None}
+    try:
+        if price_data.empty:
+            raise ValueError("no price data")
+        analyzer = PortfolioAnalyzer(price_data, risk_free_rate)
+        result['metrics'] = analyzer.compute_all_metrics()
+        optimizer = PortfolioOptimizer(analyzer)
+        result['weights'] = optimizer.run_optimization()
+        result['min_volatility_weights'] = optimizer.min_volatility(initial_weights=result['weights'])
+        result['expected_return'], result['volatility'], result['sharpe_ratio'] = \
+            optimizer.portfolio_performance(result['weights'])
+    except Exception as e:
+        result['error'] = str(e) or type(e).__name__
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+
+# The union price frame is sent to each worker once by the pool initializer;
+# tasks only carry the portfolio's tickers, dates and risk-free rate.
+_worker_prices = {}
+
+
+def _init_worker(price_data):
+    _worker_prices['prices'] = price_data
+
+
+# Prices of one portfolio over [start_date, end_date), the same half-open range
+# the fetch downloads.
+def _portfolio_prices(price_data: pd.DataFrame, portfolio: dict) -> pd.DataFrame:
+    if price_data.empty:
+        return price_data
+    tickers = [ticker for ticker in portfolio['tickers'] if ticker in price_data.columns]
+    dates = price_data.index
+    in_range = (dates >= pd.Timestamp(portfolio['start_date'])) & (dates < pd.Timestamp(portfolio['end_date']))
+    prices = price_data.loc[in_range, tickers]
+    # Tickers the fetch failed for are all-NaN columns.
+    return prices.dropna(axis=1, how='all').dropna(how='all')
+
+
+def _analyze_portfolio_in_worker(portfolio: dict) -> dict:
+    return analyze_portfolio(portfolio['name'], _portfolio_prices(_worker_prices['prices'], portfolio),
+                             portfolio['risk_free_rate'])
+
+
+# Run every portfolio in the config. processes=1 runs them in this process.
+# source overrides the fetcher's data source, e.g. a CsvDirectorySource offline.
+def run_batch(config: dict, processes: Optional[int] = None, source: Optional[DataSource] = None,
+              save: bool = True) -> dict:
+    portfolios = config['portfolios']
+    processes = processes or config.get('processes') or os.cpu_count()
+    summary = {'portfolios': len(portfolios)}
+    run_start = time.perf_counter()
+
+    # Fetch the union of tickers once over the widest date range.
+    tickers = sorted({ticker for portfolio in portfolios for ticker in portfolio['tickers']})
+    start = min(pd.Timestamp(portfolio['start_date']) for portfolio in portfolios)
+    end = max(pd.Timestamp(portfolio['end_date']) for portfolio in portfolios)
+    fetch_start = time.perf_counter()
+    fetcher = StockDataFetcher(tickers, start, end, source=source, **config.get('fetch', {}))
+    price_data = fetcher.fetch_data()
+    summary['tickers'] = len(tickers)
+    summary['fetch_seconds'] = time.perf_counter() - fetch_start
+
+    analyze_start = time.perf_counter()
+    if processes == 1 or len(portfolios) == 1:
+        results = [analyze_portfolio(portfolio['name'], _portfolio_prices(price_data, portfolio),
+                                     portfolio['risk_free_rate']) for portfolio in portfolios]
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(portfolios)), initializer=_init_worker,
+                                 initargs=(price_data,)) as executor:
+            results = list(executor.map(_analyze_portfolio_in_worker, portfolios))
+    summary['analyze_seconds'] = time.perf_counter() - analyze_start
+
+    succeeded = [result for result in results if result['error'] is None]
+    summary['failed'] = {result['name']: result['error'] for result in results if result['error'] is not None}
+    if save:
+        from db_setup import allocation_records, metrics_records, save_batch_results
+        write_start = time.perf_counter()
+        metrics_list, allocations = [], []
+        for result in succeeded:
+            metrics_list.extend(metrics_records(result['metrics'], result['name']))
+            allocations.extend(allocation_records(result['tickers'], result['weights'], result['sharpe_ratio'],
+                                                  result['volatility'], result['min_volatility_weights'],
+                                                  result['name']))
+        summary['rows_written'] = save_batch_results(metrics_list, allocations, price_data)
+        summary['write_seconds'] = time.perf_counter() - write_start
+
+    summary['total_seconds'] = time.perf_counter() - run_start
+    summary['portfolios_per_second'] = len(portfolios) / summary['analyze_seconds']
+    summary['results'] = results
+    return summary
+
+
+def print_summary(summary: dict):
+    print("\nBatch run summary")
+    print(f"  Portfolios: {summary['portfolios']} ({len(summary['failed'])} failed)")
+    print(f"  Tickers fetched: {summary['tickers']} in {summary['fetch_seconds']:.2f}s")
+    print(f"  Analysis and optimization: {summary['analyze_seconds']:.2f}s "
+          f"({summary['portfolios_per_second']:.1f} portfolios/s)")
+    if 'rows_written' in summary:
+        rows = sum(summary['rows_written'].values())
+        rate = rows / summary['write_seconds'] if summary['write_seconds'] > 0 else float('inf')
+        print(f"  Rows written: {rows} ({', '.join(f'{k}: {v}' for k, v in summary['rows_written'].items())}) "
+              f"in {summary['write_seconds']:.2f}s ({rate:,.0f} rows/s)")
+    print(f"  Total: {summary['total_seconds']:.2f}s")
+    for name, error in summary['failed'].items():
+        print(f"  Failed {name}: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze and optimize many portfolios without prompts')
+    parser.add_argument('--config', required=True, help='JSON file listing the portfolios')
+    parser.add_argument('--processes', type=int, help='worker processes (default: config or CPU count)')
+    parser.add_argument('--no-save', action='store_true', help='skip the database writes')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    if not args.no_save:
+        from db_setup import create_tables
+        create_tables()
+    summary = run_batch(config, processes=args.processes, save=not args.no_save)
+    for result in summary['results']:
+        if result['error'] is None:
+            weights = ", ".join(f"{ticker}: {weight:.2%}" for ticker, weight in
+                                zip(result['tickers'], np.round(result['weights'], 4)) if weight > 0)
+            print(f"{result['name']}: Sharpe {result['sharpe_ratio']:.4f}, "
+                  f"volatility {result['volatility']:.4f} ({weights})")
+    print_summary(summary)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,439 @@
+''' Performance benchmarks for the portfolio analyzer.
+Run from this directory, e.g. `python benchmark.py optimizer --assets 300`.
+`python benchmark.py suite --output results.json` times the analyzer, optimizer
+and database writers over a grid of synthetic universes; pass the JSON of an
+earlier run as --baseline to fail (exit code 1) on regressions.
+`python benchmark.py imports` checks the start-up import time of the entry points.'''
+
+import argparse
+import ast
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+
+from analysis import PortfolioAnalyzer
+from portfolio_optimizer import PortfolioOptimizer
+
+
+# Create deterministic synthetic prices for n_assets over n_days business days.
+# Returns follow a one-factor model (market beta plus idiosyncratic noise) so the
+# covariance has the structure of a real equity universe.
+def synthetic_prices(n_assets: int, n_days: int, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    market = rng.normal(0.0003, 0.01, size=(n_days, 1))
+    betas = rng.uniform(0.5, 1.5, size=n_assets)
+    drift = rng.normal(0.0001, 0.0003, size=n_assets)
+    idiosyncratic = rng.normal(0, 1, size=(n_days, n_assets)) * rng.uniform(0.005, 0.02, size=n_assets)
+    daily_returns = drift + market * betas + idiosyncratic
+    prices = 100 * np.exp(np.cumsum(daily_returns, axis=0))
+    dates = pd.bdate_range('2000-01-03', periods=n_days)
+    tickers = [f'T{i:04d}' for i in range(n_assets)]
+    return pd.DataFrame(prices, index=dates, columns=tickers)
+
+
+# Time a function call and return (seconds, result).
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+# The optimizer before analytic gradients: pandas objectives, finite differences.
+def _finite_difference_max_sharpe(optimizer: PortfolioOptimizer):
+    annualized_returns = optimizer.annualized_returns
+    annualized_cov = optimizer.annualized_cov
+    risk_free_rate = optimizer.risk_free_rate
+    num_assets = len(annualized_returns)
+
+    def negative_sharpe(weights):
+        expected_returns = np.dot(weights, annualized_returns)
+        volatility = np.sqrt(np.dot(weights.T, np.dot(annualized_cov, weights)))
+        return -(expected_returns - risk_free_rate) / volatility
+
+    return minimize(
+        fun=negative_sharpe,
+        x0=np.ones(num_assets) / num_assets,
+        method='SLSQP',
+        bounds=tuple((0, 1) for _ in range(num_assets)),
+        constraints={'type': 'eq', 'fun': lambda w: np.sum(w) - 1}
+    )
+
+
+# Compare the finite-difference and analytic-gradient max-Sharpe solves.
+def benchmark_optimizer_gradients(n_assets: int = 300, n_days: int = 1000, seed: int = 42) -> dict:
+    optimizer = PortfolioOptimizer(PortfolioAnalyzer(synthetic_prices(n_assets, n_days, seed)))
+    finite_difference_time, finite_difference_result = timed(_finite_difference_max_sharpe, optimizer)
+    analytic_time, analytic_weights = timed(optimizer.run_optimization)
+    return {
+        'assets': n_assets,
+        'finite_difference_seconds': finite_difference_time,
+        'finite_difference_evaluations': finite_difference_result.nfev,
+        'analytic_seconds': analytic_time,
+        'speedup': finite_difference_time / analytic_time,
+        'finite_difference_sharpe': optimizer.portfolio_performance(finite_difference_result.x)[2],
+        'analytic_sharpe': optimizer.portfolio_performance(analytic_weights)[2],
+    }
+
+
+# Time the three database writers against a local stand-in database.
+# Uses DATABASE_URL when set, otherwise a temporary SQLite file; the previous
+# DATABASE_URL and engine are restored afterwards.
+def benchmark_db_writes(n_assets: int = 50, n_days: int = 1000, seed: int = 42) -> dict:
+    import database
+    import db_setup
+
+    previous_url = os.environ.get('DATABASE_URL')
+    with tempfile.TemporaryDirectory() as directory:
+        if previous_url is None:
+            os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        database.dispose_engine()
+        try:
+            db_setup.create_tables()
+
+            price_data = synthetic_prices(n_assets, n_days, seed)
+            optimizer = PortfolioOptimizer(PortfolioAnalyzer(price_data))
+            weights = optimizer.run_optimization()
+            _, volatility, sharpe_ratio = optimizer.portfolio_performance(weights)
+            min_vol_weights = optimizer.min_volatility()
+
+            metrics_time, _ = timed(db_setup.save_performance_metrics, price_data)
+            allocations_time, _ = timed(db_setup.save_portfolio_allocations, weights, price_data, sharpe_ratio,
+                                        volatility, min_vol_weights)
+            prices_time, price_rows = timed(db_setup.insert_adjusted_prices, price_data)
+            dialect = database.get_engine().dialect.name
+        finally:
+            # Close the benchmark engine before its database file is removed.
+            database.dispose_engine()
+            if previous_url is None:
+                os.environ.pop('DATABASE_URL', None)
+    return {
+        'database': dialect,
+        'save_performance_metrics_seconds': metrics_time,
+        'save_portfolio_allocations_seconds': allocations_time,
+        'insert_adjusted_prices_seconds': prices_time,
+        'price_rows_per_second': price_rows / prices_time,
+    }
+
+
+# Fetch throughput against the local CSV stand-in with a simulated request latency,
+# sequential (one worker) versus sharded on a thread pool.
+def benchmark_fetch(n_assets: int = 500, n_days: int = 1000, shard_size: int = 25, max_workers: int = 8,
+                    latency: float = 0.2, seed: int = 42) -> dict:
+    from data_pipeline import StockDataFetcher
+    from data_sources import CsvDirectorySource
+
+    price_data = synthetic_prices(n_assets, n_days, seed)
+    start, end = price_data.index[0], price_data.index[-1] + pd.Timedelta(days=1)
+
+    result = {'assets': n_assets}
+    with tempfile.TemporaryDirectory() as directory:
+        CsvDirectorySource.write(price_data, directory)
+        source = CsvDirectorySource(directory, latency=latency)
+        for workers in (1, max_workers):
+            fetcher = StockDataFetcher(list(price_data.columns), start, end, source=source,
+                                       shard_size=shard_size, max_workers=workers)
+            seconds, _ = timed(fetcher.fetch_data)
+            result[f'workers_{workers}_seconds'] = seconds
+            result[f'workers_{workers}_tickers_per_second'] = n_assets / seconds
+    return result
+
+
+# Compare CSV and binary (memory-mapped .npy) storage on size and load time.
+def benchmark_storage(n_assets: int = 2000, n_days: int = 5000, seed: int = 42) -> dict:
+    from price_store import load_price_matrix, save_price_matrix
+
+    price_data = synthetic_prices(n_assets, n_days, seed)
+    projection = list(price_data.columns[:: max(1, n_assets // 10)])
+    start, end = price_data.index[n_days // 2], price_data.index[-1]
+
+    def directory_size(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    # The CSV and the stores take ~300 MB at the default size; remove them afterwards.
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'prices.csv')
+        stores = {'npy': os.path.join(directory, 'npy'), 'npy_float32': os.path.join(directory, 'npy32')}
+        price_data.to_csv(csv_path)
+        save_price_matrix(price_data, stores['npy'])
+        save_price_matrix(price_data, stores['npy_float32'], dtype=np.float32)
+
+        csv_seconds, _ = timed(pd.read_csv, csv_path, index_col=0, parse_dates=True)
+        result = {
+            'csv_bytes': os.path.getsize(csv_path),
+            'csv_load_seconds': csv_seconds,
+        }
+        for name, path in stores.items():
+            result[f'{name}_bytes'] = directory_size(path)
+            # Touch the values so the memory map is actually read.
+            result[f'{name}_load_seconds'], _ = timed(lambda: load_price_matrix(path).to_numpy().sum())
+            result[f'{name}_projected_load_seconds'], _ = timed(
+                lambda: load_price_matrix(path, projection, start, end).to_numpy().sum())
+    return result
+
+
+ANALYZER_METRICS = [
+    'calculate_daily_returns',
+    'calculate_cumulative_returns',
+    'calculate_annualized_volatility',
+    'calculate_annualized_return',
+    'calculate_sharpe_ratio',
+    'calculate_max_drawdown',
+    'calculate_correlation_matrix',
+    'calculate_covariance_matrix',
+    'compute_all_metrics',
+    'calculate_value_at_risk',
+    'calculate_conditional_value_at_risk',
+    'calculate_drawdown_statistics',
+]
+
+DEFAULT_SIZES = ['10x250', '100x1000', '500x2500']
+
+
+# Parse a size such as '500x2500' into (tickers, days).
+def parse_size(size: str) -> tuple:
+    n_assets, n_days = size.lower().split('x')
+    return int(n_assets), int(n_days)
+
+
+# Best of `repeat` runs, which filters out one-off noise from other processes.
+def best_time(func, repeat: int = 3, setup=None) -> float:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        times.append(timed(func)[0])
+    return min(times)
+
+
+# Time every analyzer metric, both optimizer solves, the frontier, the Monte Carlo
+# simulation, batch evaluation and (optionally) the three database writers for one
+# universe size. Metrics are timed on a cold cache, so each includes its inputs.
+# SLSQP cost grows cubically with the number of assets: solves are skipped above
+# max_optimizer_assets and DB writes above max_db_cells (tickers x days).
+def benchmark_size(n_assets: int, n_days: int, seed: int = 42, repeat: int = 3,
+                   max_optimizer_assets: int = 500, max_db_cells: int = 1_000_000) -> dict:
+    price_data = synthetic_prices(n_assets, n_days, seed)
+    analyzer = PortfolioAnalyzer(price_data)
+    timings = {}
+    for metric in ANALYZER_METRICS:
+        timings[f'analyzer.{metric}'] = best_time(getattr(analyzer, metric), repeat, analyzer.clear_cache)
+
+    optimizer = PortfolioOptimizer(analyzer)
+    weights = np.random.default_rng(seed).dirichlet(np.ones(n_assets), size=1000)
+    timings['optimizer.evaluate_portfolios'] = best_time(lambda: optimizer.evaluate_portfolios(weights), repeat)
+    timings['optimizer.simulate_random_portfolios'] = best_time(
+        lambda: optimizer.simulate_random_portfolios(10_000, seed=seed), repeat)
+    if n_assets <= max_optimizer_assets:
+        timings['optimizer.run_optimization'] = best_time(optimizer.run_optimization, repeat)
+        timings['optimizer.min_volatility'] = best_time(optimizer.min_volatility, repeat)
+        timings['optimizer.efficient_frontier'] = best_time(
+            lambda: optimizer.efficient_frontier(n_points=20, processes=1), 1)
+
+    if n_assets * n_days <= max_db_cells:
+        db_result = benchmark_db_writes(n_assets, n_days, seed)
+        for writer in ('save_performance_metrics', 'save_portfolio_allocations', 'insert_adjusted_prices'):
+            timings[f'db.{writer}'] = db_result[f'{writer}_seconds']
+    return timings
+
+
+# Run the suite over a grid of sizes; results are keyed by size then benchmark.
+def run_suite(sizes: list = None, seed: int = 42, repeat: int = 3, max_optimizer_assets: int = 500,
+              max_db_cells: int = 1_000_000) -> dict:
+    results = {}
+    for size in sizes or DEFAULT_SIZES:
+        n_assets, n_days = parse_size(size)
+        print(f"Benchmarking {n_assets} tickers x {n_days} days...")
+        results[size] = benchmark_size(n_assets, n_days, seed, repeat, max_optimizer_assets, max_db_cells)
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'seed': seed,
+        'results': results,
+    }
+
+
+# Compare a run against a baseline run. A benchmark regresses when it is more
+# than `threshold` times slower; timings below min_seconds are too noisy to judge.
+def compare_to_baseline(current: dict, baseline: dict, threshold: float = 1.5, min_seconds: float = 0.01) -> list:
+    regressions = []
+    for size, timings in current['results'].items():
+        for name, seconds in timings.items():
+            baseline_seconds = baseline['results'].get(size, {}).get(name)
+            if baseline_seconds is None or max(seconds, baseline_seconds) < min_seconds:
+                continue
+            ratio = seconds / baseline_seconds
+            if ratio > threshold:
+                regressions.append({'size': size, 'benchmark': name, 'baseline_seconds': baseline_seconds,
+                                    'seconds': seconds, 'ratio': ratio})
+    return regressions
+
+
+# The module-level import statements of a script, read from its source. Imports
+# nested in functions or page branches are deferred and left out.
+def top_level_imports(path: str) -> str:
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    return '; '.join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+# Import statements of each entry point. dashboard.py renders the page when it
+# is imported, so its top-level imports are run instead.
+IMPORT_TARGETS = {
+    'dashboard': top_level_imports(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dashboard.py')),
+    'run': 'import run',
+    'batch_run': 'import batch_run',
+}
+
+# Heavy packages an entry point must not load at start-up; they are imported
+# by the page or function that needs them.
+DEFERRED_IMPORTS = {
+    'dashboard': ['scipy', 'yfinance', 'sqlalchemy', 'matplotlib', 'seaborn', 'PIL'],
+    'run': ['scipy', 'yfinance', 'sqlalchemy', 'matplotlib', 'seaborn'],
+    'batch_run': ['scipy', 'yfinance', 'sqlalchemy', 'matplotlib', 'seaborn'],
+}
+
+
+# Run `statement` in a fresh interpreter under `python -X importtime` and return
+# the total import time in seconds plus the cumulative seconds of each
+# third-party package (the modules of this project are left out).
+def measure_import_time(statement: str) -> tuple:
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=src_dir,
+                               capture_output=True, text=True, check=True)
+    total, packages = 0, {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        package = name.strip().split('.')[0]
+        if not os.path.exists(os.path.join(src_dir, f'{package}.py')):
+            packages[package] = max(packages.get(package, 0), int(cumulative_us) / 1e6)
+    return total / 1e6, packages
+
+
+# Best-of-`repeat` import time for each entry point against a budget, and the
+# deferred packages that were loaded anyway.
+def benchmark_imports(budget_seconds: float = 1.0, repeat: int = 3) -> dict:
+    results = {}
+    for target, statement in IMPORT_TARGETS.items():
+        runs = [measure_import_time(statement) for _ in range(repeat)]
+        seconds, packages = min(runs, key=lambda run: run[0])
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:5]
+        results[target] = {
+            'seconds': seconds,
+            'over_budget': seconds > budget_seconds,
+            'eager_heavy_imports': [name for name in DEFERRED_IMPORTS[target] if name in packages],
+            'heaviest': dict(heaviest),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Portfolio analyzer benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    optimizer_parser = subparsers.add_parser('optimizer', help='analytic vs finite-difference gradients')
+    optimizer_parser.add_argument('--assets', type=int, default=300)
+    optimizer_parser.add_argument('--days', type=int, default=1000)
+    optimizer_parser.add_argument('--seed', type=int, default=42)
+
+    db_parser = subparsers.add_parser('db', help='database writers against a local stand-in')
+    db_parser.add_argument('--assets', type=int, default=50)
+    db_parser.add_argument('--days', type=int, default=1000)
+    db_parser.add_argument('--seed', type=int, default=42)
+
+    fetch_parser = subparsers.add_parser('fetch', help='sharded fetching against a local file source')
+    fetch_parser.add_argument('--assets', type=int, default=500)
+    fetch_parser.add_argument('--days', type=int, default=1000)
+    fetch_parser.add_argument('--shard-size', type=int, default=25)
+    fetch_parser.add_argument('--workers', type=int, default=8)
+    fetch_parser.add_argument('--latency', type=float, default=0.2)
+
+    storage_parser = subparsers.add_parser('storage', help='CSV vs binary price storage')
+    storage_parser.add_argument('--assets', type=int, default=2000)
+    storage_parser.add_argument('--days', type=int, default=5000)
+
+    suite_parser = subparsers.add_parser('suite', help='full suite over a grid of sizes, with JSON output')
+    suite_parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                              help='universe sizes as TICKERSxDAYS, e.g. 10x250 5000x5000')
+    suite_parser.add_argument('--seed', type=int, default=42)
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument('--max-optimizer-assets', type=int, default=500)
+    suite_parser.add_argument('--max-db-cells', type=int, default=1_000_000)
+    suite_parser.add_argument('--output', help='write the results to this JSON file')
+    suite_parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    suite_parser.add_argument('--threshold', type=float, default=1.5,
+                              help='fail when a benchmark is this many times slower than the baseline')
+
+    imports_parser = subparsers.add_parser('imports', help='start-up import time of the entry points')
+    imports_parser.add_argument('--budget-ms', type=float, default=1000,
+                                help='fail when an entry point takes longer than this to import')
+    imports_parser.add_argument('--repeat', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.benchmark == 'imports':
+        results = benchmark_imports(args.budget_ms / 1000, args.repeat)
+        failed = False
+        for target, result in results.items():
+            status = 'OVER BUDGET' if result['over_budget'] else 'ok'
+            print(f"{target}: {result['seconds'] * 1000:.0f} ms ({status})")
+            for name, seconds in result['heaviest'].items():
+                print(f"    {name}: {seconds * 1000:.0f} ms")
+            if result['eager_heavy_imports']:
+                print(f"    imported at start-up but should be deferred: "
+                      f"{', '.join(result['eager_heavy_imports'])}")
+            failed = failed or result['over_budget'] or bool(result['eager_heavy_imports'])
+        if failed:
+            sys.exit(1)
+    elif args.benchmark == 'suite':
+        report = run_suite(args.sizes, args.seed, args.repeat, args.max_optimizer_assets, args.max_db_cells)
+        for size, timings in report['results'].items():
+            print(size)
+            for name, seconds in timings.items():
+                print(f"  {name}: {seconds:.4f}s")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_to_baseline(report, json.load(f), args.threshold)
+            for regression in regressions:
+                print(f"REGRESSION {regression['size']} {regression['benchmark']}: "
+                      f"{regression['baseline_seconds']:.4f}s -> {regression['seconds']:.4f}s "
+                      f"({regression['ratio']:.2f}x)")
+            if regressions:
+                sys.exit(1)
+            print(f"No regressions beyond {args.threshold:.2f}x")
+    elif args.benchmark == 'optimizer':
+        result = benchmark_optimizer_gradients(args.assets, args.days, args.seed)
+        print(f"Max Sharpe with {result['assets']} assets:")
+        print(f"  finite differences: {result['finite_difference_seconds']:.2f}s, "
+              f"{result['finite_difference_evaluations']} objective calls "
+              f"(Sharpe {result['finite_difference_sharpe']:.4f})")
+        print(f"  analytic gradients: {result['analytic_seconds']:.2f}s "
+              f"(Sharpe {result['analytic_sharpe']:.4f})")
+        print(f"  speedup: {result['speedup']:.1f}x")
+    elif args.benchmark in ('db', 'fetch', 'storage'):
+        if args.benchmark == 'db':
+            result = benchmark_db_writes(args.assets, args.days, args.seed)
+        elif args.benchmark == 'storage':
+            result = benchmark_storage(args.assets, args.days)
+        else:
+            result = benchmark_fetch(args.assets, args.days, args.shard_size, args.workers, args.latency)
+        for name, value in result.items():
+            print(f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+''' Shared pytest fixtures. Database tests run against a throwaway SQLite file
+through DATABASE_URL, the same switch the scripts use to run offline.'''
+
+import pytest
+
+
+# An empty database; tables are left to the test (e.g. an earlier schema to migrate).
+@pytest.fixture
+def empty_engine(tmp_path, monkeypatch):
+    import database
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'portfolio.db'}")
+    database.dispose_engine()
+    yield database.get_engine()
+    database.dispose_engine()
+
+
+# A database with the current schema.
+@pytest.fixture
+def engine(empty_engine):
+    import db_setup
+    db_setup.create_tables()
+    return empty_engine
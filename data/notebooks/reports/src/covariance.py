@@ -0,0 +1,124 @@
+''' Covariance estimators for the analyzer and optimizer. Besides the sample
+covariance there is Ledoit-Wolf shrinkage, an exponentially weighted estimator
+and a low-rank-plus-diagonal factor model that is kept in factored form.
+All estimators take a (days x assets) array of daily returns and return an
+annualized covariance.'''
+
+import numpy as np
+
+
+# The factor model covariance B diag(f) B^T + diag(d), stored in factored form.
+# It supports `cov @ x` and `x @ cov` like a dense matrix, so the optimizer
+# objectives accept it unchanged, but each product costs O(n*k) instead of O(n^2).
+class FactorCovariance:
+    __array_ufunc__ = None # make NumPy defer `ndarray @ FactorCovariance` to __rmatmul__
+
+    def __init__(self, loadings: np.ndarray, factor_variances: np.ndarray, specific_variances: np.ndarray):
+        self.loadings = loadings # n_assets x n_factors
+        self.factor_variances = factor_variances # n_factors
+        self.specific_variances = specific_variances # n_assets
+
+    @property
+    def shape(self) -> tuple:
+        n_assets = len(self.specific_variances)
+        return n_assets, n_assets
+
+    @property
+    def dtype(self):
+        return self.loadings.dtype
+
+    def __matmul__(self, x: np.ndarray) -> np.ndarray:
+        factor_exposure = self.loadings.T @ x
+        if factor_exposure.ndim == 1:
+            systematic = self.loadings @ (self.factor_variances * factor_exposure)
+            return systematic + self.specific_variances * x
+        systematic = self.loadings @ (self.factor_variances[:, None] * factor_exposure)
+        return systematic + self.specific_variances[:, None] * x
+
+    # The matrix is symmetric, so x @ cov is (cov @ x^T)^T.
+    def __rmatmul__(self, x: np.ndarray) -> np.ndarray:
+        return (self @ np.asarray(x).T).T
+
+    def diagonal(self) -> np.ndarray:
+        return (self.loadings ** 2) @ self.factor_variances + self.specific_variances
+
+    def to_dense(self) -> np.ndarray:
+        return (self.loadings * self.factor_variances) @ self.loadings.T + np.diag(self.specific_variances)
+
+
+# Sample covariance (ddof=1), the same estimator as DataFrame.cov().
+def sample_covariance(returns: np.ndarray, dtype=np.float64) -> np.ndarray:
+    centered = returns - returns.mean(axis=0)
+    return (centered.T @ centered / (len(returns) - 1) * 252).astype(dtype, copy=False)
+
+
+# Ledoit-Wolf shrinkage of the sample covariance towards a scaled identity.
+# The optimal intensity is estimated from the data (Ledoit & Wolf, 2004).
+def ledoit_wolf_covariance(returns: np.ndarray, dtype=np.float64) -> np.ndarray:
+    n_days, n_assets = returns.shape
+    centered = returns - returns.mean(axis=0)
+    sample = centered.T @ centered / n_days
+    target_variance = np.trace(sample) / n_assets
+
+    sample_norm = np.sum(sample ** 2)
+    # Squared distance between the sample covariance and the shrinkage target
+    distance = (sample_norm - 2 * target_variance * np.trace(sample) + n_assets * target_variance ** 2) / n_assets
+    # Estimation error of the sample covariance: sum_t ||x_t x_t' - S||^2 / T^2
+    row_norms = np.sum(centered ** 2, axis=1)
+    error = (np.sum(row_norms ** 2) - n_days * sample_norm) / n_days ** 2 / n_assets
+    shrinkage = min(error, distance) / distance if distance > 0 else 1.0
+
+    shrunk = (1 - shrinkage) * sample
+    shrunk[np.diag_indices(n_assets)] += shrinkage * target_variance
+    return (shrunk * 252).astype(dtype, copy=False)
+
+
+# Exponentially weighted covariance; the most recent day has the largest weight.
+def ewma_covariance(returns: np.ndarray, halflife: float = 63, dtype=np.float64) -> np.ndarray:
+    decay = 0.5 ** (1 / halflife)
+    weights = decay ** np.arange(len(returns) - 1, -1, -1)
+    weights /= weights.sum()
+    centered = returns - weights @ returns
+    return ((centered * weights[:, None]).T @ centered * 252).astype(dtype, copy=False)
+
+
+# Statistical factor model: the top n_factors principal components carry the
+# common variance and each asset keeps its own residual variance.
+def factor_covariance(returns: np.ndarray, n_factors: int = 10, dtype=np.float64) -> FactorCovariance:
+    n_days, n_assets = returns.shape
+    n_factors = min(n_factors, n_assets, n_days - 1)
+    centered = returns - returns.mean(axis=0)
+    _, singular_values, components = np.linalg.svd(centered, full_matrices=False)
+
+    loadings = components[:n_factors].T
+    factor_variances = singular_values[:n_factors] ** 2 / (n_days - 1)
+    total_variances = np.sum(centered ** 2, axis=0) / (n_days - 1)
+    specific_variances = total_variances - (loadings ** 2) @ factor_variances
+    # Keep residual variances strictly positive so the matrix stays definite.
+    specific_variances = np.maximum(specific_variances, 1e-4 * total_variances)
+
+    return FactorCovariance(
+        loadings.astype(dtype),
+        (factor_variances * 252).astype(dtype),
+        (specific_variances * 252).astype(dtype)
+    )
+
+
+ESTIMATORS = {
+    'sample': sample_covariance,
+    'ledoit_wolf': ledoit_wolf_covariance,
+    'ewma': ewma_covariance,
+    'factor': factor_covariance,
+}
+
+
+# Estimate the annualized covariance of daily returns with the named estimator.
+def estimate_covariance(returns: np.ndarray, method: str = 'sample', dtype=np.float64, **options):
+    if method not in ESTIMATORS:
+        raise ValueError(f"Unknown covariance estimator: {method}. Choose from {', '.join(ESTIMATORS)}")
+    return ESTIMATORS[method](np.asarray(returns, dtype=np.float64), dtype=dtype, **options)
+
+
+# Dense ndarray form of any estimator output.
+def to_dense(cov) -> np.ndarray:
+    return cov.to_dense() if isinstance(cov, FactorCovariance) else np.asarray(cov)
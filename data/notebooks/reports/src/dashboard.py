@@ -1,16 +1,65 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from PIL import Image
-from visualization import Visualizer
 # Import the relevant modules
+# Streamlit re-runs this script on every interaction, so heavy modules (PIL,
+# matplotlib/seaborn through visualization, SQLAlchemy through db_setup) are
+# imported by the page or action that needs them.
 from data_pipeline import StockDataFetcher
 from analysis import PortfolioAnalyzer
 from portfolio_optimizer import PortfolioOptimizer
-from db_setup import save_performance_metrics, save_portfolio_allocations, insert_adjusted_prices, clear_db_tables
+from downsampling import downsample
 
 # --- Page config --- st.set_page_config(page_title="Portfolio Analyzer", layout="wide")
 
+# Points sent to the browser per line chart, shared by all tickers (at least
+# 100 and at most 1000 per ticker).
+CHART_POINTS = 100_000
+
+
+# Long-form (date, ticker, value) data for st.line_chart, downsampled with LTTB.
+def line_chart_data(frame: pd.DataFrame) -> pd.DataFrame:
+    points_per_ticker = min(1000, max(100, CHART_POINTS // max(1, frame.shape[1])))
+    return downsample(frame, points_per_ticker)
+
+
+# --- Cached computations ---
+# Streamlit hashes the price frame by content, so reruns, page switches and the
+# save action reuse results for the same data and parameters (bounded LRU).
+@st.cache_data(max_entries=32, show_spinner=False)
+def compute_metrics(price_data: pd.DataFrame, risk_free_rate: float = 0.03) -> dict:
+    analyzer = PortfolioAnalyzer(price_data, risk_free_rate)
+    return {
+        "all_metrics": analyzer.compute_all_metrics(), # one pass, reused when saving
+        "daily_returns": line_chart_data(analyzer.calculate_daily_returns()),
+        "cumulative_returns": line_chart_data(analyzer.calculate_cumulative_returns()),
+        "annualized_return": analyzer.calculate_annualized_return(),
+        "annualized_volatility": analyzer.calculate_annualized_volatility(),
+        "sharpe_ratio": analyzer.calculate_sharpe_ratio(),
+        "max_drawdown": analyzer.calculate_max_drawdown()
+    }
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def optimize_portfolio(price_data: pd.DataFrame, risk_free_rate: float = 0.03) -> dict:
+    optimizer = PortfolioOptimizer(PortfolioAnalyzer(price_data, risk_free_rate))
+    best_weights = optimizer.run_optimization()
+    expected_return, volatility, sharpe_ratio = optimizer.portfolio_performance(best_weights)
+    return {
+        "best_weights": best_weights,
+        "expected_return": expected_return,
+        "volatility": volatility,
+        "sharpe_ratio": sharpe_ratio,
+        "min_vol_weights": optimizer.min_volatility()
+    }
+
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def correlation_heatmap_figure(price_data: pd.DataFrame):
+    from visualization import Visualizer
+    return Visualizer(PortfolioAnalyzer(price_data)).correlation_heatmap()
+
+
 # --- Sidebar menu ---
 menu = ["Home", "Portfolio Metrics", "Portfolio Optimization"]
 page = st.sidebar.selectbox("Select Page", menu)
@@ -33,6 +82,7 @@ save_data_btn = st.sidebar.button("💾 Save to Database")
 
 # Clear button
 if st.sidebar.button("🗑 Clear Database"):
+    from db_setup import clear_db_tables
     cleared = clear_db_tables()
     if cleared:
         st.sidebar.success("✅ Database cleared!")
@@ -45,28 +95,48 @@ if save_data_btn:
     if price_data is None:
         st.sidebar.error("⚠️ No data available. Please fetch data first.")
     else:
-        # Save performance metrics
-        save_performance_metrics(price_data)
-
-        # Optimize portfolio and save allocations
-        analyzer = PortfolioAnalyzer(price_data)
-        optimizer = PortfolioOptimizer(analyzer)
-        best_weights = optimizer.run_optimization()
-        expected_return, volatility, sharpe_ratio = optimizer.portfolio_performance(best_weights)
-        min_vol_weights = optimizer.min_volatility()
-
-        save_portfolio_allocations(
-            weights=best_weights,
+        # Metrics and optimized portfolio (reusing the cached results)
+        metrics = compute_metrics(price_data)
+        optimization = optimize_portfolio(price_data)
+
+        # Queue metrics, allocations and adjusted close prices as one background job
+        from db_writer import get_writer
+        st.session_state.pop("save_status", None)
+        st.session_state["save_job"] = get_writer().submit_save(
             price_data=price_data,
-            optimized_sharpe=sharpe_ratio,
-            optimized_volatility=volatility,
-            min_volatility_weights=min_vol_weights
+            weights=optimization["best_weights"],
+            optimized_sharpe=optimization["sharpe_ratio"],
+            optimized_volatility=optimization["volatility"],
+            min_volatility_weights=optimization["min_vol_weights"],
+            metrics=metrics["all_metrics"]
         )
 
-        # Insert adjusted close prices
-        insert_adjusted_prices(price_data)
 
-        st.sidebar.success("✅ Data saved successfully!")
+# --- Background save status (polled without blocking the page) ---
+# The polling fragment is only rendered while a save is pending. When the job
+# finishes, its outcome is kept in session_state and the page reruns once
+# without the fragment, so nothing keeps rerunning afterwards.
+@st.fragment(run_every="1s")
+def poll_save_job():
+    save_job = st.session_state["save_job"]
+    if not save_job.done():
+        st.info("⏳ Saving to database...")
+        return
+    del st.session_state["save_job"]
+    if save_job.exception() is not None:
+        st.session_state["save_status"] = ("error", f"❌ Failed to save data: {save_job.exception()}")
+    else:
+        saved = save_job.result()
+        st.session_state["save_status"] = ("success", f"✅ Data saved successfully! ({saved['prices']} prices)")
+    st.rerun()
+
+
+with st.sidebar:
+    if "save_job" in st.session_state:
+        poll_save_job()
+    elif "save_status" in st.session_state:
+        level, message = st.session_state["save_status"]
+        getattr(st, level)(message)
 
 
 # --- Fetch data ---
@@ -87,6 +157,7 @@ if page == "Home":
         '<h1 style="text-align: center;color:#FF0000;">Portfolio Analyzer Dashboard</h1>',
         unsafe_allow_html=True
         )
+    from PIL import Image
     image = Image.open(r"C:\Users\campo\OneDrive\Desktop\Data Analysis\premium_photo-1663931932687-c4c2366a5c61.avif")
     st.image(image, use_container_width=True)
     st.write("Welcome! Use the sidebar to navigate between pages.")
@@ -94,29 +165,28 @@ if page == "Home":
 # --- Portfolio Metrics Page ---
 elif page == "Portfolio Metrics":
     if price_data is not None:
-        analyzer = PortfolioAnalyzer(price_data)
+        metrics = compute_metrics(price_data)
         st.subheader("Portfolio Metrics")
         st.write("Daily Returns:")
-        st.line_chart(analyzer.calculate_daily_returns())
+        st.line_chart(metrics["daily_returns"], x="date", y="value", color="ticker")
 
         st.write("Cumulative Returns:")
-        st.line_chart(analyzer.calculate_cumulative_returns())
+        st.line_chart(metrics["cumulative_returns"], x="date", y="value", color="ticker")
 
         st.write("Annualized Returns:")
-        st.bar_chart(analyzer.calculate_annualized_return().to_frame())
+        st.bar_chart(metrics["annualized_return"].to_frame())
 
         st.write("Annualized Volatility:")
-        st.bar_chart(analyzer.calculate_annualized_volatility().to_frame())
+        st.bar_chart(metrics["annualized_volatility"].to_frame())
 
         st.write("Sharpe Ratios:")
-        st.bar_chart(analyzer.calculate_sharpe_ratio().to_frame())
+        st.bar_chart(metrics["sharpe_ratio"].to_frame())
 
         st.write("Max Drawdown:")
-        st.dataframe(analyzer.calculate_max_drawdown().to_frame())
+        st.dataframe(metrics["max_drawdown"].to_frame())
 
         # Correlation Heatmap
-        visualizer = Visualizer(analyzer)
-        fig = visualizer.correlation_heatmap()
+        fig = correlation_heatmap_figure(price_data)
         st.pyplot(fig)
 
     else:
@@ -127,10 +197,11 @@ elif page == "Portfolio Metrics":
 # --- Portfolio Optimization Page ---
 elif page == "Portfolio Optimization":
     if price_data is not None:
-        analyzer = PortfolioAnalyzer(price_data)
-        optimizer = PortfolioOptimizer(analyzer)
-        best_weights = optimizer.run_optimization()
-        expected_return, volatility, sharpe_ratio = optimizer.portfolio_performance(best_weights)
+        optimization = optimize_portfolio(price_data)
+        best_weights = optimization["best_weights"]
+        expected_return = optimization["expected_return"]
+        volatility = optimization["volatility"]
+        sharpe_ratio = optimization["sharpe_ratio"]
         st.subheader("Optimized Portfolio Weights")
         weights_df = pd.DataFrame({
             "Ticker": tickers,
@@ -1,38 +1,134 @@
-''' This program allows the user to fetch stock data from Yahoo Finance,
-saves the data into a CSV file, and load the data from the CSV file.'''
+''' This program allows the user to fetch stock data from Yahoo Finance (or another data source),
+saves the data into a CSV or binary file, and load the data back from it.'''
 
-import yfinance as yf
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from typing import List
+from typing import List, Optional
+from data_sources import DataSource, TokenBucket, YahooFinanceSource
+from price_cache import PriceCache
+from price_store import load_price_matrix, save_price_matrix
+from instrumentation import span
 
 class StockDataFetcher:
-    def __init__(self, tickers: List[str],start_date: str, end_date: str):
+    # Tickers reported in failed_tickers with this reason simply had no prices in
+    # the requested range; any other reason is the error of their last attempt.
+    NO_DATA = 'no data'
+
+    def __init__(self, tickers: List[str],start_date: str, end_date: str, cache: Optional[PriceCache] = None,
+                 source: Optional[DataSource] = None, shard_size: int = 50, max_workers: int = 4,
+                 max_retries: int = 3, backoff: float = 1.0, requests_per_second: Optional[float] = None):
         self.tickers = [t.upper() for t in tickers]
         self.start_date = start_date
         self.end_date = end_date
+        self.cache = cache # optional on-disk cache, only missing ranges are downloaded
+        self.source = source if source is not None else YahooFinanceSource()
+        self.shard_size = shard_size # tickers per request
+        self.max_workers = max_workers # concurrent requests
+        self.max_retries = max_retries
+        self.backoff = backoff # seconds before the first retry, doubled on each retry
+        self.rate_limiter = TokenBucket(requests_per_second) if requests_per_second else None
+        self.failed_tickers = {}
         self.data = None
 
     def fetch_data(self) -> pd.DataFrame:
+        self.failed_tickers = {}
+        with span('fetch_data', tickers=len(self.tickers)) as stage:
+            try:
+                if self.cache is None:
+                    adj_close = self._download(self.tickers, self.start_date, self.end_date)
+                else:
+                    adj_close = self._fetch_with_cache()
+
+                self.data = self._drop_failed(adj_close).dropna(how='all') #drop missing values
+            except Exception as e:
+                print(f"Failed to fetch data {e}")
+                self.data = pd.DataFrame()
+            stage.rows = self.data.size # date x ticker cells
+            stage.set(failed_tickers=len(self.failed_tickers))
+
+        if self.failed_tickers:
+            print(f"Could not fetch {len(self.failed_tickers)} ticker(s): "
+                  + ", ".join(f"{t} ({reason})" for t, reason in self.failed_tickers.items()))
+        return self.data
+
+    # Remove the columns of tickers that ended up without a single price, cached
+    # or downloaded (recorded as NO_DATA unless a download error explains it), so
+    # one bad symbol does not leave an all-NaN column that empties the returns of
+    # the whole frame. Tickers that still have prices are kept and not reported
+    # as failed, e.g. when only the download of a cache gap failed.
+    def _drop_failed(self, adj_close: pd.DataFrame) -> pd.DataFrame:
+        empty = adj_close.columns[adj_close.isna().all()]
+        for ticker in empty:
+            self.failed_tickers.setdefault(ticker, self.NO_DATA)
+        for ticker in adj_close.columns.difference(empty).intersection(list(self.failed_tickers)):
+            print(f"Using cached prices only for {ticker} ({self.failed_tickers.pop(ticker)})")
+        return adj_close.drop(columns=empty)
+
+    # Download only the ranges the cache is missing, then assemble the frame from the cache.
+    def _fetch_with_cache(self) -> pd.DataFrame:
+        # Group tickers sharing the same missing range so each gap is one download.
+        gaps = {}
+        for ticker in self.tickers:
+            for date_range in self.cache.missing_ranges(ticker, self.start_date, self.end_date):
+                gaps.setdefault(date_range, []).append(ticker)
+
         try:
-            df = yf.download(
-                self.tickers,
-                start=self.start_date,
-                end=self.end_date,
-                auto_adjust=False,
-                progress=False
-            )
-            if isinstance(df.columns,pd.MultiIndex):
-                # Select only the 'Adj Close' level
-                adj_close = df['Adj Close']
-            else:
-                # Single ticker case.
-                adj_close = df[['Adj Close']] if 'Adj Close' in df.columns else df[['Close']]
-
-            self.data = adj_close.dropna(how='all') #drop missing values
-            return self.data
-        except Exception as e:
-            print(f"Failed to fetch data {e}")
-            return pd.DataFrame()
+            for (start, end), tickers in gaps.items():
+                # A gap without trading days (weekend, holiday, future end date)
+                # legitimately comes back without columns: not a failure.
+                downloaded = self._download(tickers, start, end, record_missing=False)
+                for ticker in tickers:
+                    # Only remember coverage when the request itself succeeded.
+                    if ticker in self.failed_tickers:
+                        continue
+                    prices = downloaded[ticker] if ticker in downloaded.columns else pd.Series(dtype=float)
+                    self.cache.store(ticker, prices, start, end)
+
+            start, end = pd.Timestamp(self.start_date), pd.Timestamp(self.end_date)
+            return pd.concat({t: self.cache.load(t, start, end) for t in self.tickers}, axis=1).sort_index()
+        finally:
+            # One manifest write per fetch, including the coverage stored before a failure.
+            self.cache.flush()
+
+    # Download adjusted close prices for [start, end) as a date x ticker frame.
+    # Tickers are split into shards fetched on a bounded thread pool; successful
+    # shards are merged and the tickers of failed shards go to failed_tickers
+    # (as do tickers without data, as NO_DATA, unless record_missing is False).
+    def _download(self, tickers: List[str], start, end, record_missing: bool = True) -> pd.DataFrame:
+        shards = [tickers[i:i + self.shard_size] for i in range(0, len(tickers), self.shard_size)]
+        if len(shards) == 1:
+            results = [self._download_shard(shards[0], start, end)]
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                results = list(pool.map(lambda shard: self._download_shard(shard, start, end), shards))
+
+        frames = []
+        for shard, (frame, error) in zip(shards, results):
+            if error is not None:
+                self.failed_tickers.update({ticker: error for ticker in shard})
+                continue
+            frames.append(frame)
+            for ticker in shard:
+                if record_missing and ticker not in frame.columns:
+                    self.failed_tickers.setdefault(ticker, self.NO_DATA)
+
+        if not frames:
+            return pd.DataFrame(columns=tickers, dtype=float)
+        return pd.concat(frames, axis=1).reindex(columns=tickers)
+
+    # Fetch one shard, retrying with exponential backoff. Returns (frame, error).
+    def _download_shard(self, shard: List[str], start, end):
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                return self.source.download(shard, start, end), None
+            except Exception as e:
+                if attempt == self.max_retries:
+                    return None, str(e) or type(e).__name__
+                time.sleep(self.backoff * 2 ** attempt)
 
     # Create a function to save the data into csv.
     def save_to_csv(self, path):
@@ -48,4 +144,95 @@ class StockDataFetcher:
             return self.data
         except FileNotFoundError:
             print(f'File not found: {path}')
-            return pd.DataFrame()
\ No newline at end of file
+            return pd.DataFrame()
+
+    # Create a function to save the data into the binary (memory-mappable) format.
+    def save_to_npy(self, path, dtype=np.float64):
+        if self.data is not None:
+            save_price_matrix(self.data, path, dtype)
+        else:
+            print('No data to save.')
+
+    # Create a function to load the data from the binary format, optionally only
+    # some tickers and a date range, without reading the rest of the file.
+    def load_from_npy(self, path, tickers: List[str] = None, start=None, end=None):
+        try:
+            self.data = load_price_matrix(path, tickers, start, end)
+            return self.data
+        except FileNotFoundError:
+            print(f'File not found: {path}')
+            return pd.DataFrame()
+
+    # Create a function to load adjusted close prices from the database.
+    # Rows are streamed with a server-side cursor in chunks of chunk_size and each
+    # chunk is pivoted straight into the wide (date x ticker) layout, so the long
+    # table is never held in memory. With fill_gaps=True, tickers or date ranges
+    # missing from the database are downloaded (see _missing_ranges).
+    def load_from_db(self, tickers: List[str] = None, start=None, end=None,
+                     chunk_size: int = 50_000, fill_gaps: bool = False) -> pd.DataFrame:
+        self.failed_tickers = {}
+        tickers = [t.upper() for t in tickers] if tickers is not None else self.tickers
+        start = pd.Timestamp(start if start is not None else self.start_date)
+        end = pd.Timestamp(end if end is not None else self.end_date)
+
+        from sqlalchemy import bindparam, text # deferred: only database loads need SQLAlchemy
+        from database import get_engine
+        query = text("""
+        SELECT date, ticker, adj_close FROM adjusted_prices
+        WHERE ticker IN :tickers AND date >= :start AND date < :end
+        ORDER BY date, ticker
+        """).bindparams(bindparam('tickers', expanding=True))
+        params = {'tickers': tickers, 'start': start.date(), 'end': end.date()}
+
+        pieces = []
+        with get_engine().connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(query, params)
+            for rows in result.partitions():
+                chunk = pd.DataFrame(rows, columns=['date', 'ticker', 'adj_close'])
+                chunk['adj_close'] = chunk['adj_close'].astype(float)
+                pieces.append(chunk.pivot(index='date', columns='ticker', values='adj_close'))
+
+        if pieces:
+            # A date split across two chunks shows up in both pivots with different tickers.
+            prices = pd.concat(pieces).groupby(level=0).first()
+            prices.index = pd.to_datetime(prices.index)
+        else:
+            prices = pd.DataFrame(dtype=float)
+        prices = prices.reindex(columns=tickers)
+
+        if fill_gaps:
+            prices = self._fill_gaps_from_source(prices, tickers, start, end)
+
+        self.data = prices.dropna(how='all')
+        return self.data
+
+    # Download the date ranges each ticker is missing in [start, end).
+    def _fill_gaps_from_source(self, prices: pd.DataFrame, tickers: List[str], start, end) -> pd.DataFrame:
+        gaps = {}
+        for ticker in tickers:
+            for gap_start, gap_end in self._missing_ranges(prices[ticker], start, end):
+                gaps.setdefault((gap_start, gap_end), []).append(ticker)
+
+        for (gap_start, gap_end), gap_tickers in gaps.items():
+            downloaded = self._download(gap_tickers, gap_start, gap_end)
+            prices = prices.combine_first(downloaded[downloaded.columns.intersection(gap_tickers)])
+        return prices.reindex(columns=tickers).sort_index()
+
+    # Date ranges [gap_start, gap_end) one ticker's prices are missing in
+    # [start, end): before its first price, after its last, and interior holes,
+    # i.e. dates other tickers have prices on but this one does not (each hole
+    # runs up to the ticker's next price). Edge ranges without a business day
+    # (weekends, the end bound itself) are skipped.
+    @staticmethod
+    def _missing_ranges(prices: pd.Series, start, end) -> list:
+        available = prices.dropna().index
+        if available.empty:
+            ranges = [(start, end)]
+        else:
+            ranges = [(start, available[0]), (available[-1] + pd.Timedelta(days=1), end)]
+            holes = prices.index[prices.isna() & (prices.index > available[0]) & (prices.index < available[-1])]
+            next_prices = available[available.searchsorted(holes)]
+            for next_price in next_prices.unique():
+                ranges.append((holes[next_prices == next_price][0], next_price))
+        return [(gap_start, gap_end) for gap_start, gap_end in ranges
+                if len(pd.bdate_range(gap_start, gap_end - pd.Timedelta(days=1))) > 0]
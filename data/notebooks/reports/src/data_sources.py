@@ -0,0 +1,138 @@
+''' Data sources used by StockDataFetcher. A data source downloads adjusted close
+prices for a list of tickers over [start, end) and returns them as a wide
+date x ticker frame. Tickers it has no data for are simply left out.'''
+
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List
+
+import pandas as pd
+
+
+class DataSource(ABC):
+    @abstractmethod
+    def download(self, tickers: List[str], start, end) -> pd.DataFrame:
+        ...
+
+
+# Raised by a data source when some tickers of a request failed for a reason
+# worth retrying (rate limits, timeouts, server errors). The fetcher retries the
+# whole request and reports these tickers as failed if it never succeeds.
+class DownloadError(Exception):
+    def __init__(self, errors: dict):
+        self.errors = errors # ticker -> error message
+        super().__init__("; ".join(f"{ticker}: {error}" for ticker, error in errors.items()))
+
+
+# yfinance before 1.0 collects the results of yf.download in module-global state
+# (shared._DFS and shared._ERRORS) that every call resets, so concurrent calls
+# from the fetcher's shard threads mix up or lose each other's columns and
+# errors. With those versions calls are serialized (yf.download still fetches
+# the tickers of one shard in parallel) and the fetcher's thread pool does not
+# speed up Yahoo downloads. yfinance 1.0 and later keep this state per call, and
+# shards download concurrently.
+_yahoo_lock = threading.Lock()
+
+# Per-ticker errors yfinance reports for a range without prices (delisted or
+# unknown symbols, weekends and holidays). Those are answers, not failures, and
+# are not retried.
+_NO_DATA_ERRORS = ('no price data found', 'no data found', 'delisted', 'no timezone found')
+
+
+# Run yf.download and return (frame, {ticker: error}) without sharing state
+# with concurrent calls.
+def _yahoo_download(yf, tickers: List[str], **kwargs):
+    context_class = getattr(yf.multi, '_DownloadCtx', None)
+    if context_class is not None: # yfinance >= 1.0: per-call context
+        context = context_class()
+        return yf.multi._download_impl(context, tickers, **kwargs), dict(context.errors)
+    with _yahoo_lock:
+        df = yf.download(tickers, **kwargs)
+        return df, dict(yf.shared._ERRORS)
+
+
+# Yahoo Finance through yfinance (the default source). yf.download does not
+# raise when single tickers fail; it logs them and leaves them out, so their
+# errors are read back and the retryable ones raised as a DownloadError.
+class YahooFinanceSource(DataSource):
+    def download(self, tickers: List[str], start, end) -> pd.DataFrame:
+        import yfinance as yf # slow to import, so only loaded when actually used
+        df, errors = _yahoo_download(
+            yf,
+            tickers,
+            start=start,
+            end=end,
+            auto_adjust=False,
+            progress=False
+        )
+        retryable = {ticker: str(error) for ticker, error in errors.items()
+                     if not any(reason in str(error).lower() for reason in _NO_DATA_ERRORS)}
+        if retryable:
+            raise DownloadError(retryable)
+        if df is None or df.empty:
+            return pd.DataFrame(dtype=float)
+        if isinstance(df.columns,pd.MultiIndex):
+            # Select only the 'Adj Close' level
+            adj_close = df['Adj Close']
+        else:
+            # Single ticker case.
+            adj_close = df[['Adj Close']] if 'Adj Close' in df.columns else df[['Close']]
+            adj_close = adj_close.set_axis(tickers[:1], axis=1)
+        # yfinance keeps failed tickers as all-NaN columns
+        return adj_close.dropna(axis=1, how='all')
+
+
+# Local stand-in that reads <directory>/<TICKER>.csv files (date index, one price
+# column). latency adds a fixed delay per request to mimic a remote service in
+# offline throughput tests.
+class CsvDirectorySource(DataSource):
+    def __init__(self, directory: str, latency: float = 0.0):
+        self.directory = directory
+        self.latency = latency
+
+    def download(self, tickers: List[str], start, end) -> pd.DataFrame:
+        if self.latency:
+            time.sleep(self.latency)
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        columns = {}
+        for ticker in tickers:
+            path = os.path.join(self.directory, f'{ticker}.csv')
+            if not os.path.exists(path):
+                continue
+            prices = pd.read_csv(path, index_col=0, parse_dates=True).iloc[:, 0]
+            prices = prices[(prices.index >= start) & (prices.index < end)]
+            if len(prices):
+                columns[ticker] = prices
+        return pd.concat(columns, axis=1) if columns else pd.DataFrame(dtype=float)
+
+    # Write a wide price frame as one CSV per ticker, e.g. to seed offline tests.
+    @staticmethod
+    def write(price_data: pd.DataFrame, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for ticker in price_data.columns:
+            price_data[[ticker]].dropna().to_csv(os.path.join(directory, f'{ticker}.csv'))
+
+
+# Token bucket rate limiter shared by the fetcher's worker threads: requests
+# spend one token each and tokens refill at `rate` per second up to `capacity`.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
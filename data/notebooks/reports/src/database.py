@@ -1,17 +1,53 @@
 # Here I will have the logic to create a database, connect to database
 
-from sqlalchemy import create_engine
+import os
+import threading
 
+# One engine (and connection pool) per process, created on first use. The lock
+# keeps threads that ask for it at the same time (dashboard sessions, the
+# background writer) from creating two engines and two pools.
+_engine = None
+_engine_lock = threading.Lock()
 
-# Create a database connection with PostgreSQL
-def get_engine():
+
+# Database URL: DATABASE_URL overrides the local PostgreSQL default, e.g.
+# DATABASE_URL=sqlite:///portfolio.db to run the write path offline.
+def get_database_url() -> str:
     # Create connection to PostgreSQL
     username = 'postgres'
     password = 'Campospa'
     host = 'localhost'
     port = '5433'
     database = 'portfolio_db'  # Create database manually in postgres
+    default_url = f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{database}"
+    return os.environ.get('DATABASE_URL', default_url)
+
+
+# Create a database connection with PostgreSQL
+# Pool settings can be tuned with DB_POOL_SIZE, DB_MAX_OVERFLOW and DB_POOL_RECYCLE (seconds).
+def get_engine():
+    global _engine
+    if _engine is not None:
+        return _engine
+    with _engine_lock:
+        if _engine is None:
+            from sqlalchemy import create_engine
+            url = get_database_url()
+            options = {
+                'pool_pre_ping': True, # drop dead connections before handing them out
+                'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            }
+            if not url.startswith('sqlite'):
+                options['pool_size'] = int(os.environ.get('DB_POOL_SIZE', 5))
+                options['max_overflow'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+            _engine = create_engine(url, **options)
+        return _engine
+
 
-    # Create database engine.
-    engine = create_engine(f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{database}")
-    return engine
+# Close all pooled connections and forget the engine (the next call creates a new one).
+def dispose_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
@@ -1,19 +1,34 @@
 # Here I will create the necessary database tables
 
-from sqlalchemy import text
+from contextlib import contextmanager
+from sqlalchemy import bindparam, inspect, text
 from database import get_engine
 from analysis import PortfolioAnalyzer
 from portfolio_optimizer import PortfolioOptimizer
+from instrumentation import traced
+from prefix_stats import PrefixStats, check_window, covariance_from_totals, metrics_from_totals
+import io
+import time
+import numpy as np
 import pandas as pd
 from datetime import date as dt_date
 
-# Connect to the database:
-engine = get_engine()
-
 # Define SQL statements.
+# Metrics and allocations are unique per (portfolio, ticker, date) so re-saves
+# upsert; single-portfolio callers write to the 'default' portfolio.
+# adjusted_prices is keyed on (ticker, date), range-partitioned by date (one
+# partition per year, created on demand) and has a covering index for
+# per-ticker time-range reads.
+# return_prefix_stats and return_prefix_cross_products persist the prefix-sum
+# index of prefix_stats.py: running totals per (ticker, date) and per
+# (ticker_a, ticker_b, date) with ticker_a < ticker_b. They are kept in double
+# precision because range metrics subtract two totals. observations counts the
+# ticker's returns up to and including each date (0 on its first price), and
+# the date indexes let a range query read just its two boundary dates.
 create_tables_sql = """
 CREATE TABLE IF NOT EXISTS portfolio_metrics (
     id SERIAL PRIMARY KEY,
+    portfolio VARCHAR NOT NULL DEFAULT 'default',
     ticker VARCHAR,
     date DATE,
     cumulative_return NUMERIC,
@@ -23,8 +38,12 @@ CREATE TABLE IF NOT EXISTS portfolio_metrics (
     max_drawdown NUMERIC
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS portfolio_metrics_portfolio_ticker_date_key
+    ON portfolio_metrics (portfolio, ticker, date);
+
 CREATE TABLE IF NOT EXISTS portfolio_allocations (
     id SERIAL PRIMARY KEY,
+    portfolio VARCHAR NOT NULL DEFAULT 'default',
     date DATE,
     ticker VARCHAR,
     weight NUMERIC,
@@ -33,64 +52,286 @@ CREATE TABLE IF NOT EXISTS portfolio_allocations (
     minimum_volatility_portfolio NUMERIC
 ); 
 
+CREATE UNIQUE INDEX IF NOT EXISTS portfolio_allocations_portfolio_date_ticker_key
+    ON portfolio_allocations (portfolio, date, ticker);
+
 CREATE TABLE IF NOT EXISTS adjusted_prices (
-    id SERIAL,
+    ticker VARCHAR NOT NULL,
+    date DATE NOT NULL,
+    adj_close NUMERIC,
+    PRIMARY KEY (ticker, date)
+) PARTITION BY RANGE (date);
+
+CREATE TABLE IF NOT EXISTS adjusted_prices_default PARTITION OF adjusted_prices DEFAULT;
+
+CREATE INDEX IF NOT EXISTS adjusted_prices_ticker_date_covering_idx
+    ON adjusted_prices (ticker, date) INCLUDE (adj_close);
+
+CREATE TABLE IF NOT EXISTS return_prefix_stats (
+    ticker VARCHAR NOT NULL,
+    date DATE NOT NULL,
+    sum_returns DOUBLE PRECISION,
+    sum_squares DOUBLE PRECISION,
+    sum_log_growth DOUBLE PRECISION,
+    observations INTEGER NOT NULL,
+    PRIMARY KEY (ticker, date)
+);
+
+CREATE INDEX IF NOT EXISTS return_prefix_stats_date_idx ON return_prefix_stats (date);
+
+CREATE TABLE IF NOT EXISTS return_prefix_cross_products (
+    ticker_a VARCHAR NOT NULL,
+    ticker_b VARCHAR NOT NULL,
+    date DATE NOT NULL,
+    sum_products DOUBLE PRECISION,
+    PRIMARY KEY (ticker_a, ticker_b, date)
+);
+
+CREATE INDEX IF NOT EXISTS return_prefix_cross_products_date_idx ON return_prefix_cross_products (date);
+"""
+
+# SQLite stand-in: no SERIAL or partitioning; the WITHOUT ROWID primary key
+# already stores rows in (ticker, date) order, so no extra index is needed.
+create_tables_sqlite_sql = """
+CREATE TABLE IF NOT EXISTS portfolio_metrics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    portfolio VARCHAR NOT NULL DEFAULT 'default',
     ticker VARCHAR,
     date DATE,
-    adj_close NUMERIC
+    cumulative_return NUMERIC,
+    annualized_return NUMERIC,
+    annualized_volatility NUMERIC,
+    sharpe_ratio NUMERIC,
+    max_drawdown NUMERIC
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS portfolio_metrics_portfolio_ticker_date_key
+    ON portfolio_metrics (portfolio, ticker, date);
+
+CREATE TABLE IF NOT EXISTS portfolio_allocations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    portfolio VARCHAR NOT NULL DEFAULT 'default',
+    date DATE,
+    ticker VARCHAR,
+    weight NUMERIC,
+    optimized_sharpe_ratio NUMERIC,
+    optimized_volatility NUMERIC,
+    minimum_volatility_portfolio NUMERIC
 );
+
+CREATE UNIQUE INDEX IF NOT EXISTS portfolio_allocations_portfolio_date_ticker_key
+    ON portfolio_allocations (portfolio, date, ticker);
+
+CREATE TABLE IF NOT EXISTS adjusted_prices (
+    ticker VARCHAR NOT NULL,
+    date DATE NOT NULL,
+    adj_close NUMERIC,
+    PRIMARY KEY (ticker, date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS return_prefix_stats (
+    ticker VARCHAR NOT NULL,
+    date DATE NOT NULL,
+    sum_returns DOUBLE PRECISION,
+    sum_squares DOUBLE PRECISION,
+    sum_log_growth DOUBLE PRECISION,
+    observations INTEGER NOT NULL,
+    PRIMARY KEY (ticker, date)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS return_prefix_stats_date_idx ON return_prefix_stats (date);
+
+CREATE TABLE IF NOT EXISTS return_prefix_cross_products (
+    ticker_a VARCHAR NOT NULL,
+    ticker_b VARCHAR NOT NULL,
+    date DATE NOT NULL,
+    sum_products DOUBLE PRECISION,
+    PRIMARY KEY (ticker_a, ticker_b, date)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS return_prefix_cross_products_date_idx ON return_prefix_cross_products (date);
+"""
+
+upsert_metrics_sql = """
+INSERT INTO portfolio_metrics 
+(portfolio, date, ticker, cumulative_return, annualized_return, annualized_volatility, 
+sharpe_ratio, max_drawdown)
+VALUES (:portfolio, :date, :ticker, :cumulative_return, :annualized_return, 
+:annualized_volatility, :sharpe_ratio, :max_drawdown)
+ON CONFLICT (portfolio, ticker, date) DO UPDATE SET
+    cumulative_return = EXCLUDED.cumulative_return,
+    annualized_return = EXCLUDED.annualized_return,
+    annualized_volatility = EXCLUDED.annualized_volatility,
+    sharpe_ratio = EXCLUDED.sharpe_ratio,
+    max_drawdown = EXCLUDED.max_drawdown
+"""
+
+upsert_allocations_sql = """
+INSERT INTO portfolio_allocations
+(portfolio, date, ticker, weight, optimized_sharpe_ratio, 
+optimized_volatility, minimum_volatility_portfolio)
+VALUES (:portfolio, :date, :ticker, :weight, :optimized_sharpe_ratio, 
+:optimized_volatility, :minimum_volatility_portfolio)
+ON CONFLICT (portfolio, date, ticker) DO UPDATE SET
+    weight = EXCLUDED.weight,
+    optimized_sharpe_ratio = EXCLUDED.optimized_sharpe_ratio,
+    optimized_volatility = EXCLUDED.optimized_volatility,
+    minimum_volatility_portfolio = EXCLUDED.minimum_volatility_portfolio
 """
 
+# Unchanged prices are skipped, so a re-save only writes the rows that differ.
+upsert_prices_sql = """
+INSERT INTO adjusted_prices (date, ticker, adj_close)
+{source}
+ON CONFLICT (ticker, date) DO UPDATE SET adj_close = EXCLUDED.adj_close
+WHERE adjusted_prices.adj_close <> EXCLUDED.adj_close
+"""
+
+upsert_prefix_stats_sql = """
+INSERT INTO return_prefix_stats (ticker, date, sum_returns, sum_squares, sum_log_growth, observations)
+{source}
+ON CONFLICT (ticker, date) DO UPDATE SET
+    sum_returns = EXCLUDED.sum_returns,
+    sum_squares = EXCLUDED.sum_squares,
+    sum_log_growth = EXCLUDED.sum_log_growth,
+    observations = EXCLUDED.observations
+"""
+
+upsert_prefix_cross_products_sql = """
+INSERT INTO return_prefix_cross_products (ticker_a, ticker_b, date, sum_products)
+{source}
+ON CONFLICT (ticker_a, ticker_b, date) DO UPDATE SET sum_products = EXCLUDED.sum_products
+"""
+
+# Run a block in the given connection, or in a new transaction on the
+# process-wide engine when conn is None (committed when the block exits).
+@contextmanager
+def _transaction(conn=None):
+    if conn is not None:
+        yield conn
+    else:
+        with get_engine().begin() as new_conn:
+            yield new_conn
+
+
+# Table definitions for the connected backend.
+def _schema_statements(dialect_name: str):
+    schema_sql = create_tables_sqlite_sql if dialect_name == 'sqlite' else create_tables_sql
+    return [statement for statement in schema_sql.split(';') if statement.strip()]
+
+
 # Create a function to create the tables.
 def create_tables():
     try:
-        with engine.begin() as conn:
-            conn.execute(text(create_tables_sql))
+        with get_engine().begin() as conn:
+            migrate_schema(conn)
+            for statement in _schema_statements(conn.dialect.name):
+                conn.execute(text(statement))
             print("All tables created successfully.")
     except Exception as e:
         print("Failed to create tables:", e)
         exit()
 
-# Create a function to save the relevant performance metrics
-def save_performance_metrics(price_data):
-    # Initialize analyzer.
-    analyzer = PortfolioAnalyzer(price_data)
-    today = pd.Timestamp.today().date()
-    metrics_list = []
-    for ticker in price_data.columns:
-        metrics = {
-            "date": today,
-            "ticker": ticker,
-            "cumulative_return": float(analyzer.calculate_cumulative_returns()[ticker].iloc[-1]),
-            "annualized_volatility": float(analyzer.calculate_annualized_volatility()[ticker]),
-            "annualized_return": float(analyzer.calculate_annualized_return()[ticker]),
-            "sharpe_ratio": float(analyzer.calculate_sharpe_ratio()[ticker]),
-            "max_drawdown": float(analyzer.calculate_max_drawdown()[ticker])
-        }
 
-        metrics_list.append(metrics)
+# Bring tables created by earlier versions up to the keyed schema:
+# - metrics/allocations get the portfolio column (existing rows belong to the
+#   'default' portfolio) and the (ticker, date) keys are replaced by keys that
+#   include the portfolio;
+# - duplicate metrics/allocations rows are removed (the newest id wins) so the
+#   unique indexes can be built;
+# - the unkeyed adjusted_prices table (it had an id column) is rebuilt with
+#   the (ticker, date) key, keeping the newest price per key;
+# - prefix-sum tables of earlier layouts (no observations column, or no zero
+#   row on the first price date because incomplete dates were dropped) are
+#   dropped; the next update_prefix_stats rebuilds them from adjusted_prices.
+def migrate_schema(conn):
+    inspector = inspect(conn)
+    existing_tables = inspector.get_table_names()
 
-     # Insert performance metrics data into the database
-    # Use .begin() instead of .connect() to allow for automatic commit
-    with engine.begin() as conn:
-        for row in metrics_list:
-            conn.execute(text("""
-            INSERT INTO portfolio_metrics 
-            (date, ticker, cumulative_return, annualized_return, annualized_volatility, 
-            sharpe_ratio, max_drawdown)
-            VALUES (:date, :ticker, :cumulative_return, :annualized_return, 
-            :annualized_volatility, :sharpe_ratio, :max_drawdown)
-            """), row)
+    if "return_prefix_stats" in existing_tables and _outdated_prefix_stats(conn, inspector):
+        print("Dropping the prefix-sum index for a rebuild...")
+        conn.execute(text("DROP TABLE return_prefix_stats"))
+        conn.execute(text("DROP TABLE IF EXISTS return_prefix_cross_products"))
 
-    return metrics_list
+    for table, key, index, old_index in (
+            ("portfolio_metrics", "portfolio, ticker, date", "portfolio_metrics_portfolio_ticker_date_key",
+             "portfolio_metrics_ticker_date_key"),
+            ("portfolio_allocations", "portfolio, date, ticker", "portfolio_allocations_portfolio_date_ticker_key",
+             "portfolio_allocations_date_ticker_key")):
+        if table not in existing_tables:
+            continue
+        indexes = {i['name'] for i in inspector.get_indexes(table)}
+        if "portfolio" not in {column['name'] for column in inspector.get_columns(table)}:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN portfolio VARCHAR NOT NULL DEFAULT 'default'"))
+        if old_index in indexes:
+            conn.execute(text(f"DROP INDEX {old_index}"))
+        if index not in indexes:
+            conn.execute(text(f"DELETE FROM {table} WHERE id NOT IN "
+                              f"(SELECT MAX(id) FROM {table} GROUP BY {key})"))
 
+    if "adjusted_prices" not in existing_tables:
+        return
+    if "id" not in {column['name'] for column in inspector.get_columns("adjusted_prices")}:
+        return
 
-# Create a function to save portfolio allocations (weights) and optimized metrics
-def save_portfolio_allocations(weights, price_data, optimized_sharpe, optimized_volatility, min_volatility_weights):
+    print("Migrating adjusted_prices to the keyed schema...")
+    conn.execute(text("ALTER TABLE adjusted_prices RENAME TO adjusted_prices_legacy"))
+    for statement in _schema_statements(conn.dialect.name):
+        if "adjusted_prices" in statement:
+            conn.execute(text(statement))
+    if conn.dialect.name == 'postgresql':
+        years = conn.execute(text("SELECT DISTINCT EXTRACT(YEAR FROM date)::int FROM adjusted_prices_legacy "
+                                  "WHERE date IS NOT NULL")).scalars().all()
+        _ensure_price_partitions(conn, years)
+    # Latest row per (ticker, date) wins; DO NOTHING keeps the first one inserted.
+    conn.execute(text("""
+    INSERT INTO adjusted_prices (ticker, date, adj_close)
+    SELECT ticker, date, adj_close FROM adjusted_prices_legacy
+    WHERE ticker IS NOT NULL AND date IS NOT NULL
+    ORDER BY id DESC
+    ON CONFLICT (ticker, date) DO NOTHING
+    """))
+    conn.execute(text("DROP TABLE adjusted_prices_legacy"))
+
+
+def _outdated_prefix_stats(conn, inspector) -> bool:
+    if "observations" not in {column['name'] for column in inspector.get_columns("return_prefix_stats")}:
+        return True
+    first_count = conn.execute(text("SELECT MIN(observations) FROM return_prefix_stats "
+                                    "WHERE date = (SELECT MIN(date) FROM return_prefix_stats)")).scalar()
+    return first_count is not None and first_count > 0
+
+
+# Create the yearly adjusted_prices partitions that do not exist yet (PostgreSQL only).
+def _ensure_price_partitions(conn, years):
+    if conn.dialect.name != 'postgresql':
+        return
+    for year in sorted(set(int(y) for y in years)):
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS adjusted_prices_{year} PARTITION OF adjusted_prices "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        ))
+
+
+# Rows for portfolio_metrics from a compute_all_metrics() frame.
+def metrics_records(metrics: pd.DataFrame, portfolio: str = 'default') -> list:
+    today = pd.Timestamp.today().date()
+    metrics = metrics.astype(float)
+    metrics.index.name = "ticker"
+    metrics = metrics.reset_index()
+    metrics.insert(0, "date", today)
+    metrics.insert(0, "portfolio", portfolio)
+    return metrics.to_dict('records')
+
+
+# Rows for portfolio_allocations, one per ticker.
+def allocation_records(tickers, weights, optimized_sharpe, optimized_volatility, min_volatility_weights,
+                       portfolio: str = 'default') -> list:
     today = pd.Timestamp.today().date()
     optimized_weights_metrics = []
-    for i, ticker, in enumerate(price_data.columns): # create a Tuple pairing tickers with weights
+    for i, ticker, in enumerate(tickers): # create a Tuple pairing tickers with weights
         optimized_weights_metrics.append({
+            "portfolio": portfolio,
             "date": today,
             "ticker": ticker,
             "weight": float(weights[i]),
@@ -98,40 +339,438 @@ def save_portfolio_allocations(weights, price_data, optimized_sharpe, optimized_
             "optimized_volatility": float(optimized_volatility),
             "minimum_volatility_portfolio": float(min_volatility_weights[i])
         })
+    return optimized_weights_metrics
 
-    # Insert allocations data into the database
-    with engine.begin() as conn:
-        for row in optimized_weights_metrics:
-            conn.execute(text("""
-            INSERT INTO portfolio_allocations
-            (date, ticker, weight, optimized_sharpe_ratio, 
-            optimized_volatility, minimum_volatility_portfolio)
-            VALUES (:date, :ticker, :weight, :optimized_sharpe_ratio, 
-            :optimized_volatility, :minimum_volatility_portfolio)"""), row)
 
+# Create a function to save the relevant performance metrics. metrics is a
+# compute_all_metrics() frame already computed for price_data, e.g. the one the
+# dashboard cached; it is computed here when not given.
+@traced('db.save_performance_metrics', rows=len)
+def save_performance_metrics(price_data, conn=None, portfolio: str = 'default', metrics: pd.DataFrame = None):
+    if metrics is None:
+        # Initialize analyzer and compute all metrics in a single pass.
+        metrics = PortfolioAnalyzer(price_data).compute_all_metrics()
+    metrics_list = metrics_records(metrics, portfolio)
+
+    # Upsert performance metrics data into the database in one batched statement
+    # Use .begin() instead of .connect() to allow for automatic commit
+    with _transaction(conn) as conn:
+        conn.execute(text(upsert_metrics_sql), metrics_list)
+
+    return metrics_list
+
+
+# Create a function to save portfolio allocations (weights) and optimized metrics
+@traced('db.save_portfolio_allocations', rows=len)
+def save_portfolio_allocations(weights, price_data, optimized_sharpe, optimized_volatility, min_volatility_weights,
+                               conn=None, portfolio: str = 'default'):
+    optimized_weights_metrics = allocation_records(price_data.columns, weights, optimized_sharpe,
+                                                   optimized_volatility, min_volatility_weights, portfolio)
+
+    # Upsert allocations data into the database in one batched statement
+    with _transaction(conn) as conn:
+        conn.execute(text(upsert_allocations_sql), optimized_weights_metrics)
 
     return optimized_weights_metrics
 
-# Create a function to insert adjusted close prices to the database
-def insert_adjusted_prices(df: pd.DataFrame):
+# Create a function to upsert adjusted close prices to the database.
+# The wide (date x ticker) frame is melted into long rows a slice at a time so
+# memory stays bounded by chunk_size, then streamed through COPY into a staging
+# table on PostgreSQL or sent as a batched executemany on other backends.
+# Saving the same prices twice leaves the table unchanged. Returns the number of
+# rows actually written (inserted or changed), as reported by the database.
+@traced('db.insert_adjusted_prices', rows=lambda written_rows: written_rows)
+def insert_adjusted_prices(df: pd.DataFrame, chunk_size: int = 50_000, conn=None) -> int:
     df = df.copy()
     df.index = pd.to_datetime(df.index)
+    df.index.name = 'date'
+    df.columns = [str(ticker) for ticker in df.columns]
+
+    # Number of dates per slice so that each melted chunk holds ~chunk_size rows
+    dates_per_chunk = max(1, chunk_size // max(1, len(df.columns)))
+
+    total_rows = written_rows = 0
+    start_time = time.perf_counter()
+    with _transaction(conn) as conn:
+        use_copy = conn.dialect.name == 'postgresql'
+        if use_copy:
+            _ensure_price_partitions(conn, df.index.year.unique())
+            conn.execute(text("""
+            CREATE TEMP TABLE IF NOT EXISTS adjusted_prices_staging
+            (date DATE, ticker VARCHAR, adj_close NUMERIC) ON COMMIT DROP
+            """))
+        for start in range(0, len(df), dates_per_chunk):
+            chunk = _melt_prices(df.iloc[start:start + dates_per_chunk])
+            if chunk.empty:
+                continue
+            if use_copy:
+                result = _copy_prices(conn, chunk)
+            else:
+                result = conn.execute(text(upsert_prices_sql.format(source="VALUES (:date, :ticker, :adj_close)")),
+                                      chunk.to_dict('records'))
+            total_rows += len(chunk)
+            written_rows += result.rowcount
+
+    elapsed = time.perf_counter() - start_time
+    rate = total_rows / elapsed if elapsed > 0 else float('inf')
+    print(f"Saved {written_rows} of {total_rows} adjusted prices ({total_rows - written_rows} unchanged) "
+          f"in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+    return written_rows
+
+
+# Turn a wide price frame into long (date, ticker, adj_close) rows without NaNs.
+def _melt_prices(df: pd.DataFrame) -> pd.DataFrame:
+    long_df = df.reset_index().melt(id_vars='date', var_name='ticker', value_name='adj_close')
+    long_df = long_df.dropna(subset=['adj_close']).drop_duplicates(['date', 'ticker'], keep='last')
+    long_df['date'] = long_df['date'].dt.date
+    long_df['adj_close'] = long_df['adj_close'].astype(float)
+    return long_df[['date', 'ticker', 'adj_close']]
+
+
+# Stream a chunk of long rows into the staging table with COPY FROM STDIN,
+# then merge it into adjusted_prices with one upsert. Returns the upsert result.
+def _copy_prices(conn, chunk: pd.DataFrame):
+    buffer = io.StringIO()
+    chunk.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY adjusted_prices_staging (date, ticker, adj_close) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    finally:
+        cursor.close()
+    result = conn.execute(text(upsert_prices_sql.format(
+        source="SELECT date, ticker, adj_close FROM adjusted_prices_staging WHERE true")))
+    conn.execute(text("TRUNCATE adjusted_prices_staging"))
+    return result
+
+
+# Save metrics, allocations and prices as one batched job in a single transaction.
+@traced('db.save_all', rows=lambda counts: sum(counts.values()))
+def save_all(price_data, weights, optimized_sharpe, optimized_volatility, min_volatility_weights,
+             metrics: pd.DataFrame = None):
+    with get_engine().begin() as conn:
+        metrics_list = save_performance_metrics(price_data, conn=conn, metrics=metrics)
+        allocations = save_portfolio_allocations(weights, price_data, optimized_sharpe, optimized_volatility,
+                                                 min_volatility_weights, conn=conn)
+        price_rows = insert_adjusted_prices(price_data, conn=conn)
+    return {"metrics": len(metrics_list), "allocations": len(allocations), "prices": price_rows}
+
+# Save the results of many portfolios in one transaction: every metrics row in
+# one batched upsert, every allocation row in another, then the shared prices.
+@traced('db.save_batch_results', rows=lambda counts: sum(counts.values()))
+def save_batch_results(metrics_list, allocations, price_data):
+    with get_engine().begin() as conn:
+        if metrics_list:
+            conn.execute(text(upsert_metrics_sql), metrics_list)
+        if allocations:
+            conn.execute(text(upsert_allocations_sql), allocations)
+        price_rows = insert_adjusted_prices(price_data, conn=conn)
+    return {"metrics": len(metrics_list), "allocations": len(allocations), "prices": price_rows}
+
+# Upsert long rows into table: through a COPY-filled staging table on
+# PostgreSQL, as a batched executemany elsewhere.
+def _upsert_rows(conn, upsert_sql: str, table: str, rows: pd.DataFrame):
+    columns = ", ".join(rows.columns)
+    if conn.dialect.name != 'postgresql':
+        placeholders = ", ".join(f":{column}" for column in rows.columns)
+        conn.execute(text(upsert_sql.format(source=f"VALUES ({placeholders})")), rows.to_dict('records'))
+        return
+    conn.execute(text(f"CREATE TEMP TABLE IF NOT EXISTS {table}_staging (LIKE {table}) ON COMMIT DROP"))
+    buffer = io.StringIO()
+    rows.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table}_staging ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+    conn.execute(text(upsert_sql.format(source=f"SELECT {columns} FROM {table}_staging WHERE true")))
+    conn.execute(text(f"TRUNCATE {table}_staging"))
+
+
+# Save the rows of a prefix_stats.PrefixStats dated after `since` (all when None),
+# a slice of dates at a time so each write holds ~chunk_size rows.
+@traced('db.save_prefix_stats', rows=lambda total_rows: total_rows)
+def save_prefix_stats(stats: PrefixStats, since=None, chunk_size: int = 50_000, conn=None) -> int:
+    first = 0 if since is None else stats.dates.searchsorted(pd.Timestamp(since), side='right')
+    tickers = stats.tickers.astype(str).to_numpy()
+    # Pairs are stored with ticker_a < ticker_b whatever the index order.
+    pair_a, pair_b = tickers[stats.pairs[0]], tickers[stats.pairs[1]]
+    swap = pair_a > pair_b
+    pair_a, pair_b = np.where(swap, pair_b, pair_a), np.where(swap, pair_a, pair_b)
+    row_width = len(tickers) + (len(pair_a) if stats.has_cross_products else 0)
+    dates_per_chunk = max(1, chunk_size // max(1, row_width))
+
+    total_rows = 0
+    with _transaction(conn) as conn:
+        for start in range(first, len(stats), dates_per_chunk):
+            rows = slice(start, start + dates_per_chunk)
+            dates = stats.dates[rows].date
+            _upsert_rows(conn, upsert_prefix_stats_sql, 'return_prefix_stats', pd.DataFrame({
+                'ticker': np.tile(tickers, len(dates)),
+                'date': np.repeat(dates, len(tickers)),
+                'sum_returns': stats.sums[rows].ravel(),
+                'sum_squares': stats.squares[rows].ravel(),
+                'sum_log_growth': stats.log_growth[rows].ravel(),
+                'observations': stats.counts[rows].ravel(),
+            }))
+            total_rows += len(dates) * len(tickers)
+            if stats.has_cross_products and len(pair_a):
+                _upsert_rows(conn, upsert_prefix_cross_products_sql, 'return_prefix_cross_products', pd.DataFrame({
+                    'ticker_a': np.tile(pair_a, len(dates)),
+                    'ticker_b': np.tile(pair_b, len(dates)),
+                    'date': np.repeat(dates, len(pair_a)),
+                    'sum_products': stats.cross_products[rows].ravel(),
+                }))
+                total_rows += len(dates) * len(pair_a)
+    return total_rows
+
+
+def _pivot_prices(rows: pd.DataFrame) -> pd.DataFrame:
+    prices = rows.pivot(index='date', columns='ticker', values='adj_close').astype(float)
+    prices.index = pd.to_datetime(prices.index)
+    return prices
+
+
+# Wide (date x ticker) adjusted prices dated after `after` (everything when
+# None), streamed in date order as frames of ~chunk_size rows. A date is only
+# yielded once all of its rows have been read.
+def _stream_prices(conn, tickers=None, after=None, chunk_size: int = 50_000):
+    conditions, params = [], {}
+    if tickers is not None:
+        conditions.append("ticker IN :tickers")
+        params['tickers'] = list(tickers)
+    if after is not None:
+        conditions.append("date > :after")
+        params['after'] = pd.Timestamp(after).date()
+    query = text("SELECT date, ticker, adj_close FROM adjusted_prices"
+                 + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY date, ticker")
+    if tickers is not None:
+        query = query.bindparams(bindparam('tickers', expanding=True))
+    result = conn.execute(query, params, execution_options={'stream_results': True, 'yield_per': chunk_size})
+    pending = pd.DataFrame(columns=['date', 'ticker', 'adj_close'])
+    for rows in result.partitions():
+        chunk = pd.DataFrame(rows, columns=['date', 'ticker', 'adj_close'])
+        if len(pending):
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        # The last date may continue in the next partition.
+        complete = chunk['date'] != chunk['date'].iloc[-1]
+        pending = chunk[~complete]
+        if complete.any():
+            yield _pivot_prices(chunk[complete])
+    if len(pending):
+        yield _pivot_prices(pending)
+
+
+# Index the streamed prices into stats chunk by chunk, saving the new rows and
+# then dropping them from memory. Returns the number of dates added.
+def _extend_and_save(conn, stats: PrefixStats, after=None) -> int:
+    added = 0
+    for prices in _stream_prices(conn, stats.tickers, after=after):
+        dates = stats.extend(prices)
+        if dates:
+            save_prefix_stats(stats, since=after, conn=conn)
+            added += dates
+        stats.compact()
+    return added
+
+
+# Load the persisted index, or only its rows dated from `start` on: the totals
+# of the preceding date become the index's starting point, so
+# load_prefix_stats(start=d) is enough to query windows after d or to extend it.
+# Returns None when nothing is stored.
+def load_prefix_stats(start=None, conn=None) -> PrefixStats:
+    with _transaction(conn) as conn:
+        params = {'start': pd.Timestamp(start).date()} if start is not None else {}
+        where = " WHERE date >= :start" if start is not None else ""
+        totals = pd.DataFrame(conn.execute(text(
+            "SELECT date, ticker, sum_returns, sum_squares, sum_log_growth, observations "
+            "FROM return_prefix_stats" + where),
+            params).fetchall(), columns=['date', 'ticker', 'sums', 'squares', 'log_growth', 'observations'])
+        if totals.empty:
+            return None
+        products = pd.DataFrame(conn.execute(text(
+            "SELECT date, ticker_a, ticker_b, sum_products FROM return_prefix_cross_products" + where),
+            params).fetchall(), columns=['date', 'ticker_a', 'ticker_b', 'sum_products'])
+
+        initial_totals = initial_products = None
+        if start is not None:
+            previous = conn.execute(text("SELECT MAX(date) FROM return_prefix_stats WHERE date < :start"),
+                                    params).scalar()
+            if previous is not None:
+                initial_totals, initial_products = _prefix_rows(conn, previous)
+
+        tickers = pd.Index(sorted(totals['ticker'].unique()))
+        last_date = max(totals['date'])
+        # Latest saved price of each ticker up to the last indexed date.
+        latest = conn.execute(text("""
+        SELECT p.ticker, p.adj_close FROM adjusted_prices p
+        JOIN (SELECT ticker, MAX(date) AS date FROM adjusted_prices WHERE date <= :date GROUP BY ticker) latest
+        ON p.ticker = latest.ticker AND p.date = latest.date
+        """), {'date': last_date}).fetchall()
+
+    totals['date'] = pd.to_datetime(totals['date'])
+    wide = {name: totals.pivot(index='date', columns='ticker', values=column).reindex(columns=tickers).sort_index()
+            for name, column in _PREFIX_COLUMNS.items()}
+    pairs = np.triu_indices(len(tickers), 1)
+    pair_index = pd.MultiIndex.from_arrays([tickers[pairs[0]], tickers[pairs[1]]])
+    cross_products = None
+    if not products.empty:
+        products['date'] = pd.to_datetime(products['date'])
+        cross = products.pivot(index='date', columns=['ticker_a', 'ticker_b'], values='sum_products')
+        cross = cross.reindex(index=wide['sums'].index, columns=pair_index)
+        if not cross.isna().to_numpy().any():
+            cross_products = cross.to_numpy(dtype=float)
+
+    initial = None
+    if initial_totals is not None:
+        initial = {name: _ticker_totals(initial_totals, name, tickers) for name in _PREFIX_COLUMNS}
+        initial['cross_products'] = None if cross_products is None else \
+            initial_products['sum_products'].reindex(pair_index).to_numpy(dtype=float)
+    last_prices = pd.Series(dict(latest), dtype=float).reindex(tickers).to_numpy(dtype=float)
+    return PrefixStats(tickers, wide['sums'].index,
+                       *(wide[name].to_numpy(dtype=np.int64 if name == 'counts' else float) for name in _PREFIX_COLUMNS),
+                       cross_products, initial, last_prices, pd.Timestamp(last_date))
+
+
+# PrefixStats statistic -> column of _prefix_rows' per-ticker frame.
+_PREFIX_COLUMNS = {'sums': 'sums', 'squares': 'squares', 'log_growth': 'log_growth', 'counts': 'observations'}
+
+
+def _ticker_totals(rows: pd.DataFrame, name: str, tickers) -> np.ndarray:
+    return rows[_PREFIX_COLUMNS[name]].reindex(tickers).to_numpy(dtype=np.int64 if name == 'counts' else float)
+
+
+# The stored totals of one date, for the given tickers (all when None): per
+# ticker (sums, squares, log_growth, observations) and per pair sum_products.
+def _prefix_rows(conn, date, tickers=None, cross_products: bool = True) -> tuple:
+    params = {'date': date}
+    ticker_filter = pair_filter = ""
+    if tickers is not None:
+        params['tickers'] = list(tickers)
+        ticker_filter = " AND ticker IN :tickers"
+        pair_filter = " AND ticker_a IN :tickers AND ticker_b IN :tickers"
+
+    def query(sql):
+        statement = text(sql)
+        if tickers is not None:
+            statement = statement.bindparams(bindparam('tickers', expanding=True))
+        return conn.execute(statement, params).fetchall()
+
+    totals = pd.DataFrame(query(
+        "SELECT ticker, sum_returns, sum_squares, sum_log_growth, observations FROM return_prefix_stats "
+        "WHERE date = :date" + ticker_filter),
+        columns=['ticker', 'sums', 'squares', 'log_growth', 'observations']).set_index('ticker')
+    products = None
+    if cross_products:
+        products = pd.DataFrame(query(
+            "SELECT ticker_a, ticker_b, sum_products FROM return_prefix_cross_products "
+            "WHERE date = :date" + pair_filter),
+            columns=['ticker_a', 'ticker_b', 'sum_products']).set_index(['ticker_a', 'ticker_b'])
+    return totals, products
+
+
+# Totals of the returns dated in [start, end] from the two boundary rows of the
+# persisted index (the last date before start and the last date up to end), so
+# the cost does not depend on the length of the window. The window must lie
+# within the indexed dates. Returns the sorted tickers and the totals by
+# prefix_stats name.
+def _prefix_window(conn, start=None, end=None, tickers=None, cross_products: bool = False) -> tuple:
+    first_date, last_date = conn.execute(text("SELECT MIN(date), MAX(date) FROM return_prefix_stats")).one()
+    if first_date is None:
+        raise ValueError("The prefix index is empty; run update_prefix_stats first")
+    check_window(start, end, first_date, last_date)
+    last = last_date if end is None else conn.execute(
+        text("SELECT MAX(date) FROM return_prefix_stats WHERE date <= :end"),
+        {'end': pd.Timestamp(end).date()}).scalar()
+    before = None
+    if start is not None:
+        before = conn.execute(text("SELECT MAX(date) FROM return_prefix_stats WHERE date < :start"),
+                              {'start': pd.Timestamp(start).date()}).scalar()
+
+    end_totals, end_products = _prefix_rows(conn, last, tickers, cross_products)
+    if tickers is not None:
+        missing = sorted(set(tickers) - set(end_totals.index))
+        if missing:
+            raise KeyError(f"Tickers not in the prefix index: {', '.join(missing)}")
+    tickers = pd.Index(sorted(end_totals.index))
+    totals = {name: _ticker_totals(end_totals, name, tickers) for name in _PREFIX_COLUMNS}
+
+    pairs = np.triu_indices(len(tickers), 1)
+    pair_index = pd.MultiIndex.from_arrays([tickers[pairs[0]], tickers[pairs[1]]])
+    if cross_products:
+        totals['cross_products'] = end_products['sum_products'].reindex(pair_index).to_numpy(dtype=float)
+        if np.isnan(totals['cross_products']).any():
+            raise ValueError("The prefix index was built without cross-products")
+
+    if before is not None:
+        start_totals, start_products = _prefix_rows(conn, before, tickers, cross_products)
+        for name in _PREFIX_COLUMNS:
+            totals[name] = totals[name] - _ticker_totals(start_totals, name, tickers)
+        if cross_products:
+            totals['cross_products'] -= start_products['sum_products'].reindex(pair_index).to_numpy(dtype=float)
+    return tickers, totals
+
+
+# Annualized return, volatility and Sharpe ratio and the cumulative return of
+# every ticker over [start, end], straight from the persisted index
+# (PrefixStats.range_metrics without loading it).
+def prefix_range_metrics(start=None, end=None, tickers=None, risk_free_rate: float = 0.03,
+                         conn=None) -> pd.DataFrame:
+    with _transaction(conn) as conn:
+        tickers, totals = _prefix_window(conn, start, end, tickers)
+    return metrics_from_totals(tickers, totals, risk_free_rate)
+
+
+# Annualized sample covariance over [start, end] from the persisted index.
+def prefix_range_covariance(start=None, end=None, tickers=None, conn=None) -> pd.DataFrame:
+    with _transaction(conn) as conn:
+        tickers, totals = _prefix_window(conn, start, end, tickers, cross_products=True)
+    return covariance_from_totals(tickers, totals)
+
+
+# Nightly job: extend the persisted index with the prices saved since its last
+# date and write only the new rows. Builds the index from every saved price the
+# first time. Tickers to index default to every ticker in adjusted_prices; when
+# some are not indexed yet (saved since the last build), the index is rebuilt
+# with them so their whole history and their pairs are covered. Returns the
+# number of dates added (indexed, after a rebuild).
+@traced('db.update_prefix_stats')
+def update_prefix_stats(tickers=None, conn=None) -> int:
+    with _transaction(conn) as conn:
+        if tickers is None:
+            tickers = conn.execute(text("SELECT DISTINCT ticker FROM adjusted_prices")).scalars().all()
+        last_date = conn.execute(text("SELECT MAX(date) FROM return_prefix_stats")).scalar()
+        if last_date is None:
+            return rebuild_prefix_stats(tickers, conn=conn)
+        stats = load_prefix_stats(start=last_date, conn=conn)
+        new_tickers = set(tickers) - set(stats.tickers)
+        if new_tickers:
+            print(f"Rebuilding the prefix index for {len(new_tickers)} new ticker(s): "
+                  + ", ".join(sorted(new_tickers)))
+            return rebuild_prefix_stats(sorted(new_tickers | set(stats.tickers)), stats.has_cross_products,
+                                        conn=conn)
+        return _extend_and_save(conn, stats, after=last_date)
+
 
-    with engine.begin() as conn:
-        for date, row in df.iterrows():
-            for ticker, price in row.items():
-                if pd.notna(price):
-                    conn.execute(
-                        text("""
-                        INSERT INTO adjusted_prices (date, ticker, adj_close)
-                        VALUES (:date, :ticker, :adj_close)
-                        """),
-                        {
-                            "date": date.date() if isinstance(date, pd.Timestamp) else date,
-                            "ticker": str(ticker),
-                            "adj_close": float(price)
-                        }
-                    )
+# Replace the persisted index with one built from the saved prices of the given
+# tickers (all when None), streaming the prices in date chunks so neither the
+# prices nor the index are held in memory at once. Returns the number of dates
+# indexed.
+@traced('db.rebuild_prefix_stats')
+def rebuild_prefix_stats(tickers=None, cross_products: bool = True, conn=None) -> int:
+    with _transaction(conn) as conn:
+        conn.execute(text("DELETE FROM return_prefix_stats"))
+        conn.execute(text("DELETE FROM return_prefix_cross_products"))
+        if tickers is None:
+            tickers = conn.execute(text("SELECT DISTINCT ticker FROM adjusted_prices")).scalars().all()
+        if not len(tickers):
+            return 0
+        stats = PrefixStats.empty(sorted(tickers), cross_products)
+        return _extend_and_save(conn, stats)
 
 # Commenting out this section since streamlit does not accept input()
 # Keeping the logic for debugging purposes.
@@ -141,8 +780,10 @@ def clear_db_tables():
         #print("Aborted clearing tables.")
         #return False
 
-    with engine.begin() as conn:
+    with get_engine().begin() as conn:
         conn.execute(text("DELETE FROM adjusted_prices"))
+        conn.execute(text("DELETE FROM return_prefix_stats"))
+        conn.execute(text("DELETE FROM return_prefix_cross_products"))
         conn.execute(text("DELETE FROM portfolio_allocations"))
         conn.execute(text("DELETE FROM portfolio_metrics"))
         print("Tables cleared")
@@ -0,0 +1,43 @@
+''' The BackgroundWriter class runs database saves on a single background thread
+so the dashboard does not freeze while metrics, allocations and prices are
+written. Jobs are queued and executed one at a time; each submit returns a
+Future that reports completion or the raised error.'''
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from db_setup import save_all
+
+
+class BackgroundWriter:
+    def __init__(self):
+        # One worker thread: jobs queue up and never compete for the same rows.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+
+    # Queue metrics, allocations and prices as one batched transaction. metrics
+    # is the compute_all_metrics() frame of price_data when the caller already has
+    # it, so the save does not compute it again.
+    def submit_save(self, price_data, weights, optimized_sharpe, optimized_volatility,
+                    min_volatility_weights, metrics=None) -> Future:
+        return self._executor.submit(save_all, price_data.copy(), weights, optimized_sharpe,
+                                     optimized_volatility, min_volatility_weights, metrics)
+
+    # Wait for queued jobs to finish and stop the worker thread.
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+# Process-wide writer shared by every dashboard session. Sessions run on their
+# own threads, so creation is locked: two writers would write concurrently.
+def get_writer() -> BackgroundWriter:
+    global _writer
+    if _writer is not None:
+        return _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BackgroundWriter()
+        return _writer
@@ -0,0 +1,55 @@
+''' Downsampling of long time series for charts. Plotting more points than the
+chart has pixels only costs time, so series are reduced to a point budget with
+Largest-Triangle-Three-Buckets, which keeps the visual shape of the series.
+Only NumPy and pandas are needed, so the dashboard can import this at start-up.'''
+
+import numpy as np
+import pandas as pd
+
+
+# Largest-Triangle-Three-Buckets downsampling of k series sharing the x values.
+# y is (n, k); returns (n_out, k) row indices into y, always keeping the first
+# and last points. Each bucket keeps the point forming the largest triangle with
+# the point kept in the previous bucket and the mean of the next bucket, which
+# preserves peaks and troughs. The loop runs over buckets; the k series are
+# handled together by NumPy.
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float).reshape(len(x), -1)
+    n, k = y.shape
+    if n_out >= n or n_out < 3:
+        return np.repeat(np.arange(n)[:, None], k, axis=1)
+
+    columns = np.arange(k)
+    every = (n - 2) / (n_out - 2)
+    indices = np.empty((n_out, k), dtype=np.intp)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = np.zeros(k, dtype=np.intp)
+    for i in range(n_out - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_start, next_end = end, min(int((i + 2) * every) + 1, n)
+        average_x = x[next_start:next_end].mean()
+        average_y = np.nanmean(y[next_start:next_end], axis=0)
+
+        previous_x = x[previous]
+        previous_y = y[previous, columns]
+        area = np.abs((previous_x - average_x) * (y[start:end] - previous_y)
+                      - (previous_x - x[start:end, None]) * (average_y - previous_y))
+        area[np.isnan(area)] = -1
+        previous = start + np.argmax(area, axis=0)
+        indices[i + 1] = previous
+    return indices
+
+
+# Downsample every column of a date-indexed frame to at most max_points points
+# and return it in long form (date, ticker, value), e.g. for st.line_chart.
+def downsample(frame: pd.DataFrame, max_points: int = 1000) -> pd.DataFrame:
+    frame = frame.dropna(how='all')
+    indices = lttb_indices(np.arange(len(frame)), frame.to_numpy(dtype=float), max_points)
+    values = frame.to_numpy(dtype=float)[indices, np.arange(frame.shape[1])]
+    return pd.DataFrame({
+        'date': np.asarray(frame.index)[indices].ravel(order='F'),
+        'ticker': np.repeat(np.asarray(frame.columns, dtype=object), len(indices)),
+        'value': values.ravel(order='F'),
+    })
@@ -0,0 +1,254 @@
+''' Lightweight instrumentation for the pipeline stages (fetch, analysis,
+optimization, database writes). Each stage runs inside a named span that records
+its duration, the number of rows it handled, the peak memory it allocated and
+any extra attributes such as optimizer iteration counts.
+
+Instrumentation is off unless the PORTFOLIO_PROFILE environment variable is set
+(e.g. PORTFOLIO_PROFILE=1); when off a span is a shared no-op object. Related
+variables:
+    PORTFOLIO_PROFILE_OUTPUT  write the spans at exit; a path ending in .prom gets
+                              the Prometheus text format, anything else JSON
+    PORTFOLIO_PROFILE_STAGE   capture a cProfile of the stage with this span name
+    PORTFOLIO_PROFILE_DIR     directory for the .prof files (default: current)
+    PORTFOLIO_PROFILE_MAX_RECORDS
+                              spans kept for the JSON output (default: 10000, the
+                              oldest are dropped); the per-stage totals of the
+                              Prometheus output cover every span
+
+Peak memory comes from tracemalloc, which is process-wide: spans running at the
+same time on different threads see each other's allocations.'''
+
+import atexit
+import collections
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+_enabled = False
+_profile_stage = None
+_records = collections.deque(maxlen=int(os.environ.get('PORTFOLIO_PROFILE_MAX_RECORDS', 10_000)))
+_stages = {} # per-stage totals over every span, for the Prometheus output
+_records_lock = threading.Lock()
+_local = threading.local() # per-thread stack of open spans
+
+
+class Span:
+    __slots__ = ('name', 'rows', 'attributes', '_start', '_start_memory', '_peak_memory', '_profiler')
+
+    def __init__(self, name: str, rows: Optional[int] = None, **attributes):
+        self.name = name
+        self.rows = rows
+        self.attributes = attributes
+
+    # Attach extra values to the span, e.g. span.set(iterations=result.nit).
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = _span_stack()
+        if stack:
+            # The parent's peak so far would be lost when the peak is reset below.
+            stack[-1]._peak_memory = max(stack[-1]._peak_memory, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self._start_memory = self._peak_memory = tracemalloc.get_traced_memory()[0]
+        stack.append(self)
+
+        self._profiler = None
+        if self.name == _profile_stage and not any(open_span._profiler for open_span in stack[:-1]):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self._start
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.attributes['profile'] = _dump_profile(self._profiler, self.name)
+        self._peak_memory = max(self._peak_memory, tracemalloc.get_traced_memory()[1])
+        stack = _span_stack()
+        stack.pop()
+        if stack:
+            stack[-1]._peak_memory = max(stack[-1]._peak_memory, self._peak_memory)
+
+        record = {
+            'name': self.name,
+            'seconds': seconds,
+            'rows': self.rows,
+            'peak_memory_bytes': self._peak_memory - self._start_memory,
+            'error': exc_type.__name__ if exc_type is not None else None,
+            'thread': threading.current_thread().name,
+            'timestamp': time.time(),
+        }
+        record.update(self.attributes)
+        with _records_lock:
+            _records.append(record)
+            _aggregate(record)
+        return False
+
+
+# Add a finished span to the totals of its stage.
+def _aggregate(record: dict):
+    stage = _stages.setdefault(record['name'], {
+        'calls': 0, 'errors': 0, 'seconds': 0.0, 'rows': 0, 'peak_memory_bytes': 0,
+        'iterations': 0, 'function_evaluations': 0,
+    })
+    stage['calls'] += 1
+    stage['errors'] += record['error'] is not None
+    stage['seconds'] += record['seconds']
+    stage['rows'] += record['rows'] or 0
+    stage['peak_memory_bytes'] = max(stage['peak_memory_bytes'], record['peak_memory_bytes'])
+    stage['iterations'] += record.get('iterations', 0)
+    stage['function_evaluations'] += record.get('function_evaluations', 0)
+
+
+# Stands in for every span while instrumentation is off.
+class _NoOpSpan:
+    __slots__ = ()
+    rows = None
+
+    def __setattr__(self, name, value):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+def _span_stack() -> list:
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _dump_profile(profiler: cProfile.Profile, name: str) -> str:
+    directory = os.environ.get('PORTFOLIO_PROFILE_DIR', '.')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+    profiler.dump_stats(path)
+    print(f"Saved profile of {name} to {path} (view with `python -m pstats {path}`)")
+    return path
+
+
+# Open a span around a stage:
+#     with span('db.insert_adjusted_prices') as s:
+#         ...
+#         s.rows = total_rows
+def span(name: str, rows: Optional[int] = None, **attributes):
+    if not _enabled:
+        return _NO_OP_SPAN
+    return Span(name, rows, **attributes)
+
+
+# Decorator form of span. rows, if given, computes the row count from the result.
+def traced(name: str, rows=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(name) as current:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    current.rows = rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+# Turn instrumentation on; profile_stage names a span to capture with cProfile.
+def enable(profile_stage: Optional[str] = None):
+    global _enabled, _profile_stage
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _profile_stage = profile_stage
+    _enabled = True
+
+
+def disable():
+    global _enabled, _profile_stage
+    _enabled = False
+    _profile_stage = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+# The most recent spans (up to PORTFOLIO_PROFILE_MAX_RECORDS), oldest first.
+def records() -> list:
+    with _records_lock:
+        return list(_records)
+
+
+# Per-stage totals of every span since the last reset.
+def stage_totals() -> dict:
+    with _records_lock:
+        return {name: dict(totals) for name, totals in _stages.items()}
+
+
+def reset():
+    with _records_lock:
+        _records.clear()
+        _stages.clear()
+
+
+def to_json(indent: int = 2) -> str:
+    return json.dumps(records(), indent=indent, default=str)
+
+
+# Prometheus text exposition format, aggregated per stage.
+def to_prometheus() -> str:
+    stages = stage_totals()
+
+    metrics = [
+        ('calls', 'counter', 'Number of times the stage ran'),
+        ('errors', 'counter', 'Number of runs of the stage that raised'),
+        ('seconds', 'counter', 'Total wall time spent in the stage'),
+        ('rows', 'counter', 'Total rows handled by the stage'),
+        ('peak_memory_bytes', 'gauge', 'Largest peak memory allocated during one run of the stage'),
+        ('iterations', 'counter', 'Total optimizer iterations'),
+        ('function_evaluations', 'counter', 'Total optimizer objective evaluations'),
+    ]
+    lines = []
+    for metric, kind, description in metrics:
+        name = f'portfolio_stage_{metric}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# HELP {name} {description}.')
+        lines.append(f'# TYPE {name} {kind}')
+        for stage, values in stages.items():
+            lines.append(f'{name}{{stage="{stage}"}} {values[metric]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Write the recorded spans to path, as Prometheus text for *.prom and JSON otherwise.
+def export(path: str):
+    content = to_prometheus() if path.endswith('.prom') else to_json()
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _export_at_exit():
+    path = os.environ.get('PORTFOLIO_PROFILE_OUTPUT')
+    if path and stage_totals():
+        export(path)
+
+
+if os.environ.get('PORTFOLIO_PROFILE', '').lower() not in ('', '0', 'false', 'no'):
+    enable(os.environ.get('PORTFOLIO_PROFILE_STAGE'))
+    atexit.register(_export_at_exit)
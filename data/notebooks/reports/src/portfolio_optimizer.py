@@ -2,33 +2,221 @@
 by optimizing Sharpe Ratio and minimize portfolio volatility.'''
 
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
+
+
+from analysis import PortfolioAnalyzer
+from covariance import to_dense
+from instrumentation import span
+
+
+# SciPy takes about half a second to import, so it is loaded on the first solve
+# instead of with this module.
+def _minimize(*args, **kwargs):
+    from scipy.optimize import minimize
+    return minimize(*args, **kwargs)
+
+
+# Objective functions and their closed-form gradients. They work on plain
+# NumPy arrays so SLSQP does not pay pandas index alignment on every call.
+def _portfolio_volatility(weights, cov_matrix):
+    return np.sqrt(weights @ (cov_matrix @ weights))
+
+
+def _volatility_gradient(weights, cov_matrix):
+    cov_weights = cov_matrix @ weights
+    return cov_weights / np.sqrt(weights @ cov_weights)
+
+
+def _negative_sharpe(weights, expected_returns, cov_matrix, risk_free_rate):
+    excess_return = weights @ expected_returns - risk_free_rate
+    return -excess_return / _portfolio_volatility(weights, cov_matrix)
+
+
+def _negative_sharpe_gradient(weights, expected_returns, cov_matrix, risk_free_rate):
+    cov_weights = cov_matrix @ weights
+    volatility = np.sqrt(weights @ cov_weights)
+    excess_return = weights @ expected_returns - risk_free_rate
+    return -(expected_returns / volatility - excess_return * cov_weights / volatility ** 3)
+
+
+# Weights must sum to 1 to be a fully invested portfolio; the Jacobian is constant.
+_FULLY_INVESTED = {'type': 'eq', 'fun': lambda w: np.sum(w) - 1, 'jac': lambda w: np.ones_like(w)}
+
+
+# Minimize volatility subject to hitting a target expected return.
+def _min_volatility_for_target(expected_returns, cov_matrix, target_return, initial_weights):
+    target_constraint = {
+        'type': 'eq',
+        'fun': lambda w: w @ expected_returns - target_return,
+        'jac': lambda w: expected_returns
+    }
+    return _minimize(
+        fun=_portfolio_volatility,
+        x0=initial_weights,
+        args=(cov_matrix,),
+        jac=_volatility_gradient,
+        method='SLSQP',
+        bounds=tuple((0, 1) for _ in range(len(expected_returns))),
+        constraints=[_FULLY_INVESTED, target_constraint]
+    )
+
+
+# Solve a run of neighbouring frontier points, warm-starting each solve from the
+# previous solution. Points that fail to converge come back as NaN weights.
+def _solve_frontier_segment(expected_returns, cov_matrix, target_returns, initial_weights):
+    weights = initial_weights
+    solutions = []
+    for target_return in target_returns:
+        result = _min_volatility_for_target(expected_returns, cov_matrix, target_return, weights)
+        if result.success:
+            weights = result.x
+            solutions.append(result.x)
+        else:
+            solutions.append(np.full(len(expected_returns), np.nan))
+    return solutions
+
 
+# Score one chunk of random long-only portfolios drawn from a flat Dirichlet.
+# Only chunk_size x n_assets weights are alive at a time.
+def _simulate_chunk(expected_returns, cov_matrix, risk_free_rate, n_portfolios, seed_sequence):
+    rng = np.random.default_rng(seed_sequence)
+    weights = rng.dirichlet(np.ones(len(expected_returns)), size=n_portfolios)
+    portfolio_returns = weights @ expected_returns
+    volatility = np.sqrt(np.einsum('ij,ij->i', weights @ cov_matrix, weights))
+    return portfolio_returns, volatility, (portfolio_returns - risk_free_rate) / volatility
 
-from data.notebooks.reports.src.analysis import PortfolioAnalyzer
-from scipy.optimize import minimize
+
+# Inputs shared by every task of a worker process. The pool initializer sends
+# them once per worker instead of pickling the covariance matrix with each task.
+_worker_inputs = {}
+
+
+def _init_worker(expected_returns, cov_matrix):
+    _worker_inputs['expected_returns'] = expected_returns
+    _worker_inputs['cov_matrix'] = cov_matrix
+
+
+def _solve_frontier_segment_in_worker(target_returns, initial_weights):
+    return _solve_frontier_segment(_worker_inputs['expected_returns'], _worker_inputs['cov_matrix'],
+                                   target_returns, initial_weights)
+
+
+def _simulate_chunk_in_worker(risk_free_rate, n_portfolios, seed_sequence):
+    return _simulate_chunk(_worker_inputs['expected_returns'], _worker_inputs['cov_matrix'],
+                           risk_free_rate, n_portfolios, seed_sequence)
 
 
 class PortfolioOptimizer:
     def __init__(self, analyzer: PortfolioAnalyzer):
         self.analyzer = analyzer
-        self.returns = analyzer.returns # This is the daily returns
-        self.annualized_returns = analyzer.calculate_annualized_return()
-        self.annualized_cov = analyzer.calculate_covariance_matrix()
-        self.risk_free_rate = analyzer.risk_free_rate
+        self.return_matrix = analyzer.return_matrix() # This is the daily returns
+        self._set_moments(analyzer.calculate_annualized_return(), analyzer.covariance_estimate(),
+                          analyzer.risk_free_rate)
+
+    # Build an optimizer straight from annualized expected returns and covariance,
+    # e.g. when they are maintained incrementally outside a PortfolioAnalyzer.
+    @classmethod
+    # annualized_cov may be a DataFrame, an ndarray or a covariance.FactorCovariance.
+    def from_moments(cls, annualized_returns: pd.Series, annualized_cov,
+                     risk_free_rate: float = 0.03) -> 'PortfolioOptimizer':
+        optimizer = cls.__new__(cls)
+        optimizer.analyzer = None
+        optimizer.return_matrix = None
+        optimizer._set_moments(annualized_returns, annualized_cov, risk_free_rate)
+        return optimizer
+
+    def _set_moments(self, annualized_returns: pd.Series, annualized_cov, risk_free_rate: float):
+        self.annualized_returns = annualized_returns
+        self.risk_free_rate = risk_free_rate
+        # NumPy forms used inside the optimizer objectives
+        self._expected_returns = annualized_returns.to_numpy(dtype=float)
+        self._cov = annualized_cov.to_numpy() if isinstance(annualized_cov, pd.DataFrame) else annualized_cov
+
+    # Daily returns as a DataFrame sharing memory with return_matrix
+    @property
+    def returns(self) -> pd.DataFrame:
+        return None if self.return_matrix is None else self.return_matrix.to_frame()
+
+    # Dense covariance matrix as a DataFrame (built on access for factor models)
+    @property
+    def annualized_cov(self) -> pd.DataFrame:
+        tickers = self.annualized_returns.index
+        return pd.DataFrame(to_dense(self._cov), index=tickers, columns=tickers)
 
     # Create a function to calculate performance given a set of weights
     def portfolio_performance(self, weights: np.ndarray) -> tuple: # accept weights
-        expected_returns = np.dot(weights, self.annualized_returns)
-        volatility = np.sqrt(weights.T @ self.annualized_cov @ weights)
+        weights = np.asarray(weights, dtype=float)
+        expected_returns = weights @ self._expected_returns
+        volatility = _portfolio_volatility(weights, self._cov)
         # excess return divided by the volatility
         sharpe_ratio = (expected_returns - self.risk_free_rate) / volatility
         return expected_returns, volatility, sharpe_ratio
 
+    # Create a function to evaluate many portfolios over the same universe at once.
+    # weights is a (portfolios x assets) matrix. benchmark is either a weight
+    # vector over the same assets (tracking error from the covariance) or a
+    # Series of daily benchmark returns (tracking error from active returns). A
+    # benchmark Series indexed by tickers is a weight vector (missing tickers
+    # get 0); any other Series is daily returns, aligned to the return dates.
+    # A weights DataFrame is aligned to the tickers (missing ones get 0) and its
+    # index labels the result. Portfolios are processed in chunks of chunk_size
+    # so the daily (days x chunk) return matrix used for drawdowns stays bounded.
+    def evaluate_portfolios(self, weights, benchmark=None, chunk_size: int = 1000) -> pd.DataFrame:
+        if self.return_matrix is None:
+            raise ValueError("Daily returns are required; build the optimizer from a PortfolioAnalyzer.")
+        index = None
+        tickers = self.annualized_returns.index
+        if isinstance(weights, pd.DataFrame):
+            index = weights.index
+            weights = weights.reindex(columns=tickers, fill_value=0.0)
+        weights = np.atleast_2d(np.asarray(weights, dtype=float))
+        daily_returns = self.return_matrix.values
+        benchmark_weights = benchmark_returns = None
+        if isinstance(benchmark, pd.Series) and benchmark.index.isin(tickers).all():
+            benchmark_weights = benchmark.reindex(tickers, fill_value=0.0).to_numpy(dtype=float)
+        elif isinstance(benchmark, pd.Series):
+            benchmark_returns = benchmark.reindex(self.return_matrix.dates).to_numpy(dtype=float)
+            if np.isnan(benchmark_returns).all():
+                raise ValueError("The benchmark returns share no dates with the portfolio returns "
+                                 f"({self.return_matrix.dates[0]:%Y-%m-%d} to {self.return_matrix.dates[-1]:%Y-%m-%d})")
+        elif benchmark is not None:
+            benchmark_weights = np.asarray(benchmark, dtype=float)
+
+        expected_returns = weights @ self._expected_returns
+        volatility = np.sqrt(np.einsum('ij,ij->i', weights @ self._cov, weights))
+        metrics = {
+            'expected_return': expected_returns,
+            'volatility': volatility,
+            'sharpe_ratio': (expected_returns - self.risk_free_rate) / volatility,
+        }
+        if benchmark_weights is not None:
+            active_weights = weights - benchmark_weights
+            metrics['tracking_error'] = np.sqrt(np.einsum('ij,ij->i', active_weights @ self._cov, active_weights))
+        elif benchmark_returns is not None:
+            metrics['tracking_error'] = np.empty(len(weights))
+        metrics['max_drawdown'] = np.empty(len(weights))
+
+        for start in range(0, len(weights), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            portfolio_returns = daily_returns @ weights[chunk].T # days x portfolios
+            if benchmark_returns is not None:
+                active_returns = portfolio_returns - benchmark_returns[:, None]
+                metrics['tracking_error'][chunk] = np.nanstd(active_returns, axis=0, ddof=1) * np.sqrt(252)
+            cumulative_returns = np.cumprod(1 + portfolio_returns, axis=0)
+            running_max = np.maximum.accumulate(cumulative_returns, axis=0)
+            metrics['max_drawdown'][chunk] = ((running_max - cumulative_returns) / running_max).max(axis=0)
+
+        return pd.DataFrame(metrics, index=index)
+
     # Allow user to input the weights
     def get_weights_input(self) -> np.ndarray:
-        n_assets = len(self.returns.columns) # ask the user for porfolio weights, return a NumPy array
-        tickers = self.returns.columns.tolist()
+        n_assets = len(self.annualized_returns) # ask the user for porfolio weights, return a NumPy array
+        tickers = self.annualized_returns.index.tolist()
         # converts the assets list from pandas index object
         # into a plain Python list
 
@@ -44,34 +232,33 @@ class PortfolioOptimizer:
 
     # Create a function to optimize the Sharpe ratio
     def optimize_sharpe_ratio(self, weights):
-        expected_returns = np.dot(weights, self.annualized_returns)
-        cov_matrix = self.annualized_cov
-        risk_free_rate = self.risk_free_rate
+        return _negative_sharpe(weights, self._expected_returns, self._cov, self.risk_free_rate)
 
-        portfolio_volatility = np.sqrt(np.dot(weights.T, np.dot(cov_matrix, weights)))
-        sharpe_ratio = (expected_returns - self.risk_free_rate) / portfolio_volatility
-        return  -sharpe_ratio
+    # Gradient of the negative Sharpe ratio with respect to the weights
+    def sharpe_ratio_gradient(self, weights):
+        return _negative_sharpe_gradient(weights, self._expected_returns, self._cov, self.risk_free_rate)
 
     # Create a function to run shape ration optimization (maximize)
-    def run_optimization(self):
-        num_assets = len(self.annualized_returns)
+    def run_optimization(self, initial_weights: np.ndarray = None):
+        num_assets = len(self._expected_returns)
 
-        # Start with equal weights for all assets
-        initial_weights = np.ones(num_assets) / num_assets
+        # Start with equal weights for all assets unless a warm start is given
+        if initial_weights is None:
+            initial_weights = np.ones(num_assets) / num_assets
 
         # Set bounds for each asset's weight: must be between 0 and 1
         bounds = tuple((0,1) for _ in range(num_assets))
 
-        # Constraint: weights must sum to 1 to be a fully invested portfolio
-        constraints = {'type': 'eq', 'fun': lambda  w:np.sum(w) - 1} # rewrite this!
-
-        result = minimize(
-            fun = self.optimize_sharpe_ratio,
-            x0 = initial_weights,
-            method= 'SLSQP',
-            bounds = bounds,
-            constraints = constraints
-        )
+        with span('optimizer.run_optimization', rows=num_assets) as stage:
+            result = _minimize(
+                fun = self.optimize_sharpe_ratio,
+                x0 = initial_weights,
+                jac = self.sharpe_ratio_gradient,
+                method= 'SLSQP',
+                bounds = bounds,
+                constraints = _FULLY_INVESTED
+            )
+            stage.set(iterations=result.nit, function_evaluations=result.nfev, success=bool(result.success))
         if result.success:
             return result.x # Optimized weight
         else:
@@ -79,42 +266,92 @@ class PortfolioOptimizer:
 
     # Crete a function to minimize volatility
     def optimize_volatility(self, weights):
-        cov_matrix = self.annualized_cov
-        portfolio_variance = np.dot(weights.T, np.dot(cov_matrix, weights))
-        volatility = np.sqrt(portfolio_variance)
-
-        return volatility
+        return _portfolio_volatility(weights, self._cov)
 
+    # Gradient of the portfolio volatility with respect to the weights
+    def volatility_gradient(self, weights):
+        return _volatility_gradient(weights, self._cov)
 
     # Create a function to minimize volatility
-    def min_volatility(self):
-        num_assets = len(self.annualized_returns)
-        # Start with equal weights for all assets
-        initial_weights = np.ones(num_assets) / num_assets
+    def min_volatility(self, initial_weights: np.ndarray = None):
+        num_assets = len(self._expected_returns)
+        # Start with equal weights for all assets unless a warm start is given
+        if initial_weights is None:
+            initial_weights = np.ones(num_assets) / num_assets
 
         # Set bounds for each asset's weight: must be between 0 and 1
         bounds = tuple((0, 1) for _ in range(num_assets))
 
-        # Constraint: weights must sum to 1 to be a fully invested portfolio
-        constraints = {'type': 'eq', 'fun': lambda w: np.sum(w) - 1}  # rewrite this!
-
-        result = minimize(fun=self.optimize_volatility,
-                 x0=initial_weights,
-                 method='SLSQP',
-                 bounds=bounds,
-                 constraints=constraints
-                 )
+        with span('optimizer.min_volatility', rows=num_assets) as stage:
+            result = _minimize(fun=self.optimize_volatility,
+                     x0=initial_weights,
+                     jac=self.volatility_gradient,
+                     method='SLSQP',
+                     bounds=bounds,
+                     constraints=_FULLY_INVESTED
+                     )
+            stage.set(iterations=result.nit, function_evaluations=result.nfev, success=bool(result.success))
         if result.success:
             return result.x  # Optimized weight
         else:
             raise ValueError("Optimization failed" + result.message)
 
+    # Create a function to trace the efficient frontier.
+    # Target returns run from the minimum-volatility portfolio up to the best
+    # single asset. By default they are solved serially, each warm-started from
+    # the previous point; processes > 1 (None for one per CPU) solves contiguous
+    # segments in parallel processes. A pool costs process start-up plus a copy
+    # of the covariance per worker (~0.1 s), so it only pays off when the serial
+    # frontier takes seconds, i.e. for universes of a hundred or more assets.
+    def efficient_frontier(self, n_points: int = 100, processes: int = 1) -> pd.DataFrame:
+        min_vol_weights = self.min_volatility()
+        lowest_return = min_vol_weights @ self._expected_returns
+        highest_return = self._expected_returns.max()
+        target_returns = np.linspace(lowest_return, highest_return, n_points)
+
+        n_segments = max(1, min(processes or os.cpu_count() or 1, n_points))
+        segments = np.array_split(target_returns, n_segments)
+        if n_segments == 1:
+            solutions = _solve_frontier_segment(self._expected_returns, self._cov, target_returns, min_vol_weights)
+        else:
+            with ProcessPoolExecutor(max_workers=n_segments, initializer=_init_worker,
+                                     initargs=(self._expected_returns, self._cov)) as pool:
+                segment_solutions = pool.map(_solve_frontier_segment_in_worker, segments,
+                                             [min_vol_weights] * n_segments)
+                solutions = [weights for segment in segment_solutions for weights in segment]
+
+        weights = np.vstack(solutions)
+        volatility = np.sqrt(np.einsum('ij,ij->i', weights @ self._cov, weights))
+        frontier = pd.DataFrame({
+            'target_return': target_returns,
+            'volatility': volatility,
+            'sharpe_ratio': (target_returns - self.risk_free_rate) / volatility
+        })
+        return pd.concat([frontier, pd.DataFrame(weights, columns=self.annualized_returns.index)], axis=1)
+
+    # Create a function to simulate random long-only portfolios.
+    # Weights are drawn and scored chunk by chunk, so working memory depends on
+    # chunk_size only; each chunk has its own seed, so results are the same
+    # for a given seed whether or not chunks run in parallel processes.
+    # n_portfolios=0 gives an empty frame with the same columns.
+    def simulate_random_portfolios(self, n_portfolios: int, chunk_size: int = 100_000,
+                                   seed: int = None, processes: int = 1) -> pd.DataFrame:
+        if n_portfolios < 0:
+            raise ValueError("n_portfolios must not be negative")
+        columns = ['expected_return', 'volatility', 'sharpe_ratio']
+        if n_portfolios == 0:
+            return pd.DataFrame({column: np.empty(0) for column in columns})
+        chunk_sizes = [min(chunk_size, n_portfolios - start) for start in range(0, n_portfolios, chunk_size)]
+        seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+        if processes == 1:
+            chunks = [_simulate_chunk(self._expected_returns, self._cov, self.risk_free_rate, size, seed_sequence)
+                      for size, seed_sequence in zip(chunk_sizes, seed_sequences)]
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                     initargs=(self._expected_returns, self._cov)) as pool:
+                chunks = list(pool.map(_simulate_chunk_in_worker, [self.risk_free_rate] * len(chunk_sizes),
+                                       chunk_sizes, seed_sequences))
 
-
-
-
-
-
-
-
-
+        return pd.DataFrame({column: np.concatenate([chunk[i] for chunk in chunks])
+                             for i, column in enumerate(columns)})
@@ -0,0 +1,260 @@
+''' Prefix-sum statistics index for metrics over arbitrary date ranges. For every
+price date it keeps the running totals, per ticker, of daily returns, squared
+returns, log growth and the number of returns, and (optionally) of the
+cross-products of every ticker pair. The mean, variance, covariance and
+cumulative return of any window then come from the difference of two rows
+instead of a pass over the prices.
+
+A window [start, end] covers the daily returns dated start to end inclusive,
+the same returns PortfolioAnalyzer computes from the prices of the trading day
+before start through end. Each ticker is indexed from its own first price:
+gaps are forward-filled and a ticker without a price yet simply adds no return,
+so a late listing does not shorten the history of the others. A window must lie
+within the indexed dates. The cross-products take (dates x tickers^2 / 2)
+floats, e.g. 200 MB for 100 tickers over 20 years; build the index with
+cross_products=False when only per-ticker metrics are needed.
+
+The index is persisted next to adjusted_prices by db_setup (save_prefix_stats,
+load_prefix_stats) and extended each night by update_prefix_stats; run
+`python prefix_stats.py` from cron for that. prefix_range_metrics and
+prefix_range_covariance answer a window from the two stored boundary rows.'''
+
+import argparse
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from price_matrix import PriceMatrix, as_price_matrix
+
+
+class PrefixStats:
+    STATISTICS = ('sums', 'squares', 'log_growth', 'counts', 'cross_products')
+
+    # Running totals through each date (row i includes dates[i]); `initial` is
+    # the totals before dates[0], zero for an index built from the first price.
+    # last_prices are the latest (forward-filled) prices, dated last_price_date,
+    # from which the next extend() computes its first return.
+    def __init__(self, tickers, dates, sums: np.ndarray, squares: np.ndarray, log_growth: np.ndarray,
+                 counts: np.ndarray, cross_products: Optional[np.ndarray] = None, initial: Optional[dict] = None,
+                 last_prices: Optional[np.ndarray] = None, last_price_date=None):
+        self.tickers = pd.Index(tickers)
+        self.dates = pd.Index(dates)
+        self.sums = sums # dates x tickers
+        self.squares = squares # dates x tickers
+        self.log_growth = log_growth # dates x tickers, sum of log(1 + r)
+        self.counts = counts # dates x tickers, number of returns
+        self.cross_products = cross_products # dates x pairs, pairs in np.triu_indices order
+        self.pairs = np.triu_indices(len(self.tickers), 1)
+        n_tickers = len(self.tickers)
+        self.initial = initial or {
+            'sums': np.zeros(n_tickers),
+            'squares': np.zeros(n_tickers),
+            'log_growth': np.zeros(n_tickers),
+            'counts': np.zeros(n_tickers, dtype=np.int64),
+            'cross_products': None if cross_products is None else np.zeros(len(self.pairs[0])),
+        }
+        self.last_prices = last_prices
+        self.last_price_date = last_price_date
+
+    # An index with no dates yet, to be filled by extend().
+    @classmethod
+    def empty(cls, tickers, cross_products: bool = True) -> 'PrefixStats':
+        return cls(tickers, pd.DatetimeIndex([]), *_empty(len(tickers), cross_products))
+
+    # Build the index from a wide (date x ticker) price frame or a PriceMatrix.
+    @classmethod
+    def from_prices(cls, price_data, cross_products: bool = True) -> 'PrefixStats':
+        prices = as_price_matrix(price_data)
+        stats = cls.empty(prices.tickers, cross_products)
+        stats.extend(prices)
+        return stats
+
+    @property
+    def has_cross_products(self) -> bool:
+        return self.cross_products is not None
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    # Append the prices dated after the last indexed date; earlier rows are
+    # ignored. The tickers are fixed: new columns are dropped, missing ones are
+    # treated as no new price (forward-filled). Every price date becomes a row,
+    # the returns of tickers without an earlier price count as missing. Returns
+    # the number of dates added.
+    def extend(self, price_data) -> int:
+        prices = as_price_matrix(price_data).to_frame()
+        if self.last_price_date is not None:
+            prices = prices[prices.index > self.last_price_date]
+        prices = prices.reindex(columns=self.tickers)
+        if prices.empty:
+            return 0
+        self.last_price_date = prices.index[-1]
+        # Seed with the last known prices so the first new bar has a return.
+        seed = self.last_prices if self.last_prices is not None else np.full(len(self.tickers), np.nan)
+        filled = PriceMatrix(np.vstack([seed, prices.to_numpy(dtype=float)]), self.tickers,
+                             prices.index.insert(0, pd.NaT)).ffill().values
+        self.last_prices = filled[-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = filled[1:] / filled[:-1] - 1
+        valid = ~np.isnan(returns)
+        returns[~valid] = 0 # missing returns add nothing to the totals
+
+        new_rows = {
+            'sums': returns,
+            'squares': returns * returns,
+            'log_growth': np.log1p(returns),
+            'counts': valid.astype(np.int64),
+        }
+        if self.has_cross_products:
+            new_rows['cross_products'] = returns[:, self.pairs[0]] * returns[:, self.pairs[1]]
+        for name, rows in new_rows.items():
+            totals = getattr(self, name)
+            previous = totals[-1] if len(totals) else self.initial[name]
+            cumulative = np.cumsum(rows, axis=0)
+            cumulative += previous
+            setattr(self, name, np.concatenate([totals, cumulative]))
+        self.dates = self.dates.append(prices.index)
+        return len(prices)
+
+    # Keep only the extension state: the totals of the last date become the
+    # starting point and the rows are released (e.g. once they are saved).
+    def compact(self):
+        if not len(self.dates):
+            return
+        for name in self.STATISTICS:
+            totals = getattr(self, name)
+            if totals is not None:
+                self.initial[name] = totals[-1].copy()
+                setattr(self, name, totals[:0].copy())
+        self.dates = self.dates[:0]
+
+    # Row positions (first, last + 1) of the dates in [start, end], which must
+    # lie within the indexed dates.
+    def _window(self, start=None, end=None) -> tuple:
+        if not len(self.dates):
+            raise ValueError("The index has no dates")
+        check_window(start, end, self.dates[0], self.dates[-1])
+        first = 0 if start is None else self.dates.searchsorted(pd.Timestamp(start), side='left')
+        last = len(self.dates) if end is None else self.dates.searchsorted(pd.Timestamp(end), side='right')
+        return first, last
+
+    # Totals of the statistics over rows [first, last): two lookups each.
+    def _totals(self, first: int, last: int, names) -> dict:
+        totals = {}
+        for name in names:
+            values = getattr(self, name)
+            before = values[first - 1] if first > 0 else self.initial[name]
+            totals[name] = values[last - 1] - before if last > first else np.zeros_like(before)
+        return totals
+
+    # Annualized return, volatility and Sharpe ratio and the cumulative return
+    # of every ticker over [start, end], in the layout of compute_all_metrics
+    # (without the max drawdown, which prefix sums cannot give).
+    def range_metrics(self, start=None, end=None, risk_free_rate: float = 0.03) -> pd.DataFrame:
+        first, last = self._window(start, end)
+        totals = self._totals(first, last, ('sums', 'squares', 'log_growth', 'counts'))
+        return metrics_from_totals(self.tickers, totals, risk_free_rate)
+
+    # Annualized sample covariance over [start, end].
+    def range_covariance(self, start=None, end=None) -> pd.DataFrame:
+        if not self.has_cross_products:
+            raise ValueError("This index was built without cross-products")
+        first, last = self._window(start, end)
+        totals = self._totals(first, last, ('sums', 'squares', 'counts', 'cross_products'))
+        return covariance_from_totals(self.tickers, totals)
+
+    # Optimizer for the window, without recomputing returns from prices.
+    def range_optimizer(self, start=None, end=None, risk_free_rate: float = 0.03):
+        from portfolio_optimizer import PortfolioOptimizer
+        metrics = self.range_metrics(start, end, risk_free_rate)
+        return PortfolioOptimizer.from_moments(metrics['annualized_return'], self.range_covariance(start, end),
+                                               risk_free_rate)
+
+
+# Raise unless [start, end] lies within the indexed dates [first_date, last_date].
+def check_window(start, end, first_date, last_date):
+    first_date, last_date = pd.Timestamp(first_date), pd.Timestamp(last_date)
+    if start is not None and pd.Timestamp(start) < first_date:
+        raise ValueError(f"Window start {pd.Timestamp(start).date()} is before the first indexed date "
+                         f"{first_date.date()}")
+    if end is not None and pd.Timestamp(end) > last_date:
+        raise ValueError(f"Window end {pd.Timestamp(end).date()} is after the last indexed date "
+                         f"{last_date.date()}")
+    if start is not None and end is not None and pd.Timestamp(start) > pd.Timestamp(end):
+        raise ValueError(f"Window start {start} is after its end {end}")
+
+
+# Window metrics from the totals of the window (end row minus the row before
+# it), shared by PrefixStats and the database lookups. Each ticker uses its own
+# number of returns; tickers with fewer than two get NaN.
+def metrics_from_totals(tickers, totals: dict, risk_free_rate: float = 0.03) -> pd.DataFrame:
+    counts = np.asarray(totals['counts'], dtype=float)
+    if not (counts >= 2).any():
+        raise ValueError("Fewer than two returns in the window")
+    n_days = np.where(counts >= 2, counts, np.nan)
+    mean = totals['sums'] / n_days
+    variance = (totals['squares'] - n_days * mean * mean) / (n_days - 1)
+    annualized_return = mean * 252
+    annualized_volatility = np.sqrt(np.maximum(variance, 0) * 252)
+    return pd.DataFrame({
+        "cumulative_return": np.where(counts >= 2, np.exp(totals['log_growth']), np.nan),
+        "annualized_return": annualized_return,
+        "annualized_volatility": annualized_volatility,
+        "sharpe_ratio": (annualized_return - risk_free_rate) / annualized_volatility,
+    }, index=tickers)
+
+
+# Annualized sample covariance from window totals; cross_products are in
+# np.triu_indices(len(tickers), 1) order. Every ticker needs a return on every
+# date of the window so the pairs share one sample.
+def covariance_from_totals(tickers, totals: dict) -> pd.DataFrame:
+    counts = np.asarray(totals['counts'])
+    n_days = int(counts.max()) if len(counts) else 0
+    short = [str(ticker) for ticker, count in zip(tickers, counts) if count < n_days]
+    if short:
+        raise ValueError(f"Tickers without a return on every date of the window: {', '.join(short)}; "
+                         f"start the window after their first price")
+    if n_days < 2:
+        raise ValueError("Fewer than two returns in the window")
+    n_tickers = len(tickers)
+    pairs = np.triu_indices(n_tickers, 1)
+    mean = totals['sums'] / n_days
+    co_moments = np.empty((n_tickers, n_tickers))
+    co_moments[pairs] = totals['cross_products']
+    co_moments.T[pairs] = co_moments[pairs]
+    np.fill_diagonal(co_moments, totals['squares'])
+    covariance = (co_moments - n_days * np.outer(mean, mean)) / (n_days - 1) * 252
+    return pd.DataFrame(covariance, index=tickers, columns=tickers)
+
+
+def _empty(n_tickers: int, cross_products: bool) -> tuple:
+    n_pairs = n_tickers * (n_tickers - 1) // 2
+    empty = [np.empty((0, n_tickers)) for _ in range(3)]
+    counts = np.empty((0, n_tickers), dtype=np.int64)
+    return (*empty, counts, np.empty((0, n_pairs)) if cross_products else None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extend the prefix-sum statistics index in the database '
+                                                 'with the prices saved since the last run')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the index from every price in adjusted_prices')
+    parser.add_argument('--tickers', nargs='+',
+                        help='tickers to index (default: every ticker in adjusted_prices)')
+    parser.add_argument('--no-cross-products', action='store_true',
+                        help='rebuild without pair cross-products (no range covariance)')
+    args = parser.parse_args(argv)
+
+    from db_setup import create_tables, rebuild_prefix_stats, update_prefix_stats
+    create_tables()
+    if args.rebuild:
+        rows = rebuild_prefix_stats(args.tickers, cross_products=not args.no_cross_products)
+    else:
+        rows = update_prefix_stats(args.tickers)
+    print(f"Prefix statistics: {rows} new date(s) indexed")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
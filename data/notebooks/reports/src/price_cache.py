@@ -0,0 +1,153 @@
+''' The PriceCache class keeps adjusted close prices on disk (one Parquet file per
+ticker) together with the date ranges that have already been downloaded, so the
+StockDataFetcher only has to request the missing pieces from the data source.
+Loads and stores only update the in-memory manifest; flush() evicts and writes
+it, once per fetch.'''
+
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+
+DateRange = Tuple[pd.Timestamp, pd.Timestamp]  # half-open [start, end), like yfinance
+
+
+class PriceCache:
+    def __init__(self, cache_dir: str = 'price_cache', max_bytes: int = 500 * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._manifest_path = os.path.join(self.cache_dir, 'manifest.json')
+        self._manifest = self._read_manifest()
+        self._dirty = False # manifest changed since the last write
+        self._stored = set() # tickers stored since the last flush, never evicted by it
+
+    # Return the date ranges inside [start, end) that are not cached yet for a ticker.
+    def missing_ranges(self, ticker: str, start, end) -> List[DateRange]:
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        missing = []
+        cursor = start
+        for covered_start, covered_end in self._coverage(ticker):
+            if covered_end <= cursor:
+                continue
+            if covered_start >= end:
+                break
+            if covered_start > cursor:
+                missing.append((cursor, covered_start))
+            cursor = max(cursor, covered_end)
+        if cursor < end:
+            missing.append((cursor, end))
+        return missing
+
+    # Load the cached prices of one ticker for [start, end).
+    def load(self, ticker: str, start, end) -> pd.Series:
+        path = self._path(ticker)
+        if not os.path.exists(path):
+            return pd.Series(dtype=float, name=ticker)
+        prices = pd.read_parquet(path)[ticker]
+        self._touch(ticker)
+        return prices[(prices.index >= pd.Timestamp(start)) & (prices.index < pd.Timestamp(end))]
+
+    # Merge newly downloaded prices for [start, end) into the cache.
+    def store(self, ticker: str, prices: pd.Series, start, end):
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        # Today's bar may still change, so coverage never extends past yesterday.
+        end = min(end, pd.Timestamp.today().normalize())
+        if end <= start:
+            return
+
+        prices = prices.dropna().astype(float).rename(ticker)
+        prices.index = pd.to_datetime(prices.index)
+        path = self._path(ticker)
+        if os.path.exists(path):
+            existing = pd.read_parquet(path)[ticker]
+            prices = pd.concat([existing, prices])
+            prices = prices[~prices.index.duplicated(keep='last')]
+        prices.sort_index().to_frame().to_parquet(path)
+
+        entry = self._manifest.setdefault(ticker, {'coverage': []})
+        coverage = self._coverage(ticker) + [(start, end)]
+        entry['coverage'] = [[s.isoformat(), e.isoformat()] for s, e in _merge_ranges(coverage)]
+        entry['last_access'] = time.time()
+        self._stored.add(ticker)
+        self._dirty = True
+
+    # Evict down to max_bytes and write the manifest if it changed since the
+    # last flush. StockDataFetcher calls this once at the end of a fetch.
+    def flush(self):
+        if self._stored:
+            self.evict(keep=self._stored)
+            self._stored = set()
+        if self._dirty:
+            self._write_manifest()
+
+    # Drop cached prices for the given tickers, or everything when tickers is None.
+    def invalidate(self, tickers: Optional[List[str]] = None):
+        tickers = list(self._manifest) if tickers is None else [t.upper() for t in tickers]
+        for ticker in tickers:
+            self._manifest.pop(ticker, None)
+            path = self._path(ticker)
+            if os.path.exists(path):
+                os.remove(path)
+        self._write_manifest()
+
+    # Remove least recently used tickers until the cache fits in max_bytes.
+    def evict(self, keep: Optional[List[str]] = None):
+        keep = set(keep or [])
+        sizes = {t: os.path.getsize(self._path(t)) for t in self._manifest if os.path.exists(self._path(t))}
+        total = sum(sizes.values())
+        by_age = sorted(sizes, key=lambda t: self._manifest[t].get('last_access', 0))
+        evicted = []
+        for ticker in by_age:
+            if total <= self.max_bytes:
+                break
+            if ticker in keep:
+                continue
+            total -= sizes[ticker]
+            evicted.append(ticker)
+        if evicted:
+            self.invalidate(evicted)
+
+    # Total size of the cached price files in bytes.
+    def size_bytes(self) -> int:
+        return sum(os.path.getsize(self._path(t)) for t in self._manifest if os.path.exists(self._path(t)))
+
+    def _coverage(self, ticker: str) -> List[DateRange]:
+        entry = self._manifest.get(ticker, {})
+        return [(pd.Timestamp(s), pd.Timestamp(e)) for s, e in entry.get('coverage', [])]
+
+    def _touch(self, ticker: str):
+        if ticker in self._manifest:
+            self._manifest[ticker]['last_access'] = time.time()
+            self._dirty = True
+
+    def _path(self, ticker: str) -> str:
+        return os.path.join(self.cache_dir, f'{ticker}.parquet')
+
+    def _read_manifest(self) -> Dict:
+        try:
+            with open(self._manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_manifest(self):
+        tmp_path = self._manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, self._manifest_path)
+        self._dirty = False
+
+
+# Merge overlapping or touching date ranges.
+def _merge_ranges(ranges: List[DateRange]) -> List[DateRange]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
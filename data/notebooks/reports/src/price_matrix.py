@@ -0,0 +1,110 @@
+''' Compact array-backed price (or return) matrix for the analysis hot paths. A
+PriceMatrix is a float64 or float32 ndarray of shape (dates x tickers) plus the
+ticker and date indexes. Date ranges and runs of adjacent tickers are zero-copy
+views of the same buffer, and DataFrames are only built at the API boundary
+(to_frame wraps the buffer without copying).'''
+
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class PriceMatrix:
+    __slots__ = ('values', 'tickers', 'dates')
+
+    def __init__(self, values: np.ndarray, tickers, dates):
+        values = np.asarray(values)
+        if values.ndim != 2 or values.shape != (len(dates), len(tickers)):
+            raise ValueError(f"values of shape {values.shape} do not match "
+                             f"{len(dates)} dates x {len(tickers)} tickers")
+        if values.dtype not in (np.float64, np.float32):
+            values = values.astype(np.float64)
+        self.values = values # dates x tickers
+        self.tickers = pd.Index(tickers)
+        self.dates = pd.Index(dates)
+
+    # Wrap a wide (date x ticker) frame. A single-dtype frame of the requested
+    # dtype is not copied; anything else is converted once into a contiguous array.
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, dtype=np.float64) -> 'PriceMatrix':
+        values = frame.to_numpy(dtype=dtype)
+        if not (values.flags.c_contiguous or values.flags.f_contiguous):
+            values = np.ascontiguousarray(values)
+        return cls(values, frame.columns, frame.index)
+
+    # DataFrame view of the matrix (no copy); it shares memory with this matrix.
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values, index=self.dates, columns=self.tickers, copy=False)
+
+    @property
+    def shape(self) -> tuple:
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __repr__(self) -> str:
+        span = f", {self.dates[0]} to {self.dates[-1]}" if len(self.dates) else ""
+        return f"PriceMatrix({len(self.dates)} dates x {len(self.tickers)} tickers, {self.dtype}{span})"
+
+    def astype(self, dtype) -> 'PriceMatrix':
+        if self.values.dtype == dtype:
+            return self
+        return PriceMatrix(self.values.astype(dtype), self.tickers, self.dates)
+
+    # Rows from start to end inclusive; the dates must be sorted. A view.
+    def between(self, start=None, end=None) -> 'PriceMatrix':
+        first = 0 if start is None else self.dates.searchsorted(start, side='left')
+        last = len(self.dates) if end is None else self.dates.searchsorted(end, side='right')
+        return PriceMatrix(self.values[first:last], self.tickers, self.dates[first:last])
+
+    # Column subset in the given order. A run of adjacent tickers stays a view;
+    # other selections are copied.
+    def select(self, tickers: List[str]) -> 'PriceMatrix':
+        positions = self.tickers.get_indexer(tickers)
+        if (positions < 0).any():
+            missing = [ticker for ticker, position in zip(tickers, positions) if position < 0]
+            raise KeyError(f"Tickers not in matrix: {', '.join(map(str, missing))}")
+        columns = positions
+        if len(positions) and (np.diff(positions) == 1).all():
+            columns = slice(positions[0], positions[-1] + 1)
+        return PriceMatrix(self.values[:, columns], self.tickers[positions], self.dates)
+
+    # One ticker's history as a 1-D view.
+    def column(self, ticker) -> np.ndarray:
+        return self.values[:, self.tickers.get_loc(ticker)]
+
+    # Forward-fill missing prices with the last known one (leading gaps stay NaN).
+    def ffill(self) -> 'PriceMatrix':
+        missing = np.isnan(self.values)
+        if not missing.any():
+            return self
+        rows = np.where(missing, 0, np.arange(len(self.values))[:, None])
+        np.maximum.accumulate(rows, axis=0, out=rows)
+        return PriceMatrix(np.take_along_axis(self.values, rows, axis=0), self.tickers, self.dates)
+
+    # Simple daily returns in the same dtype, dated by the later price. Like
+    # prices.pct_change().dropna(): gaps are forward-filled first and dates where
+    # any ticker still has no return (before its first price) are dropped.
+    def returns(self) -> 'PriceMatrix':
+        prices = self.ffill().values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = prices[1:] / prices[:-1]
+        returns -= 1
+        dates = self.dates[1:]
+        complete = ~np.isnan(returns).any(axis=1)
+        if not complete.all():
+            returns, dates = returns[complete], dates[complete]
+        return PriceMatrix(returns, self.tickers, dates)
+
+
+# Accept either representation at the API boundary.
+def as_price_matrix(prices, dtype: Optional[type] = None) -> PriceMatrix:
+    if isinstance(prices, PriceMatrix):
+        return prices if dtype is None else prices.astype(dtype)
+    return PriceMatrix.from_frame(prices, dtype or np.float64)
@@ -0,0 +1,66 @@
+''' Binary storage for wide price frames. A store is a directory holding the raw
+price matrix as a column-major .npy file (each ticker's history is contiguous)
+plus the dates and tickers as sidecar files. Loading memory-maps the matrix, so
+only the selected tickers and date range are read from disk and an unfiltered
+or date-sliced load is a zero-copy view.'''
+
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from price_matrix import PriceMatrix
+
+
+PRICES_FILE = 'prices.npy'
+DATES_FILE = 'dates.npy'
+TICKERS_FILE = 'tickers.json'
+
+
+# Save a wide (date x ticker) price frame or a PriceMatrix; dtype=np.float32 halves the size.
+def save_price_matrix(price_data: pd.DataFrame, path: str, dtype=np.float64):
+    if isinstance(price_data, PriceMatrix):
+        price_data = price_data.to_frame()
+    os.makedirs(path, exist_ok=True)
+    values = np.asfortranarray(price_data.to_numpy(dtype=dtype))
+    np.save(os.path.join(path, PRICES_FILE), values)
+    np.save(os.path.join(path, DATES_FILE), pd.to_datetime(price_data.index).to_numpy(dtype='datetime64[ns]'))
+    with open(os.path.join(path, TICKERS_FILE), 'w') as f:
+        json.dump([str(ticker) for ticker in price_data.columns], f)
+
+
+# Load prices as a DataFrame, optionally projected to some tickers and sliced
+# to [start, end]. The returned frame may be backed by a read-only memory map:
+# copy it before modifying values in place.
+def load_price_matrix(path: str, tickers: Optional[List[str]] = None, start=None, end=None) -> pd.DataFrame:
+    return open_price_matrix(path, tickers, start, end).to_frame()
+
+
+# Same as load_price_matrix, returned as a PriceMatrix that PortfolioAnalyzer
+# accepts directly, without going through a DataFrame.
+def open_price_matrix(path: str, tickers: Optional[List[str]] = None, start=None, end=None) -> PriceMatrix:
+    values = np.load(os.path.join(path, PRICES_FILE), mmap_mode='r')
+    dates = np.load(os.path.join(path, DATES_FILE))
+    with open(os.path.join(path, TICKERS_FILE)) as f:
+        all_tickers = json.load(f)
+
+    first = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+    last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+
+    if tickers is None:
+        columns = slice(None)
+        selected_tickers = all_tickers
+    else:
+        position = {ticker: i for i, ticker in enumerate(all_tickers)}
+        missing = [ticker for ticker in tickers if ticker not in position]
+        if missing:
+            raise KeyError(f"Tickers not in store: {', '.join(missing)}")
+        columns = [position[ticker] for ticker in tickers]
+        selected_tickers = list(tickers)
+        # A run of adjacent tickers can stay a view instead of a copy.
+        if columns == list(range(columns[0], columns[0] + len(columns))):
+            columns = slice(columns[0], columns[0] + len(columns))
+
+    return PriceMatrix(values[first:last, columns], selected_tickers, pd.DatetimeIndex(dates[first:last]))
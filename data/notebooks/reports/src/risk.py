@@ -0,0 +1,197 @@
+''' Tail-risk metrics for many assets (or portfolios) at once. Every function
+takes a (days x series) array of daily returns, one column per asset or
+portfolio, and works on all columns together.
+
+VaR and CVaR are daily and reported as positive losses: at confidence 0.95 the
+VaR is the loss exceeded on 5% of days and the CVaR is the average loss on those
+days. Three methods are available:
+    historical       empirical quantile, found with np.partition (no full sort)
+    parametric       normal distribution fitted to the mean and volatility
+    cornish_fisher   normal quantile adjusted for skewness and excess kurtosis
+Returns are expected to be free of NaNs, as PortfolioAnalyzer produces them.'''
+
+from statistics import NormalDist
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _as_2d(returns) -> np.ndarray:
+    returns = np.asarray(returns, dtype=float)
+    return returns[:, None] if returns.ndim == 1 else returns
+
+
+# Daily returns of one weight vector or a (portfolios x assets) weight matrix.
+def portfolio_returns(returns, weights) -> np.ndarray:
+    return _as_2d(returns) @ np.atleast_2d(np.asarray(weights, dtype=float)).T
+
+
+# Number of observations in the tail: the worst ceil((1 - confidence) * n) days.
+def _tail_size(n_days: int, confidence: float) -> int:
+    return min(n_days, max(1, int(np.ceil((1 - confidence) * n_days - 1e-9))))
+
+
+# One partial selection gives both measures: after np.partition the first k rows
+# are the k worst days (unordered) and row k-1 is the k-th worst.
+def historical_var_cvar(returns, confidence: float = 0.95) -> tuple:
+    returns = _as_2d(returns)
+    k = _tail_size(len(returns), confidence)
+    tail = np.partition(returns, k - 1, axis=0)[:k]
+    return -tail[k - 1], -tail.mean(axis=0)
+
+
+def parametric_var_cvar(returns, confidence: float = 0.95) -> tuple:
+    returns = _as_2d(returns)
+    mean = returns.mean(axis=0)
+    volatility = returns.std(axis=0, ddof=1)
+    return _normal_var_cvar(mean, volatility, confidence)
+
+
+def _normal_var_cvar(mean, volatility, confidence: float) -> tuple:
+    alpha = 1 - confidence
+    z = NormalDist().inv_cdf(alpha)
+    var = -(mean + z * volatility)
+    cvar = -(mean - volatility * NormalDist().pdf(z) / alpha)
+    return var, cvar
+
+
+# Cornish-Fisher quantile z + (z^2-1)S/6 + (z^3-3z)K/24 - (2z^3-5z)S^2/36 of the
+# standardized returns. It is linear in S, K and S^2, so only the coefficients
+# depend on the normal quantile z.
+def _cornish_fisher_coefficients(z) -> np.ndarray:
+    z = np.asarray(z, dtype=float)
+    return np.array([z, (z ** 2 - 1) / 6, (z ** 3 - 3 * z) / 24, -(2 * z ** 3 - 5 * z) / 36])
+
+
+# The CVaR averages the adjusted quantile over the tail probabilities
+# (midpoint rule on a fixed grid), so it is consistent with the VaR.
+def _cornish_fisher_var_cvar(mean, volatility, skewness, excess_kurtosis, confidence: float,
+                             grid_size: int = 200) -> tuple:
+    alpha = 1 - confidence
+    normal = NormalDist()
+    tail_probabilities = (np.arange(grid_size) + 0.5) / grid_size * alpha
+    tail = _cornish_fisher_coefficients([normal.inv_cdf(p) for p in tail_probabilities]).mean(axis=1)
+    at_var = _cornish_fisher_coefficients(normal.inv_cdf(alpha))
+    terms = (1, skewness, excess_kurtosis, skewness ** 2)
+    quantile = sum(c * term for c, term in zip(at_var, terms))
+    tail_quantile = sum(c * term for c, term in zip(tail, terms))
+    return -(mean + quantile * volatility), -(mean + tail_quantile * volatility)
+
+
+def cornish_fisher_var_cvar(returns, confidence: float = 0.95) -> tuple:
+    returns = _as_2d(returns)
+    mean = returns.mean(axis=0)
+    centered = returns - mean
+    squared = centered * centered # integer powers above 2 go through the slow generic pow
+    variance = squared.mean(axis=0)
+    skewness = np.einsum('ij,ij->j', squared, centered) / len(returns) / variance ** 1.5
+    excess_kurtosis = np.einsum('ij,ij->j', squared, squared) / len(returns) / variance ** 2 - 3
+    return _cornish_fisher_var_cvar(mean, returns.std(axis=0, ddof=1), skewness, excess_kurtosis, confidence)
+
+
+METHODS = {
+    'historical': historical_var_cvar,
+    'parametric': parametric_var_cvar,
+    'cornish_fisher': cornish_fisher_var_cvar,
+}
+
+
+# VaR and CVaR of every column with the named method.
+def var_cvar(returns, confidence: float = 0.95, method: str = 'historical') -> tuple:
+    if method not in METHODS:
+        raise ValueError(f"Unknown VaR method: {method}. Choose from {', '.join(METHODS)}")
+    if not 0 < confidence < 1:
+        raise ValueError("confidence must be between 0 and 1")
+    return METHODS[method](returns, confidence)
+
+
+# VaR and CVaR over trailing windows, evaluated every `step` days; row i covers
+# days [i*step, i*step + window). Parametric and Cornish-Fisher use running sums
+# of powers of the returns (O(n) per column); historical partitions each window,
+# a few windows at a time so memory stays bounded.
+def rolling_var_cvar(returns, window: int = 252, confidence: float = 0.95, method: str = 'historical',
+                     step: int = 1, max_elements: int = 20_000_000) -> tuple:
+    returns = _as_2d(returns)
+    n_days, n_series = returns.shape
+    if window > n_days:
+        raise ValueError(f"window ({window}) is longer than the returns ({n_days} days)")
+    starts = np.arange(0, n_days - window + 1, step)
+
+    if method == 'historical':
+        k = _tail_size(window, confidence)
+        windows = sliding_window_view(returns, window, axis=0)[::step] # (windows, series, window) view
+        var = np.empty((len(starts), n_series))
+        cvar = np.empty((len(starts), n_series))
+        chunk = max(1, max_elements // (n_series * window))
+        for first in range(0, len(starts), chunk):
+            tail = np.partition(windows[first:first + chunk], k - 1, axis=-1)[..., :k]
+            var[first:first + chunk] = -tail[..., k - 1]
+            cvar[first:first + chunk] = -tail.mean(axis=-1)
+        return var, cvar
+
+    if method not in METHODS:
+        raise ValueError(f"Unknown VaR method: {method}. Choose from {', '.join(METHODS)}")
+    # Centre on the full-sample mean first so the power sums do not cancel badly.
+    centered = returns - returns.mean(axis=0)
+    prefix = np.zeros((n_days + 1, n_series))
+    power = np.ones_like(centered)
+    moments = []
+    for _ in range(2 if method == 'parametric' else 4):
+        power *= centered
+        np.cumsum(power, axis=0, out=prefix[1:])
+        moments.append((prefix[starts + window] - prefix[starts]) / window)
+    m1, m2 = moments[:2]
+    variance = np.maximum(m2 - m1 ** 2, 0) # population variance of the window
+    mean = m1 + returns.mean(axis=0)
+    volatility = np.sqrt(variance * window / (window - 1))
+    if method == 'parametric':
+        return _normal_var_cvar(mean, volatility, confidence)
+    m3, m4 = moments[2:]
+    third = m3 - 3 * m1 * m2 + 2 * m1 ** 3
+    fourth = m4 - 4 * m1 * m3 + 6 * m1 ** 2 * m2 - 3 * m1 ** 4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skewness = third / variance ** 1.5
+        excess_kurtosis = fourth / variance ** 2 - 3
+    return _cornish_fisher_var_cvar(mean, volatility, skewness, excess_kurtosis, confidence)
+
+
+# Drawdown curve and time under water for every column, in one pass over time.
+# Returns (drawdown, duration, peak_index): drawdown from the running peak,
+# days since that peak and the row of the peak, each (days x series).
+def drawdown_series(returns) -> tuple:
+    returns = _as_2d(returns)
+    wealth = np.cumprod(1 + returns, axis=0)
+    running_max = np.maximum.accumulate(wealth, axis=0)
+    days = np.arange(len(wealth))[:, None]
+    peak_index = np.maximum.accumulate(np.where(wealth >= running_max, days, 0), axis=0)
+    drawdown = (running_max - wealth) / running_max
+    return drawdown, days - peak_index, peak_index
+
+
+# Per-column drawdown statistics, all in O(days) per column:
+# max_drawdown, the peak/trough/recovery rows of the deepest drawdown,
+# recovery_days (trough to the first day back at the peak; recovery is -1 and
+# recovery_days NaN if not yet recovered or never in drawdown), max_duration (longest time under water, ongoing ones included)
+# and current_duration.
+def drawdown_statistics(returns) -> dict:
+    drawdown, duration, peak_index = drawdown_series(returns)
+    n_days, n_series = drawdown.shape
+    columns = np.arange(n_series)
+    trough = np.argmax(drawdown, axis=0)
+    peak = peak_index[trough, columns]
+    max_drawdown = drawdown[trough, columns]
+
+    # Recovered on the first day after the trough whose peak is a new one. A
+    # series that never fell has nothing to recover from.
+    recovered = (peak_index > peak) & (np.arange(n_days)[:, None] > trough)
+    has_recovered = recovered.any(axis=0) & (max_drawdown > 0)
+    recovery = np.where(has_recovered, np.argmax(recovered, axis=0), -1)
+    return {
+        'max_drawdown': max_drawdown,
+        'peak': peak,
+        'trough': trough,
+        'recovery': recovery,
+        'recovery_days': np.where(has_recovered, recovery - trough, np.nan),
+        'max_duration': duration.max(axis=0),
+        'current_duration': duration[-1],
+    }
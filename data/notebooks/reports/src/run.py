@@ -1,31 +1,34 @@
+import argparse
 import sys
 import os
 import numpy as np
-from db_setup import insert_adjusted_prices
 from data_pipeline import StockDataFetcher
 from analysis import PortfolioAnalyzer
 from portfolio_optimizer import PortfolioOptimizer
-from db_setup import save_performance_metrics, save_portfolio_allocations
-from database import get_engine
-from db_setup import create_tables
-from db_setup import clear_db_tables
 
 # Add the parent directory of src to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-# Clear tables if data exists prior to running the program
-if clear_db_tables():
-    sys.exit()
-
-# Ask the user if he wants to procedd with the analysis.
-proceed = input('Would you like to proceed with the Analysis? (yes/no): ').strip().lower()
-if proceed != 'yes':
-    print('Exiting program.')
-    sys.exit()
-
 
 
 def main():
+    # Database modules (and SQLAlchemy) are only loaded by the interactive run,
+    # not by `run.py --config`.
+    from db_setup import insert_adjusted_prices
+    from db_setup import save_performance_metrics, save_portfolio_allocations
+    from database import get_engine
+    from db_setup import create_tables
+    from db_setup import clear_db_tables
+
+    # Clear tables if data exists prior to running the program
+    if clear_db_tables():
+        sys.exit()
+
+    # Ask the user if he wants to procedd with the analysis.
+    proceed = input('Would you like to proceed with the Analysis? (yes/no): ').strip().lower()
+    if proceed != 'yes':
+        print('Exiting program.')
+        sys.exit()
 
     # Connect to the database:
     engine = get_engine()
@@ -134,7 +137,7 @@ def main():
 
 
     # Save metrics to the database
-    metrics_list = save_performance_metrics(price_data)
+    metrics_list = save_performance_metrics(price_data, metrics=analyzer.compute_all_metrics())
 
 
     # Save optimized portfolio allocations
@@ -166,4 +169,12 @@ def main():
 
 
 if __name__ == '__main__':
+    # `python run.py --config batch.json` runs the headless batch job instead
+    # of the interactive prompts (see batch_run.py).
+    parser = argparse.ArgumentParser(description='Portfolio analyzer')
+    parser.add_argument('--config', help='JSON batch config; runs without prompts')
+    args, batch_args = parser.parse_known_args()
+    if args.config:
+        import batch_run
+        sys.exit(batch_run.main(['--config', args.config] + batch_args))
     price_data = main()
\ No newline at end of file
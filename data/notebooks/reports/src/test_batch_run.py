@@ -0,0 +1,20 @@
+''' Tests for the batch runner's per-portfolio price selection. Run from this
+directory with `python -m pytest`.'''
+
+import numpy as np
+import pandas as pd
+
+from batch_run import _portfolio_prices
+
+
+# Regression: the portfolio slice included end_date although the fetch (like
+# yfinance) treats it as exclusive, so one portfolio could get one more day
+# than a fetch over its own range.
+def test_portfolio_prices_exclude_end_date():
+    dates = pd.bdate_range('2024-01-01', '2024-01-31')
+    prices = pd.DataFrame(np.arange(len(dates) * 2, dtype=float).reshape(-1, 2), index=dates, columns=['A', 'B'])
+    portfolio = {'tickers': ['B', 'NOPE'], 'start_date': '2024-01-03', 'end_date': '2024-01-10'}
+    selected = _portfolio_prices(prices, portfolio)
+    assert list(selected.columns) == ['B']
+    assert selected.index[0] == pd.Timestamp('2024-01-03')
+    assert selected.index[-1] == pd.Timestamp('2024-01-09')
@@ -0,0 +1,180 @@
+''' Tests for StockDataFetcher against the local CSV source: failed and empty
+tickers, the price cache and its gap downloads, and the retries of Yahoo
+downloads whose tickers fail without an exception. Run from this directory with
+`python -m pytest`.'''
+
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_pipeline import StockDataFetcher
+from data_sources import CsvDirectorySource, DataSource, YahooFinanceSource
+from price_cache import PriceCache
+
+
+# Business-day prices from Monday 2024-01-01 to Friday 2024-03-29.
+def make_prices(n_assets: int = 3) -> pd.DataFrame:
+    dates = pd.bdate_range('2024-01-01', '2024-03-29')
+    rng = np.random.default_rng(3)
+    prices = 100 * np.cumprod(1 + rng.normal(0, 0.01, size=(len(dates), n_assets)), axis=0)
+    return pd.DataFrame(prices, index=dates, columns=[f'T{i}' for i in range(n_assets)])
+
+
+# Counts requests and fails every one of them once `failing` is set.
+class FlakySource(DataSource):
+    def __init__(self, source: DataSource):
+        self.source = source
+        self.failing = False
+        self.calls = 0
+
+    def download(self, tickers, start, end):
+        self.calls += 1
+        if self.failing:
+            raise ConnectionError('connection reset')
+        return self.source.download(tickers, start, end)
+
+
+@pytest.fixture
+def prices() -> pd.DataFrame:
+    return make_prices()
+
+
+@pytest.fixture
+def source(tmp_path, prices) -> CsvDirectorySource:
+    CsvDirectorySource.write(prices, str(tmp_path / 'source'))
+    return CsvDirectorySource(str(tmp_path / 'source'))
+
+
+def make_fetcher(tickers, end, source, cache=None) -> StockDataFetcher:
+    return StockDataFetcher(tickers, '2024-01-01', end, cache=cache, source=source, backoff=0, max_retries=1)
+
+
+def test_unknown_ticker_is_dropped_as_no_data(source, prices):
+    fetcher = make_fetcher(['T0', 'T1', 'NOPE'], '2024-03-30', source)
+    data = fetcher.fetch_data()
+    assert list(data.columns) == ['T0', 'T1']
+    assert fetcher.failed_tickers == {'NOPE': StockDataFetcher.NO_DATA}
+    pd.testing.assert_frame_equal(data, prices[['T0', 'T1']], check_freq=False, check_names=False)
+
+
+# Regression: with a warm cache, a gap without trading days (here a weekend)
+# comes back without columns and used to mark every ticker as 'no data'.
+def test_warm_cache_with_weekend_gap_keeps_every_ticker(tmp_path, source, prices):
+    cache = PriceCache(str(tmp_path / 'cache'))
+    tickers = list(prices.columns)
+    first = make_fetcher(tickers, '2024-03-30', source, cache).fetch_data() # through Friday
+
+    fetcher = make_fetcher(tickers, '2024-04-01', source, cache) # adds Saturday and Sunday
+    assert cache.missing_ranges('T0', '2024-01-01', '2024-04-01') == \
+        [(pd.Timestamp('2024-03-30'), pd.Timestamp('2024-04-01'))]
+    data = fetcher.fetch_data()
+    assert fetcher.failed_tickers == {}
+    assert list(data.columns) == tickers
+    pd.testing.assert_frame_equal(data, first)
+    # The empty gap is remembered as covered, so it is not requested again.
+    assert cache.missing_ranges('T0', '2024-01-01', '2024-04-01') == []
+
+
+def test_failed_gap_download_keeps_cached_prices(tmp_path, source, prices):
+    cache = PriceCache(str(tmp_path / 'cache'))
+    flaky = FlakySource(source)
+    make_fetcher(['T0', 'T1'], '2024-03-01', flaky, cache).fetch_data()
+
+    flaky.failing = True
+    fetcher = make_fetcher(['T0', 'T1', 'T2'], '2024-03-30', flaky, cache)
+    data = fetcher.fetch_data()
+    # T2 has nothing cached, so it fails; T0 and T1 keep their cached history.
+    assert list(data.columns) == ['T0', 'T1']
+    assert list(fetcher.failed_tickers) == ['T2']
+    assert data.index[-1] == pd.Timestamp('2024-02-29')
+    # The failed gap is not marked as covered.
+    assert cache.missing_ranges('T0', '2024-01-01', '2024-03-30') == \
+        [(pd.Timestamp('2024-03-01'), pd.Timestamp('2024-03-30'))]
+
+
+# Regression: holes inside the range saved in the database were never
+# downloaded, only missing edges, and failures of an earlier fetch stayed in
+# failed_tickers.
+def test_load_from_db_fills_interior_holes(engine, source, prices):
+    import db_setup
+    saved = prices.copy()
+    saved.iloc[20:25, 1] = np.nan # a week missing for T1
+    saved.iloc[40, 1] = np.nan # and a single day
+    saved.iloc[-10:, 2] = np.nan # T2 stops early
+    db_setup.insert_adjusted_prices(saved)
+
+    flaky = FlakySource(source)
+    fetcher = make_fetcher(list(prices.columns), '2024-03-30', flaky)
+    fetcher.failed_tickers = {'T0': 'connection reset'}
+    data = fetcher.load_from_db(fill_gaps=True)
+    assert fetcher.failed_tickers == {}
+    assert flaky.calls == 3 # the two holes of T1 and the end of T2
+    pd.testing.assert_frame_equal(data, prices, check_freq=False, check_names=False)
+
+
+# Stand-in for the yfinance module: download answers from `prices` and, like
+# yfinance, leaves failing tickers out and records their errors instead of
+# raising. `errors` holds one {ticker: message} dict per call to fail with.
+# per_call_context mimics yfinance >= 1.0, otherwise the errors go to the
+# pre-1.0 module-global shared._ERRORS.
+def fake_yfinance(prices: pd.DataFrame, errors: list, per_call_context: bool):
+    yf = types.SimpleNamespace(calls=0, shared=types.SimpleNamespace(_ERRORS={}), multi=types.SimpleNamespace())
+
+    def download(context_errors, tickers, start=None, end=None, **kwargs):
+        yf.calls += 1
+        failing = errors.pop(0) if errors else {}
+        context_errors.clear()
+        context_errors.update(failing)
+        window = prices.loc[pd.Timestamp(start):pd.Timestamp(end) - pd.Timedelta(days=1)]
+        window = window[[t for t in tickers if t in window.columns and t not in failing]]
+        return pd.concat({'Adj Close': window}, axis=1)
+
+    if per_call_context:
+        yf.multi._DownloadCtx = lambda: types.SimpleNamespace(errors={})
+        yf.multi._download_impl = lambda context, *args, **kwargs: download(context.errors, *args, **kwargs)
+    else:
+        yf.download = lambda *args, **kwargs: download(yf.shared._ERRORS, *args, **kwargs)
+    return yf
+
+
+@pytest.fixture(params=[True, False], ids=['yfinance-1', 'yfinance-0.2'])
+def install_yfinance(request, monkeypatch, prices):
+    def install(errors):
+        yf = fake_yfinance(prices, errors, per_call_context=request.param)
+        monkeypatch.setitem(sys.modules, 'yfinance', yf)
+        return yf
+    return install
+
+
+# Regression: yfinance does not raise when single tickers fail, so a rate-limited
+# download was never retried and the tickers came back as 'no data'.
+def test_yahoo_ticker_errors_are_retried(install_yfinance, prices):
+    yf = install_yfinance([{'T1': "YFRateLimitError('Too Many Requests. Rate limited. Try after a while.')"}])
+    fetcher = make_fetcher(['T0', 'T1'], '2024-03-30', YahooFinanceSource())
+    data = fetcher.fetch_data()
+    assert yf.calls == 2
+    assert fetcher.failed_tickers == {}
+    pd.testing.assert_frame_equal(data, prices[['T0', 'T1']], check_freq=False, check_names=False)
+
+
+def test_yahoo_errors_fail_the_shard_after_the_last_retry(install_yfinance):
+    rate_limited = {'T1': 'Too Many Requests'}
+    yf = install_yfinance([rate_limited, dict(rate_limited)])
+    fetcher = make_fetcher(['T0', 'T1'], '2024-03-30', YahooFinanceSource())
+    assert fetcher.fetch_data().empty
+    assert yf.calls == 2 # first attempt and max_retries=1
+    assert set(fetcher.failed_tickers) == {'T0', 'T1'}
+    assert 'Too Many Requests' in fetcher.failed_tickers['T1']
+
+
+# A delisted symbol, or a range without trading days, is an answer: no retry.
+def test_yahoo_no_data_errors_are_not_retried(install_yfinance, prices):
+    yf = install_yfinance([{'NOPE': "YFTzMissingError('$NOPE: possibly delisted; no timezone found')"}])
+    fetcher = make_fetcher(['T0', 'NOPE'], '2024-03-30', YahooFinanceSource())
+    data = fetcher.fetch_data()
+    assert yf.calls == 1
+    assert fetcher.failed_tickers == {'NOPE': StockDataFetcher.NO_DATA}
+    assert list(data.columns) == ['T0']
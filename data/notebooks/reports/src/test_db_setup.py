@@ -0,0 +1,107 @@
+''' Tests for the database writers and the schema migration, against a
+throwaway SQLite database. Run from this directory with `python -m pytest`.'''
+
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+import database
+import db_setup
+from analysis import PortfolioAnalyzer
+
+
+def make_prices(n_assets: int = 3, n_days: int = 60, seed: int = 4) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0005, 0.01, size=(n_days, n_assets))
+    return pd.DataFrame(100 * np.cumprod(1 + returns, axis=0), index=pd.bdate_range('2024-01-01', periods=n_days),
+                        columns=[f'T{i}' for i in range(n_assets)])
+
+
+# Regression: the dashboard's save recomputed metrics it had already cached.
+def test_save_all_reuses_given_metrics(engine, monkeypatch):
+    prices = make_prices()
+    metrics = PortfolioAnalyzer(prices).compute_all_metrics()
+
+    def recompute(self):
+        raise AssertionError("metrics were computed again")
+    monkeypatch.setattr(PortfolioAnalyzer, 'compute_all_metrics', recompute)
+    weights = np.full(3, 1 / 3)
+    saved = db_setup.save_all(prices, weights, 1.2, 0.15, weights, metrics=metrics)
+    assert saved == {'metrics': 3, 'allocations': 3, 'prices': prices.size}
+    with engine.connect() as conn:
+        stored = pd.read_sql(text("SELECT ticker, sharpe_ratio FROM portfolio_metrics ORDER BY ticker"), conn)
+    np.testing.assert_allclose(stored['sharpe_ratio'], metrics['sharpe_ratio'])
+
+
+# Regression: concurrent first calls could each create an engine (and pool).
+def test_get_engine_creates_one_engine_across_threads(engine):
+    database.dispose_engine()
+    barrier = threading.Barrier(8)
+    engines = []
+
+    def first_call():
+        barrier.wait()
+        engines.append(database.get_engine())
+    threads = [threading.Thread(target=first_call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(e) for e in engines}) == 1
+
+
+# Regression: the save reported every submitted row as saved, including
+# unchanged rows the upsert skips.
+def test_insert_adjusted_prices_reports_rows_written(engine, capsys):
+    prices = make_prices()
+    assert db_setup.insert_adjusted_prices(prices) == prices.size
+    assert db_setup.insert_adjusted_prices(prices) == 0
+    assert f"Saved 0 of {prices.size} adjusted prices ({prices.size} unchanged)" in capsys.readouterr().out
+    prices.iloc[-1] *= 1.01
+    assert db_setup.insert_adjusted_prices(prices, chunk_size=7) == prices.shape[1]
+
+
+# The unkeyed tables of the first version of this module, with duplicates.
+LEGACY_SCHEMA = """
+CREATE TABLE portfolio_metrics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, ticker VARCHAR, date DATE, cumulative_return NUMERIC,
+    annualized_return NUMERIC, annualized_volatility NUMERIC, sharpe_ratio NUMERIC, max_drawdown NUMERIC
+);
+CREATE TABLE portfolio_allocations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, date DATE, ticker VARCHAR, weight NUMERIC,
+    optimized_sharpe_ratio NUMERIC, optimized_volatility NUMERIC, minimum_volatility_portfolio NUMERIC
+);
+CREATE TABLE adjusted_prices (id INTEGER PRIMARY KEY AUTOINCREMENT, ticker VARCHAR, date DATE, adj_close NUMERIC);
+INSERT INTO portfolio_metrics (ticker, date, sharpe_ratio) VALUES
+    ('A', '2024-01-02', 1.0), ('A', '2024-01-02', 1.5), ('B', '2024-01-02', 0.5);
+INSERT INTO portfolio_allocations (date, ticker, weight) VALUES
+    ('2024-01-02', 'A', 0.2), ('2024-01-02', 'A', 0.6), ('2024-01-02', 'B', 0.4);
+INSERT INTO adjusted_prices (ticker, date, adj_close) VALUES
+    ('A', '2024-01-02', 10.0), ('A', '2024-01-02', 11.0), ('A', '2024-01-03', 12.0), (NULL, '2024-01-03', 1.0)
+"""
+
+
+def test_legacy_schema_is_migrated(empty_engine):
+    with empty_engine.begin() as conn:
+        for statement in LEGACY_SCHEMA.split(';'):
+            conn.execute(text(statement))
+    db_setup.create_tables()
+    db_setup.create_tables() # a second run finds nothing to migrate
+
+    with empty_engine.connect() as conn:
+        prices = conn.execute(text("SELECT ticker, date, adj_close FROM adjusted_prices ORDER BY date")).all()
+        metrics = conn.execute(text("SELECT portfolio, ticker, sharpe_ratio FROM portfolio_metrics "
+                                    "ORDER BY ticker")).all()
+        weights = conn.execute(text("SELECT portfolio, ticker, weight FROM portfolio_allocations "
+                                    "ORDER BY ticker")).all()
+    # The newest row per key wins; rows without a key are dropped.
+    assert [tuple(row) for row in prices] == [('A', '2024-01-02', 11.0), ('A', '2024-01-03', 12.0)]
+    assert [tuple(row) for row in metrics] == [('default', 'A', 1.5), ('default', 'B', 0.5)]
+    assert [tuple(row) for row in weights] == [('default', 'A', 0.6), ('default', 'B', 0.4)]
+
+    # The keyed tables take upserts: saving the same prices again changes nothing.
+    saved = pd.DataFrame({'A': [11.0, 12.0]}, index=pd.to_datetime(['2024-01-02', '2024-01-03']))
+    assert db_setup.insert_adjusted_prices(saved) == 0
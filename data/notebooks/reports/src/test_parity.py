@@ -0,0 +1,80 @@
+''' Parity checks between the fast paths and the straightforward pandas versions
+they replace: IncrementalPortfolioAnalyzer against a full PortfolioAnalyzer
+pass, and PriceMatrix.returns() against pct_change().dropna(), both with gaps
+in the prices. Run from this directory with `python -m pytest`.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis import IncrementalPortfolioAnalyzer, PortfolioAnalyzer
+from price_matrix import PriceMatrix
+
+
+# Random-walk prices for n_assets over n_days business days.
+def make_prices(n_assets: int = 5, n_days: int = 300, seed: int = 7) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0004, 0.012, size=(n_days, n_assets))
+    prices = 100 * np.cumprod(1 + returns, axis=0)
+    return pd.DataFrame(prices, index=pd.bdate_range('2020-01-01', periods=n_days),
+                        columns=[f'T{i}' for i in range(n_assets)])
+
+
+# Prices with a late listing (leading NaNs), a missing bar in one ticker and a
+# date with no prices at all.
+def make_prices_with_gaps() -> pd.DataFrame:
+    prices = make_prices()
+    prices.iloc[:20, 1] = np.nan
+    prices.iloc[100:103, 2] = np.nan
+    prices.iloc[150] = np.nan
+    return prices
+
+
+@pytest.mark.parametrize('prices', [make_prices(), make_prices_with_gaps()], ids=['complete', 'gaps'])
+def test_incremental_matches_batch(prices):
+    seed_rows = 200
+    incremental = IncrementalPortfolioAnalyzer.from_prices(prices.iloc[:seed_rows])
+    for date, row in prices.iloc[seed_rows:].iterrows():
+        incremental.update(row, date)
+    batch = PortfolioAnalyzer(prices)
+
+    assert incremental.count == len(batch.returns)
+    assert incremental.last_date == prices.index[-1]
+    pd.testing.assert_series_equal(incremental.calculate_cumulative_returns(),
+                                   batch.calculate_cumulative_returns().iloc[-1], check_names=False)
+    for metric in ('calculate_annualized_return', 'calculate_annualized_volatility',
+                   'calculate_sharpe_ratio', 'calculate_max_drawdown'):
+        pd.testing.assert_series_equal(getattr(incremental, metric)(), getattr(batch, metric)(),
+                                       check_names=False, rtol=1e-9)
+    for metric in ('calculate_covariance_matrix', 'calculate_correlation_matrix'):
+        pd.testing.assert_frame_equal(getattr(incremental, metric)(), getattr(batch, metric)(), rtol=1e-9)
+
+
+def test_incremental_rejects_incomplete_bar():
+    prices = make_prices()
+    incremental = IncrementalPortfolioAnalyzer.from_prices(prices)
+    with pytest.raises(ValueError, match='T3'):
+        incremental.update(prices.iloc[-1].drop('T3'))
+
+
+def test_price_matrix_returns_match_pct_change():
+    prices = make_prices()
+    returns = PriceMatrix.from_frame(prices).returns()
+    pd.testing.assert_frame_equal(returns.to_frame(), prices.pct_change().dropna(), check_freq=False)
+
+
+# Gaps are forward-filled as pct_change's default (pad) fill does; written out
+# with ffill() so the expectation does not depend on that deprecated default.
+def test_price_matrix_returns_with_gaps():
+    prices = make_prices_with_gaps()
+    returns = PriceMatrix.from_frame(prices).returns()
+    expected = prices.ffill().pct_change().dropna()
+    assert returns.dates[0] == prices.index[21] # first return of the late listing
+    pd.testing.assert_frame_equal(returns.to_frame(), expected, check_freq=False)
+
+
+def test_price_matrix_returns_float32():
+    prices = make_prices_with_gaps()
+    returns = PriceMatrix.from_frame(prices, dtype=np.float32).returns()
+    assert returns.dtype == np.float32
+    np.testing.assert_allclose(returns.values, prices.ffill().pct_change().dropna().to_numpy(), atol=1e-6)
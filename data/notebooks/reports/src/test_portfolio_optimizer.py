@@ -0,0 +1,51 @@
+''' Tests for PortfolioOptimizer.evaluate_portfolios and its benchmark forms.
+Run from this directory with `python -m pytest`.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis import PortfolioAnalyzer
+from portfolio_optimizer import PortfolioOptimizer
+
+
+def make_prices(n_assets: int = 4, n_days: int = 250, seed: int = 2) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0004, 0.012, size=(n_days, n_assets))
+    return pd.DataFrame(100 * np.cumprod(1 + returns, axis=0), index=pd.bdate_range('2022-01-03', periods=n_days),
+                        columns=[f'T{i}' for i in range(n_assets)])
+
+
+@pytest.fixture
+def optimizer() -> PortfolioOptimizer:
+    return PortfolioOptimizer(PortfolioAnalyzer(make_prices()))
+
+
+@pytest.fixture
+def weights() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(rng.dirichlet(np.ones(4), size=5), columns=['T0', 'T1', 'T2', 'T3'])
+
+
+# Regression: a benchmark weight Series indexed by tickers was reindexed on the
+# return dates and gave NaN tracking errors.
+def test_benchmark_weight_series_is_read_as_weights(optimizer, weights):
+    benchmark = pd.Series({'T3': 0.5, 'T0': 0.5}) # T1 and T2 get 0
+    result = optimizer.evaluate_portfolios(weights, benchmark=benchmark)
+    expected = optimizer.evaluate_portfolios(weights, benchmark=np.array([0.5, 0, 0, 0.5]))
+    assert result['tracking_error'].notna().all()
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_benchmark_return_series_gives_active_tracking_error(optimizer, weights):
+    returns = optimizer.returns
+    benchmark = returns.mean(axis=1)
+    result = optimizer.evaluate_portfolios(weights, benchmark=benchmark)
+    active = returns.to_numpy() @ weights.to_numpy().T - benchmark.to_numpy()[:, None]
+    np.testing.assert_allclose(result['tracking_error'], active.std(axis=0, ddof=1) * np.sqrt(252))
+
+
+def test_benchmark_returns_without_common_dates_raise(optimizer, weights):
+    benchmark = pd.Series(0.001, index=pd.bdate_range('2010-01-01', periods=100))
+    with pytest.raises(ValueError, match='share no dates'):
+        optimizer.evaluate_portfolios(weights, benchmark=benchmark)
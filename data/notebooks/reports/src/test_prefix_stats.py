@@ -0,0 +1,159 @@
+''' Tests for the prefix-sum statistics index, in memory and persisted: window
+metrics against PortfolioAnalyzer, tickers with short histories, windows
+outside the index, incremental updates and new tickers. Run from this
+directory with `python -m pytest`.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+import db_setup
+from analysis import PortfolioAnalyzer
+from prefix_stats import PrefixStats
+
+
+# Random-walk prices; T1 is listed late (no prices before day 100) and T2 misses
+# a few bars in the middle.
+def make_prices(n_assets: int = 4, n_days: int = 400, seed: int = 11) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0003, 0.012, size=(n_days, n_assets))
+    prices = pd.DataFrame(100 * np.cumprod(1 + returns, axis=0),
+                          index=pd.bdate_range('2019-01-01', periods=n_days),
+                          columns=[f'T{i}' for i in range(n_assets)])
+    prices.iloc[:100, 1] = np.nan
+    prices.iloc[250:253, 2] = np.nan
+    return prices
+
+
+# What PortfolioAnalyzer reports for the returns dated in [start, end]: the
+# prices from the trading day before start through end.
+def analyzer_for(prices: pd.DataFrame, start, end, tickers) -> PortfolioAnalyzer:
+    first = max(0, prices.index.searchsorted(start) - 1)
+    window = prices.iloc[first:prices.index.searchsorted(end, side='right')][tickers]
+    return PortfolioAnalyzer(window.loc[window.first_valid_index():])
+
+
+METRICS = ['cumulative_return', 'annualized_return', 'annualized_volatility', 'sharpe_ratio']
+
+
+def assert_metrics_match(metrics: pd.DataFrame, analyzer: PortfolioAnalyzer):
+    expected = analyzer.compute_all_metrics()[METRICS]
+    pd.testing.assert_frame_equal(metrics.loc[expected.index, METRICS], expected, rtol=1e-9, check_names=False)
+
+
+@pytest.fixture
+def prices() -> pd.DataFrame:
+    return make_prices()
+
+
+def test_window_metrics_and_covariance_match_analyzer(prices):
+    stats = PrefixStats.from_prices(prices)
+    dates = prices.index
+    start, end = dates[120], dates[380]
+    assert_metrics_match(stats.range_metrics(start, end), analyzer_for(prices, start, end, list(prices.columns)))
+    pd.testing.assert_frame_equal(stats.range_covariance(start, end),
+                                  analyzer_for(prices, start, end, list(prices.columns))
+                                  .calculate_covariance_matrix(), rtol=1e-9, check_names=False)
+
+
+# Regression: one ticker with a short history used to cut the history of all
+# the others, and windows before its listing raised.
+def test_short_history_does_not_cut_other_tickers(prices):
+    stats = PrefixStats.from_prices(prices)
+    dates = prices.index
+    assert len(stats) == len(prices)
+    start, end = dates[10], dates[300]
+    metrics = stats.range_metrics(start, end)
+    for ticker in ('T0', 'T2', 'T3'):
+        assert_metrics_match(metrics, analyzer_for(prices, start, end, [ticker]))
+    # T1 is measured over its own returns only, from its listing on.
+    assert_metrics_match(metrics, analyzer_for(prices, dates[101], end, ['T1']))
+    # A covariance needs every ticker on every date of the window.
+    with pytest.raises(ValueError, match='T1'):
+        stats.range_covariance(start, end)
+    stats.range_covariance(dates[101], end)
+
+
+# Regression: a start before the first indexed date was clamped to it.
+def test_window_outside_index_raises(prices):
+    dates = prices.index
+    stats = PrefixStats.from_prices(prices.iloc[20:])
+    with pytest.raises(ValueError, match='before the first indexed date'):
+        stats.range_metrics(dates[10], dates[-1])
+    with pytest.raises(ValueError, match='after the last indexed date'):
+        stats.range_metrics(dates[30], dates[-1] + pd.Timedelta(days=1))
+    assert_metrics_match(stats.range_metrics(dates[21], dates[-1]),
+                         analyzer_for(prices, dates[21], dates[-1], ['T0']))
+
+
+def test_extend_in_chunks_matches_full_build(prices):
+    full = PrefixStats.from_prices(prices)
+    stats = PrefixStats.empty(prices.columns)
+    for first in range(0, len(prices), 37):
+        stats.extend(prices.iloc[first:first + 37])
+    assert (stats.dates == full.dates).all()
+    for name in PrefixStats.STATISTICS:
+        np.testing.assert_allclose(getattr(stats, name), getattr(full, name), rtol=1e-12)
+
+
+def test_persisted_index_matches_memory(engine, prices, monkeypatch):
+    db_setup.insert_adjusted_prices(prices)
+    # Small stream chunks so the rebuild runs over many date chunks.
+    stream = db_setup._stream_prices
+    monkeypatch.setattr(db_setup, '_stream_prices',
+                        lambda conn, tickers=None, after=None: stream(conn, tickers, after, chunk_size=50))
+    assert db_setup.rebuild_prefix_stats() == len(prices)
+
+    full = PrefixStats.from_prices(prices)
+    loaded = db_setup.load_prefix_stats()
+    for name in PrefixStats.STATISTICS:
+        np.testing.assert_allclose(getattr(loaded, name), getattr(full, name), rtol=1e-12, atol=1e-12)
+
+    dates = prices.index
+    for start, end in ((None, None), (dates[0], dates[50]), (dates[120], dates[380]), (dates[5], None)):
+        pd.testing.assert_frame_equal(db_setup.prefix_range_metrics(start, end), full.range_metrics(start, end),
+                                      rtol=1e-9)
+    pd.testing.assert_frame_equal(db_setup.prefix_range_covariance(dates[120], dates[380], tickers=['T3', 'T1']),
+                                  full.range_covariance(dates[120], dates[380]).loc[['T1', 'T3'], ['T1', 'T3']],
+                                  rtol=1e-9)
+    with pytest.raises(ValueError, match='before the first indexed date'):
+        db_setup.prefix_range_metrics(dates[0] - pd.Timedelta(days=7), dates[50])
+    with pytest.raises(KeyError):
+        db_setup.prefix_range_metrics(tickers=['NOPE'])
+
+
+def test_nightly_update_matches_full_build(engine, prices):
+    db_setup.insert_adjusted_prices(prices.iloc[:200])
+    db_setup.update_prefix_stats()
+    db_setup.insert_adjusted_prices(prices.iloc[200:])
+    assert db_setup.update_prefix_stats() == len(prices) - 200
+    assert db_setup.update_prefix_stats() == 0
+
+    full = PrefixStats.from_prices(prices)
+    loaded = db_setup.load_prefix_stats()
+    for name in PrefixStats.STATISTICS:
+        np.testing.assert_allclose(getattr(loaded, name), getattr(full, name), rtol=1e-12, atol=1e-12)
+
+
+# Regression: tickers saved after the index was built were never indexed.
+def test_nightly_update_indexes_new_tickers(engine, prices):
+    db_setup.insert_adjusted_prices(prices[['T0', 'T1']])
+    db_setup.update_prefix_stats()
+    db_setup.insert_adjusted_prices(prices[['T2', 'T3']])
+    db_setup.update_prefix_stats()
+
+    dates = prices.index
+    full = PrefixStats.from_prices(prices)
+    pd.testing.assert_frame_equal(db_setup.prefix_range_metrics(dates[120], dates[380], tickers=['T3']),
+                                  full.range_metrics(dates[120], dates[380]).loc[['T3']], rtol=1e-9)
+    pd.testing.assert_frame_equal(db_setup.prefix_range_covariance(dates[120], dates[380]),
+                                  full.range_covariance(dates[120], dates[380]), rtol=1e-9)
+
+
+def test_outdated_index_is_dropped_on_migration(engine):
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO return_prefix_stats VALUES ('T0', '2020-01-02', 0.01, 0.0001, 0.01, 1)"))
+    db_setup.create_tables()
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM return_prefix_stats")).scalar() == 0
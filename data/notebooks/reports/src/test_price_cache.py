@@ -0,0 +1,83 @@
+''' Tests for the on-disk PriceCache: coverage bookkeeping, round trips through
+the Parquet files, the manifest written by flush() and LRU eviction. Run from
+this directory with `python -m pytest`.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from price_cache import PriceCache
+
+
+def make_prices(start: str = '2024-01-01', end: str = '2024-03-29', seed: int = 8) -> pd.Series:
+    dates = pd.bdate_range(start, end)
+    rng = np.random.default_rng(seed)
+    return pd.Series(100 * np.cumprod(1 + rng.normal(0, 0.01, len(dates))), index=dates, name='T0')
+
+
+@pytest.fixture
+def cache(tmp_path) -> PriceCache:
+    return PriceCache(str(tmp_path / 'cache'))
+
+
+def ts(date: str) -> pd.Timestamp:
+    return pd.Timestamp(date)
+
+
+def test_missing_ranges_skip_covered_pieces(cache):
+    prices = make_prices()
+    assert cache.missing_ranges('T0', '2024-01-01', '2024-04-01') == [(ts('2024-01-01'), ts('2024-04-01'))]
+    cache.store('T0', prices['2024-01-15':'2024-01-31'], '2024-01-15', '2024-02-01')
+    cache.store('T0', prices['2024-03-01':'2024-03-14'], '2024-03-01', '2024-03-15')
+    assert cache.missing_ranges('T0', '2024-01-01', '2024-04-01') == [
+        (ts('2024-01-01'), ts('2024-01-15')),
+        (ts('2024-02-01'), ts('2024-03-01')),
+        (ts('2024-03-15'), ts('2024-04-01')),
+    ]
+    # Touching ranges merge into one.
+    cache.store('T0', prices['2024-02-01':'2024-02-29'], '2024-02-01', '2024-03-01')
+    assert cache.missing_ranges('T0', '2024-01-15', '2024-03-15') == []
+
+
+def test_store_and_load_round_trip(cache):
+    prices = make_prices()
+    cache.store('T0', prices[:'2024-02-15'], '2024-01-01', '2024-02-16')
+    cache.store('T0', prices['2024-02-10':], '2024-02-10', '2024-03-30') # overlapping, newer values win
+    loaded = cache.load('T0', '2024-01-01', '2024-03-30')
+    pd.testing.assert_series_equal(loaded, prices, check_freq=False, check_names=False)
+    # [start, end): the end date is not included.
+    assert cache.load('T0', '2024-01-02', '2024-01-05').index[-1] == ts('2024-01-04')
+    assert cache.load('NOPE', '2024-01-01', '2024-03-30').empty
+
+
+# Today's bar may still change, so its coverage is never recorded.
+def test_coverage_stops_before_today(cache):
+    today = pd.Timestamp.today().normalize()
+    cache.store('T0', pd.Series([100.0], index=[today - pd.Timedelta(days=1)]), today - pd.Timedelta(days=1),
+                today + pd.Timedelta(days=5))
+    assert cache.missing_ranges('T0', today - pd.Timedelta(days=1), today + pd.Timedelta(days=5)) == \
+        [(today, today + pd.Timedelta(days=5))]
+
+
+def test_flush_writes_the_manifest(tmp_path, cache):
+    cache.store('T0', make_prices(), '2024-01-01', '2024-03-30')
+    assert PriceCache(cache.cache_dir).missing_ranges('T0', '2024-01-01', '2024-03-30') != []
+    cache.flush()
+    assert PriceCache(cache.cache_dir).missing_ranges('T0', '2024-01-01', '2024-03-30') == []
+
+
+def test_evict_drops_least_recently_used_tickers(cache):
+    for i, ticker in enumerate(['A', 'B', 'C']):
+        cache.store(ticker, make_prices(seed=i).rename(ticker), '2024-01-01', '2024-03-30')
+    cache.flush()
+    cache.load('A', '2024-01-01', '2024-03-30') # A becomes the most recently used
+    cache.max_bytes = cache.size_bytes() * 2 // 3
+    cache.evict()
+    assert cache.missing_ranges('B', '2024-01-01', '2024-03-30') != [] # oldest access, evicted
+    assert cache.missing_ranges('A', '2024-01-01', '2024-03-30') == []
+    assert cache.missing_ranges('C', '2024-01-01', '2024-03-30') == []
+    assert cache.size_bytes() <= cache.max_bytes
+
+    cache.invalidate()
+    assert cache.size_bytes() == 0
+    assert cache.load('A', '2024-01-01', '2024-03-30').empty
@@ -0,0 +1,75 @@
+''' Tests for the memory-mapped price store: round trips, ticker and date
+selection without copies, float32 storage and the analyzer on a store. Run from
+this directory with `python -m pytest`.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis import PortfolioAnalyzer
+from price_store import load_price_matrix, open_price_matrix, save_price_matrix
+
+
+def make_prices(n_assets: int = 5, n_days: int = 200, seed: int = 9) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0004, 0.012, size=(n_days, n_assets))
+    prices = pd.DataFrame(100 * np.cumprod(1 + returns, axis=0), index=pd.bdate_range('2023-01-02', periods=n_days),
+                          columns=[f'T{i}' for i in range(n_assets)])
+    prices.iloc[:30, 2] = np.nan # late listing
+    return prices
+
+
+# Whether an array is a view of a memory map rather than a copy in memory.
+def memory_mapped(values: np.ndarray) -> bool:
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+@pytest.fixture
+def prices() -> pd.DataFrame:
+    return make_prices()
+
+
+@pytest.fixture
+def store(tmp_path, prices) -> str:
+    path = str(tmp_path / 'store')
+    save_price_matrix(prices, path)
+    return path
+
+
+def test_round_trip(store, prices):
+    pd.testing.assert_frame_equal(load_price_matrix(store), prices, check_freq=False)
+
+
+def test_selection_reads_a_view_of_the_memory_map(store, prices):
+    dates = prices.index
+    matrix = open_price_matrix(store, tickers=['T1', 'T2'], start=dates[10], end=dates[49])
+    # [start, end], both included
+    pd.testing.assert_frame_equal(matrix.to_frame(), prices.loc[dates[10]:dates[49], ['T1', 'T2']],
+                                  check_freq=False)
+    assert memory_mapped(matrix.values)
+    # Tickers out of order are copied, still in the requested order.
+    matrix = open_price_matrix(store, tickers=['T4', 'T0'])
+    assert not memory_mapped(matrix.values)
+    pd.testing.assert_frame_equal(matrix.to_frame(), prices[['T4', 'T0']], check_freq=False)
+
+
+def test_unknown_ticker_raises(store):
+    with pytest.raises(KeyError, match='NOPE'):
+        open_price_matrix(store, tickers=['T0', 'NOPE'])
+
+
+def test_float32_store(tmp_path, prices):
+    path = str(tmp_path / 'store32')
+    save_price_matrix(prices, path, dtype=np.float32)
+    loaded = load_price_matrix(path)
+    assert (loaded.dtypes == np.float32).all()
+    np.testing.assert_allclose(loaded.to_numpy(), prices.to_numpy(), rtol=1e-6)
+
+
+def test_analyzer_on_store_matches_frame(store, prices):
+    metrics = PortfolioAnalyzer(open_price_matrix(store)).compute_all_metrics()
+    pd.testing.assert_frame_equal(metrics, PortfolioAnalyzer(prices).compute_all_metrics(), rtol=1e-12)
@@ -0,0 +1,70 @@
+''' Tests for the tail-risk module: drawdown statistics on hand-built series
+and VaR/CVaR against straightforward per-window versions. Run from this
+directory with `python -m pytest`.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import risk
+from analysis import PortfolioAnalyzer
+
+
+# Wealth after each day 1.1, 0.88, 0.99, 1.1, 1.21: a 20% drawdown from the
+# peak on day 0, trough on day 1, back at the peak on day 3.
+RECOVERED = [0.1, -0.2, 0.125, 1.1 / 0.99 - 1, 0.1]
+# Same fall, never recovered.
+UNRECOVERED = [0.1, -0.2, 0.125, -0.05, 0.01]
+
+
+def test_drawdown_statistics_recovered_and_unrecovered():
+    stats = risk.drawdown_statistics(np.column_stack([RECOVERED, UNRECOVERED]))
+    np.testing.assert_allclose(stats['max_drawdown'], [0.2, 0.2])
+    np.testing.assert_array_equal(stats['peak'], [0, 0])
+    np.testing.assert_array_equal(stats['trough'], [1, 1])
+    np.testing.assert_array_equal(stats['recovery'], [3, -1])
+    np.testing.assert_array_equal(stats['recovery_days'], [2, np.nan])
+    np.testing.assert_array_equal(stats['max_duration'], [2, 4])
+    np.testing.assert_array_equal(stats['current_duration'], [0, 4])
+
+
+# Regression: a series that never fell was reported as recovered on its second
+# day.
+def test_drawdown_statistics_monotonically_rising_series():
+    stats = risk.drawdown_statistics(np.full(10, 0.01))
+    assert stats['max_drawdown'][0] == 0
+    assert stats['recovery'][0] == -1
+    assert np.isnan(stats['recovery_days'][0])
+    assert stats['max_duration'][0] == 0
+
+    # Through the analyzer: no recovery date for the rising ticker.
+    growth = {'UP': np.full(10, 0.01), 'DOWN': np.r_[RECOVERED, np.full(5, 0.01)]}
+    prices = pd.DataFrame({ticker: 100 * np.cumprod(np.r_[1, 1 + r]) for ticker, r in growth.items()},
+                          index=pd.bdate_range('2024-01-01', periods=11))
+    table = PortfolioAnalyzer(prices).calculate_drawdown_statistics()
+    assert pd.isna(table.loc['UP', 'recovery_date'])
+    assert np.isnan(table.loc['UP', 'recovery_days'])
+    assert table.loc['DOWN', 'recovery_date'] == prices.index[4]
+    assert table.loc['DOWN', 'recovery_days'] == 2
+
+
+@pytest.fixture
+def returns() -> np.ndarray:
+    return np.random.default_rng(5).standard_t(4, size=(500, 3)) * 0.01
+
+
+def test_historical_var_cvar_matches_sorted_tail(returns):
+    var, cvar = risk.var_cvar(returns, 0.95)
+    tail = np.sort(returns, axis=0)[:25] # ceil(0.05 * 500) worst days
+    np.testing.assert_allclose(var, -tail[-1])
+    np.testing.assert_allclose(cvar, -tail.mean(axis=0))
+
+
+@pytest.mark.parametrize('method', list(risk.METHODS))
+def test_rolling_var_cvar_matches_each_window(returns, method):
+    window, step = 120, 7
+    var, cvar = risk.rolling_var_cvar(returns, window, 0.99, method, step=step, max_elements=1_000)
+    for row, first in enumerate(range(0, len(returns) - window + 1, step)):
+        expected = risk.var_cvar(returns[first:first + window], 0.99, method)
+        np.testing.assert_allclose(var[row], expected[0], rtol=1e-8)
+        np.testing.assert_allclose(cvar[row], expected[1], rtol=1e-8)
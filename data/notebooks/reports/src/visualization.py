@@ -1,111 +1,209 @@
 # Create visualizations for the metrics
+# Figures are built with the object-oriented matplotlib API (no global pyplot
+# state), long time series are downsampled to the figure's pixel width with
+# LTTB, and rendered figures are cached by a hash of their input data.
+
+import hashlib
+from collections import OrderedDict
 
-from data_pipeline import StockDataFetcher
-from analysis import PortfolioAnalyzer
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sns
+import pandas as pd
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+import matplotlib.dates as mdates
+
+from analysis import PortfolioAnalyzer
+from downsampling import lttb_indices
+
+FIGSIZE = (10, 6)
+DPI = 100
+MAX_POINTS = FIGSIZE[0] * DPI # one point per horizontal pixel, see downsampling.py
+ANNOTATE_LIMIT = 20 # heatmaps with more tickers are drawn without cell labels
+LINE_LIMIT = 50 # time series of more tickers are drawn as a density image
+LABEL_LIMIT = 100 # ... and without tick labels beyond this
+FIGURE_CACHE_SIZE = 32
+
+
+# Order tickers so that correlated ones sit next to each other (average-linkage
+# hierarchical clustering on 1 - correlation).
+def cluster_order(corr_matrix: pd.DataFrame) -> np.ndarray:
+    from scipy.cluster.hierarchy import leaves_list, linkage
+    from scipy.spatial.distance import squareform
+    distance = np.clip(1 - corr_matrix.to_numpy(dtype=float), 0, 2)
+    distance = np.nan_to_num((distance + distance.T) / 2, nan=2.0)
+    np.fill_diagonal(distance, 0)
+    return leaves_list(linkage(squareform(distance, checks=False), method='average'))
+
+
+def _data_hash(*objects) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for obj in objects:
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            digest.update(np.ascontiguousarray(obj.to_numpy(dtype=float)).tobytes())
+            digest.update(repr((list(obj.index[[0, -1]]) if len(obj) else [], len(obj.index))).encode())
+            digest.update(repr(list(obj.columns) if isinstance(obj, pd.DataFrame) else obj.name).encode())
+        else:
+            digest.update(repr(obj).encode())
+    return digest.hexdigest()
+
+
+# Rendered figures shared by every Visualizer, least recently used evicted first.
+_figure_cache = OrderedDict()
+
+
+def _cached_figure(key: str, draw) -> Figure:
+    if key in _figure_cache:
+        _figure_cache.move_to_end(key)
+        return _figure_cache[key]
+    fig = draw()
+    _figure_cache[key] = fig
+    if len(_figure_cache) > FIGURE_CACHE_SIZE:
+        _figure_cache.popitem(last=False)
+    return fig
+
+
+def clear_figure_cache():
+    _figure_cache.clear()
 
 
 class Visualizer:
-    def __init__(self, analyzer: PortfolioAnalyzer):
+    # Metrics come from the analyzer's cache, so they are computed at most once
+    # whether the analyzer already used them or a plot asks first.
+    def __init__(self, analyzer: PortfolioAnalyzer, max_points: int = MAX_POINTS):
         self.analyzer = analyzer
         self.prices = analyzer.prices # Historical prices Dataframe
-        self.returns = analyzer.returns # Daily returns
+        self.max_points = max_points # points per line after downsampling
+
+    @property
+    def returns(self) -> pd.DataFrame:
+        return self.analyzer.returns # Daily returns
+
+    # Draw one downsampled line per column as a single LineCollection. Beyond
+    # LINE_LIMIT tickers individual lines are unreadable and slow to rasterize,
+    # so the figure shows how many tickers fall in each pixel instead.
+    def _line_figure(self, frame: pd.DataFrame, title: str, ylabel: str) -> Figure:
+        def draw():
+            fig = Figure(figsize=FIGSIZE, dpi=DPI)
+            ax = fig.subplots()
+            x = mdates.date2num(pd.to_datetime(frame.index))
+            values = frame.to_numpy(dtype=float)
+            if values.shape[1] > LINE_LIMIT:
+                self._draw_density(fig, ax, x, values)
+            else:
+                self._draw_lines(ax, x, values, frame.columns)
+            ax.set_title(title)
+            ax.set_xlabel("Date")
+            ax.set_ylabel(ylabel)
+            ax.grid(True)
+            fig.tight_layout()
+            return fig
+        return _cached_figure(_data_hash('line', frame, title, self.max_points), draw)
+
+    def _draw_lines(self, ax, x: np.ndarray, values: np.ndarray, columns):
+        indices = lttb_indices(x, values, self.max_points)
+        segments = [np.column_stack((x[indices[:, j]], values[indices[:, j], j]))
+                    for j in range(values.shape[1])]
+        colors = [f'C{j % 10}' for j in range(len(segments))]
+        ax.add_collection(LineCollection(segments, colors=colors, linewidths=1))
+        ax.autoscale()
+        ax.xaxis_date()
+        if len(segments) <= ANNOTATE_LIMIT:
+            ax.legend(handles=[ax.plot([], [], color=color, label=str(column))[0]
+                               for color, column in zip(colors, columns)], fontsize='small')
+
+    # 2-D histogram of all values with max_points time bins; the value axis is
+    # clipped to the 0.5-99.5 percentiles so a few outliers do not flatten it.
+    def _draw_density(self, fig, ax, x: np.ndarray, values: np.ndarray):
+        finite = np.isfinite(values)
+        low, high = np.percentile(values[finite], [0.5, 99.5])
+        x_all = np.broadcast_to(x[:, None], values.shape)[finite]
+        counts, x_edges, y_edges = np.histogram2d(
+            x_all, np.clip(values[finite], low, high),
+            bins=(min(self.max_points, len(x)), FIGSIZE[1] * DPI // 2),
+            range=((x[0], x[-1]), (low, high)))
+        image = ax.imshow(np.log1p(counts.T), origin='lower', aspect='auto', cmap='viridis',
+                          extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]), interpolation='nearest')
+        ax.xaxis_date()
+        fig.colorbar(image, ax=ax, label='log(1 + tickers)')
+
+    def _bar_figure(self, series: pd.Series, title: str, ylabel: str) -> Figure:
+        def draw():
+            fig = Figure(figsize=FIGSIZE, dpi=DPI)
+            ax = fig.subplots()
+            ax.bar(series.index.astype(str), series.to_numpy(dtype=float))
+            if len(series) > LABEL_LIMIT:
+                ax.set_xticks([])
+            ax.set_title(title)
+            ax.set_xlabel("Tickers")
+            ax.set_ylabel(ylabel)
+            ax.grid(axis='y')
+            fig.tight_layout()
+            return fig
+        return _cached_figure(_data_hash('bar', series, title), draw)
+
+    # Small matrices are annotated cell by cell; large ones are reordered by
+    # clustering on corr_matrix and drawn as a plain image.
+    def _heatmap_figure(self, matrix: pd.DataFrame, corr_matrix: pd.DataFrame, title: str,
+                        vmin=None, vmax=None) -> Figure:
+        def draw():
+            n = len(matrix)
+            values = matrix
+            if n > ANNOTATE_LIMIT:
+                order = cluster_order(corr_matrix)
+                values = matrix.iloc[order, order]
+            fig = Figure(figsize=(8, 6), dpi=DPI)
+            ax = fig.subplots()
+            image = ax.imshow(values.to_numpy(dtype=float), cmap='coolwarm', vmin=vmin, vmax=vmax,
+                              interpolation='nearest', aspect='auto')
+            fig.colorbar(image, ax=ax)
+            if n <= LABEL_LIMIT:
+                ax.set_xticks(range(n), values.columns, rotation=90, fontsize='small')
+                ax.set_yticks(range(n), values.index, fontsize='small')
+            else:
+                ax.set_xticks([])
+                ax.set_yticks([])
+            if n <= ANNOTATE_LIMIT:
+                for i in range(n):
+                    for j in range(n):
+                        ax.text(j, i, f'{values.iat[i, j]:.2f}', ha='center', va='center', fontsize='small')
+            ax.set_title(title)
+            fig.tight_layout()
+            return fig
+        return _cached_figure(_data_hash('heatmap', matrix, title), draw)
 
     # Create a line plot to plot daily returns.
-    def plot_daily_returns(self):
-        self.returns.plot() # I'm accessing this form __init__
-        plt.title("Daily Returns")
-        plt.xlabel("Date")
-        plt.ylabel("Return")
-        plt.grid(True)
-        plt.tight_layout()
-        plt.show()
+    def plot_daily_returns(self) -> Figure:
+        return self._line_figure(self.returns, "Daily Returns", "Return")
 
     # Create a line plot to plot cumulative returns.
-    def plot_cumulative_returns(self):
-        cum_returns = (1 + self.returns).cumprod() - 1
-        cum_returns.plot() # I'm calculating this inside this method, therefore no self is used
-        plt.title("Cumulative Returns")
-        plt.xlabel("Date")
-        plt.ylabel("Returns")
-        plt.grid(True)
-        plt.tight_layout()
-        plt.show()
-
-
+    def plot_cumulative_returns(self) -> Figure:
+        return self._line_figure(self.analyzer.calculate_cumulative_returns() - 1, "Cumulative Returns", "Returns")
 
     # Create a bar chart to plot annualized volatility.
-    def plot_annualized_volatility(self):
-        std_daily_returns = self.returns.std()
-        vol = std_daily_returns * np.sqrt(252)
-        plt.bar(vol.index, vol.values)
-        plt.title("Annualized Volatility")
-        plt.xlabel("Tickers")
-        plt.ylabel("Volatility")
-        plt.grid(axis='y')
-        plt.tight_layout()
-        plt.show()
-
+    def plot_annualized_volatility(self) -> Figure:
+        return self._bar_figure(self.analyzer.calculate_annualized_volatility(), "Annualized Volatility",
+                                "Volatility")
 
     # Create a bar chart to plot annualized return
-    def plot_annualized_return(self):
-        average_daily_returns = self.returns.mean()  # Take the average of daily returns.
-        ann_returns = average_daily_returns * 252
-        plt.bar(ann_returns.index, ann_returns.values)
-        plt.title("Annualized Returns")
-        plt.xlabel("Tickers")
-        plt.ylabel("Return")
-        plt.grid(axis='y')
-        plt.tight_layout()
-        plt.show()
-
+    def plot_annualized_return(self) -> Figure:
+        return self._bar_figure(self.analyzer.calculate_annualized_return(), "Annualized Returns", "Return")
 
     # Create a bar chart to plot the Sharpe Ratio.
-    def plot_sharpe_ratio(self):
-        annualized_returns = self.analyzer.calculate_annualized_return()
-        annualized_volatility = self.analyzer.calculate_annualized_volatility()
-        risk_free_rate = self.analyzer.risk_free_rate
-        sharpe_ratio = (annualized_returns - risk_free_rate) / annualized_volatility
-        plt.bar(sharpe_ratio.index, sharpe_ratio.values)
-        plt.title("Sharpe Ratio")
-        plt.xlabel("Tickers")
-        plt.ylabel("Sharpe Ratio")
-        plt.grid(axis='y')
-        plt.tight_layout()
-        plt.show()
-
-
-    # Create a line plot to plot the max drawdown.
-    def plot_max_drawdown(self):
-        cumulative_returns = self.analyzer.calculate_cumulative_returns()
-        running_max = cumulative_returns.cummax()
-        drawdown = (running_max - cumulative_returns) / running_max
-        max_drawdown = drawdown.max()
-        max_drawdown.plot()
-        plt.title("Maximun Drawdown")
-        plt.xlabel("Tickers")
-        plt.ylabel("Max. Drawdown")
-        plt.grid(True)
-        plt.tight_layout()
-        plt.show()
+    def plot_sharpe_ratio(self) -> Figure:
+        return self._bar_figure(self.analyzer.calculate_sharpe_ratio(), "Sharpe Ratio", "Sharpe Ratio")
+
+    # Create a bar chart to plot the max drawdown.
+    def plot_max_drawdown(self) -> Figure:
+        return self._bar_figure(self.analyzer.calculate_max_drawdown(), "Maximum Drawdown", "Max. Drawdown")
 
     # Create a heatmap to display the correlation matrix
-    def correlation_heatmap(self):
+    def correlation_heatmap(self) -> Figure:
         corr_matrix = self.analyzer.calculate_correlation_matrix()
-        # Create figure and axes
-        fig, ax = plt.subplots(figsize=(8, 6))
-        sns.heatmap(corr_matrix, annot=True,
-        cmap='coolwarm', fmt='.2f', ax=ax)
-        ax.set_title('Correlation Matrix Heatmap')
-        return fig # Return figure instead of calling plt.show()
+        return self._heatmap_figure(corr_matrix, corr_matrix, 'Correlation Matrix Heatmap', vmin=-1, vmax=1)
 
     # Create a heatmap to display the covariance matrix
-    def covariance_heatmap(self):
+    def covariance_heatmap(self) -> Figure:
         cov_matrix = self.analyzer.calculate_covariance_matrix()
-        cov_matrix = sns.heatmap(cov_matrix, annot= True, cmap='coolwarm', fmt='.2f')
-        plt.title('Covariance Matrix')
-        plt.show()
-
-
+        volatility = np.sqrt(np.diag(cov_matrix))
+        corr_matrix = cov_matrix / np.outer(volatility, volatility)
+        return self._heatmap_figure(cov_matrix, corr_matrix, 'Covariance Matrix')